@@ -0,0 +1,219 @@
+#!/usr/bin/env python3
+
+import argparse
+import json
+import random
+import socket
+import sys
+import threading
+import time
+
+import log
+import server
+
+from metrics import Histogram
+
+
+class Stats:
+    '''
+    Stats accumulates the outcome of the requests issued by one connection.
+    '''
+
+    def __init__(self):
+        self.latencies = Histogram()
+        self.requests = 0
+        self.errors = 0
+        self.bytes_sent = 0
+        self.bytes_received = 0
+
+    def merge(self, other):
+        self.latencies.merge(other.latencies)
+        self.requests += other.requests
+        self.errors += other.errors
+        self.bytes_sent += other.bytes_sent
+        self.bytes_received += other.bytes_received
+
+
+def parse_size_distribution(value):
+    '''
+    Parses a message size distribution such as "64:0.5,1024:0.4,8192:0.1".
+
+    Args:
+        value (str): Comma separated sizes, each one optionally followed by its weight.
+
+    Returns:
+        tuple: The list of sizes and the list of their weights.
+    '''
+
+    sizes, weights = [], []
+
+    for item in value.split(','):
+        size, _, weight = item.partition(':')
+        sizes.append(int(size))
+        weights.append(float(weight or 1))
+
+    return sizes, weights
+
+def run_connection(address, sizes, weights, deadline, max_requests, stats):
+    '''
+    Sends messages over a single connection, one at a time, and records how
+    long every echo takes to be fully received.
+    '''
+
+    rng = random.Random()
+
+    try:
+        with socket.create_connection(address) as ss:
+            ss.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+            while time.monotonic() < deadline and stats.requests < max_requests:
+                size = rng.choices(sizes, weights)[0]
+                message = b'x' * (size - 1) + b'\n'
+
+                started_at = time.perf_counter_ns()
+                ss.sendall(message)
+
+                received = 0
+                while received < len(message):
+                    data = ss.recv(65536)
+                    if not data:
+                        raise ConnectionError('server has closed the connection')
+
+                    received += len(data)
+
+                stats.latencies.record((time.perf_counter_ns() - started_at) // 1000)
+                stats.requests += 1
+                stats.bytes_sent += len(message)
+                stats.bytes_received += received
+
+    except Exception as e:
+        stats.errors += 1
+        print(f'an exception occurred while benchmarking: Exception = {e}', file = sys.stderr)
+
+def run_benchmark(address, connections, sizes, weights, duration, max_requests):
+    '''
+    Opens a number of concurrent connections to the server and drives them
+    until the duration elapses (or every connection sends max_requests).
+
+    Returns:
+        tuple: The merged Stats and the elapsed time in seconds.
+    '''
+
+    deadline = time.monotonic() + duration
+
+    stats = [Stats() for _ in range(connections)]
+    threads = [threading.Thread(target = run_connection, args = (address, sizes, weights, deadline, max_requests, s)) for s in stats]
+
+    started_at = time.monotonic()
+
+    for t in threads:
+        t.start()
+
+    for t in threads:
+        t.join()
+
+    elapsed = time.monotonic() - started_at
+
+    total = Stats()
+    for s in stats:
+        total.merge(s)
+
+    return total, elapsed
+
+def build_report(stats, elapsed):
+    latencies = stats.latencies
+
+    return {
+        'requests': stats.requests,
+        'errors': stats.errors,
+        'elapsed_seconds': round(elapsed, 3),
+        'requests_per_second': round(stats.requests / elapsed, 2) if elapsed else 0,
+        'bytes_per_second': round((stats.bytes_sent + stats.bytes_received) / elapsed, 2) if elapsed else 0,
+        'latency_us': {
+            'min': latencies.min or 0,
+            'mean': round(latencies.mean(), 1),
+            'p50': latencies.percentile(50),
+            'p95': latencies.percentile(95),
+            'p99': latencies.percentile(99),
+            'p99.9': latencies.percentile(99.9),
+            'max': latencies.max or 0,
+        },
+        'histogram_us': [[lower, upper, count] for lower, upper, count in latencies.buckets()],
+    }
+
+def print_report(report, output_file = sys.stdout):
+    print(f'requests:     {report["requests"]} ({report["errors"]} errors) in {report["elapsed_seconds"]}s', file = output_file)
+    print(f'throughput:   {report["requests_per_second"]} req/s, {report["bytes_per_second"]} bytes/s', file = output_file)
+
+    latency = report['latency_us']
+    print(f'latency (us): min {latency["min"]}  mean {latency["mean"]}  p50 {latency["p50"]}  p95 {latency["p95"]}  p99 {latency["p99"]}  p99.9 {latency["p99.9"]}  max {latency["max"]}', file = output_file)
+
+    histogram = report['histogram_us']
+    if not histogram:
+        return
+
+    widest = max(count for _, _, count in histogram)
+    for lower, upper, count in histogram:
+        print(f'  {lower:>9} - {upper:<9} {count:>9} {"#" * max(1, 40 * count // widest)}', file = output_file)
+
+def start_in_process(mode, threads):
+    '''
+    Starts the echo server in a background thread on an ephemeral port.
+
+    Returns:
+        tuple: The running server and the address it is listening on.
+    '''
+
+    if mode == 'selectors':
+        ss = server.SelectorServer()
+    elif mode == 'asyncio':
+        ss = server.AsyncServer()
+    else:
+        ss = server.Server(threads = threads)
+
+    threading.Thread(target = ss.start, args = ('localhost', 0), daemon = True).start()
+
+    while True:
+        if mode == 'asyncio' and ss.server and ss.server.sockets:
+            return ss, ss.server.sockets[0].getsockname()[:2]
+
+        if mode != 'asyncio' and ss.socket:
+            return ss, ss.socket.getsockname()[:2]
+
+        time.sleep(0.01)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = 'measures the throughput and the latency of the echo server')
+
+    parser.add_argument('--host', '-H', type = str, default = 'localhost', help = 'remote server\'s address (default localhost)')
+    parser.add_argument('--port', '-p', type = int, default = 8080, help = 'remote server\'s port (default 8080)')
+    parser.add_argument('--connections', '-c', type = int, default = 2, help = 'number of concurrent connections (default 2)')
+    parser.add_argument('--duration', '-d', type = float, default = 10, help = 'seconds to run the benchmark for (default 10)')
+    parser.add_argument('--requests', '-n', type = int, default = sys.maxsize, help = 'max number of requests per connection (default unlimited)')
+    parser.add_argument('--sizes', '-s', type = str, default = '64', help = 'message sizes in bytes with optional weights, e.g. 64:0.9,4096:0.1 (default 64)')
+    parser.add_argument('--in-process', action = 'store_true', help = 'starts the server in-process on an ephemeral port instead of connecting to --host/--port')
+    parser.add_argument('--mode', '-m', type = str, default = 'threads', choices = ['threads', 'selectors', 'asyncio'], help = 'serving mode of the in-process server (default threads)')
+    parser.add_argument('--json', action = 'store_true', help = 'writes the report as JSON')
+
+    args = parser.parse_args()
+
+    address = (args.host, args.port)
+    in_process_server = None
+
+    if args.in_process:
+        log.setup(level = 'warning')
+        in_process_server, address = start_in_process(args.mode, args.connections)
+
+    sizes, weights = parse_size_distribution(args.sizes)
+    stats, elapsed = run_benchmark(address, args.connections, sizes, weights, args.duration, args.requests)
+
+    if in_process_server:
+        in_process_server.stop()
+
+    report = build_report(stats, elapsed)
+
+    if args.json:
+        print(json.dumps(report))
+    else:
+        print_report(report)
@@ -1,8 +1,10 @@
 #!/usr/bin/env python3
 
 import argparse
+import queue
 import socket
 import sys
+import threading
 
 
 class Client:
@@ -11,18 +13,27 @@ class Client:
     to the remote server, sends the message from standard input and writes
     the received reply on the standard output.
 
+    Since the server echoes every message, the reply of a message is framed
+    by its own length: the client knows exactly how many bytes it must read
+    back for each message, no matter how TCP splits them.
+
     Args:
-        payload_size (int): Max size of an incoming message. Defaults to 1024.
+        payload_size (int): Max size read from the socket at once. Defaults to 1024.
+        window (int): Max number of messages sent without having their replies received. Defaults to 1.
     '''
 
-    def __init__(self, payload_size = 1024):
+    def __init__(self, payload_size = 1024, window = 1):
         self.payload_size = payload_size
+        self.window = window
 
     def connect_on_server(self, address, port, input_file = sys.stdin, output_file = sys.stdout):
         '''
         Connects to the remote server, sends the messages from STDIN to there
         and writes the replies on STDOUT.
 
+        Up to "window" messages are kept in flight, so the throughput is not
+        bound by the round-trip time when replaying large inputs.
+
         Args:
             address (str): remote server address.
             port (int): remote server port.
@@ -37,21 +48,84 @@ class Client:
                 print(f'an exception occurred while connecting on remote server: Exception = {e}', file = sys.stderr)
                 return
 
+            in_flight = threading.Semaphore(self.window)
+            pending = queue.Queue()
+            stopped = threading.Event() # set by the receiver before its last release of the window
+
+            receiver = threading.Thread(target = self.receive_replies, args = (ss, pending, in_flight, stopped, output_file))
+            receiver.start()
+
+            try:
+                for sent_message in input_file:
+                    payload = sent_message.encode()
+                    if not payload:
+                        continue
+
+                    in_flight.acquire()
 
-            for sent_message in input_file:
-                ss.sendall(sent_message.encode())
+                    if stopped.is_set():
+                        break
 
-                received_message = ss.recv(self.payload_size)
-                print(str(received_message, encoding = 'utf-8'), end = '', file = output_file)
+                    pending.put(len(payload))
+                    ss.sendall(payload)
+
+            except Exception as e:
+                print(f'an exception occurred while sending messages to remote server: Exception = {e}', file = sys.stderr)
+
+            finally:
+                pending.put(None)
+                receiver.join()
 
         print(f'closing connection with {address}:{port}...')
 
+    def receive_replies(self, ss, pending, in_flight, stopped, output_file):
+        '''
+        Reads the replies of the messages in flight, in the same order they
+        were sent, and writes them on STDOUT.
+
+        Args:
+            ss (obj): Socket connected to the remote server.
+            pending (obj): Queue with the size of every message sent, None marks the end of the input.
+            in_flight (obj): Semaphore released for every received reply.
+            stopped (obj): Event set once the receiver gives up or has received every reply.
+            output_file (obj): File where the replies are written to.
+        '''
+
+        received = bytearray()
+
+        try:
+            while True:
+                size = pending.get()
+                if size is None:
+                    return
+
+                while len(received) < size:
+                    data = ss.recv(max(self.payload_size, size - len(received)))
+                    if not data:
+                        print('remote server has closed the connection before replying every message', file = sys.stderr)
+                        return
+
+                    received += data
+
+                print(str(received[:size], encoding = 'utf-8'), end = '', file = output_file)
+                del received[:size]
+
+                in_flight.release()
+
+        except Exception as e:
+            print(f'an exception occurred while receiving replies from remote server: Exception = {e}', file = sys.stderr)
+
+        finally:
+            stopped.set() # before the release, so the sender it unblocks knows it must stop
+            in_flight.release()
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description = 'reads messages from STDIN, sends them to remote server and writes the reply on STDOUT')
 
     parser.add_argument('--host', '-H', type = str, default = 'localhost', help = 'remote server\'s address (default localhost)')
     parser.add_argument('--port', '-p', type = int, default = 8080, help = 'remote server\'s port (default 8080)')
+    parser.add_argument('--window', '-W', type = int, default = 1, help = 'max number of messages in flight (default 1)')
 
     args = parser.parse_args()
 
-    Client().connect_on_server(args.host, args.port)
\ No newline at end of file
+    Client(window = args.window).connect_on_server(args.host, args.port)
@@ -1,13 +1,91 @@
 #!/usr/bin/env python3
 
 import argparse
+import asyncio
+import logging
+import os
+import queue
+import select
+import selectors
 import signal
 import socket
-import sys
 import threading
+import time
 
+import log
+import metrics
 
-class Server:
+
+logger = log.get_logger(__name__)
+
+
+class BaseServer:
+    '''
+    BaseServer holds what the threaded and the asyncio servers share: the
+    limits of the admission control and the metrics served over HTTP.
+
+    Args:
+        payload_size (int): Max size of an incoming message. Defaults to 1024.
+    '''
+
+    def __init__(self, payload_size = 1024):
+        self.payload_size = payload_size
+
+        self.metrics = metrics.Registry()
+        self.stats_port = 0
+        self.stats_server = None
+
+        self.max_connections = 0
+        self.max_pending = 0
+        self.idle_timeout = None
+        self.io_timeout = None
+
+    def limit_connections(self, max_connections = 0, max_pending = 64, idle_timeout = None, io_timeout = None):
+        '''
+        Sets the admission control of the server. Connections which can not
+        be admitted are closed right away instead of waiting on the kernel
+        backlog, and peers which stall are dropped so they can not hold a
+        worker forever.
+
+        Args:
+            max_connections (int): Max number of connections being served or waiting for a worker, 0 means no limit. Defaults to 0.
+            max_pending (int): Max number of accepted connections waiting for a free worker, 0 means no limit. Defaults to 64.
+            idle_timeout (float): Max seconds a peer may take to send its next message, None means no limit. Defaults to None.
+            io_timeout (float): Max seconds a single read or write of a request may block, None means no limit. Peers exceeding it are reported as slow clients. Defaults to None.
+        '''
+
+        self.max_connections = max_connections
+        self.max_pending = max_pending
+        self.idle_timeout = idle_timeout
+        self.io_timeout = io_timeout
+
+    def expose_metrics(self, port):
+        '''
+        Exposes the metrics of the server over HTTP on a separate port once it
+        is started: "/" replies with plain text and "/json" with JSON.
+
+        Args:
+            port (int): Port number where the metrics are served, 0 disables it.
+        '''
+
+        self.stats_port = port
+
+    def start_stats_server(self, host):
+        if not self.stats_port:
+            return
+
+        logger.info('serving metrics at %s:%s...', host, self.stats_port)
+
+        self.stats_server = metrics.StatsServer(self.metrics)
+        self.stats_server.start(host, self.stats_port)
+
+    def stop_stats_server(self):
+        if self.stats_server:
+            self.stats_server.stop()
+            self.stats_server = None
+
+
+class Server(BaseServer):
     '''
     Server is the passive side of client-server architecture model. It binds
     to one or more local interface and listens for incoming connection on some
@@ -15,19 +93,34 @@ class Server:
 
     For learning purporses, all incoming messages are echoed to its related peer.
 
+    Every connection reads into its own preallocated buffer, so echoing a
+    message neither allocates nor copies it. On Linux, the payload can even be
+    moved from the receive queue to the send queue by the kernel (splice),
+    without ever reaching the user space.
+
     Args:
         threads (int): Max number of peers which are able to send and receive messages simultaneosly. Defaults to 2.
-        payload_size (int): Max size of an incoming message. Defaults to 1024.
+        payload_size (int): Size of the per-connection receive buffer, i.e. the max size of an incoming message. Defaults to 1024.
+        splice (bool): Echoes the payload through a kernel pipe (os.splice) when available. Defaults to False.
     '''
 
-    def __init__(self, threads = 2, payload_size = 1024):
-        self.payload_size = payload_size
+    def __init__(self, threads = 2, payload_size = 1024, splice = False):
+        super().__init__(payload_size)
+
         self.threads = threads
+        self.max_pending = 64
+        self.splice = splice and hasattr(os, 'splice')
 
         self.lock = threading.Lock()
         self.socket = None
         self.stopped = True
 
+        self.metrics.gauge('workers', lambda: self.threads)
+
+        self.pending = None
+        self.admitted = 0
+        self.metrics.gauge('connections_pending', lambda: self.pending.qsize() if self.pending else 0)
+
     def start(self, host, port):
         '''
         Starts the server.
@@ -38,54 +131,166 @@ class Server:
         '''
 
         address = (host, port)
-        print(f'starting the server at {address[0]}:{address[1]}...')
+        logger.info('starting the server at %s:%s...', address[0], address[1])
+
+        self.start_stats_server(host)
 
         with socket.create_server(address, reuse_port = True) as ss:
             with self.lock:
                 self.socket = ss
                 self.stopped = False
+                self.pending = queue.Queue(self.max_pending)
 
             threads = []
             for tid in range(self.threads):
-                t = threading.Thread(target=self.listen_connections, args=(tid, ss))
+                t = threading.Thread(target=self.listen_connections, args=(tid, self.pending))
                 threads.append(t)
                 t.start()
 
+            self.accept_connections(ss)
+
+            for t in threads:
+                self.pending.put(None)
+
             for t in threads:
                 t.join()
 
         with self.lock:
             self.socket = None
 
+        self.stop_stats_server()
+
     def stop(self):
         '''
-        Stops the server.
+        Stops the server. It takes no lock, since it is usually called by a
+        signal handler on the thread accepting the connections, which may
+        hold the lock while admitting one.
+        '''
+
+        logger.info('server has received a signal to stop...')
+        self.stopped = True
+
+        ss = self.socket
+        if ss:
+            try:
+                ss.shutdown(socket.SHUT_RDWR) # wakes up the thread blocked on accept, the socket is closed once it returns
+            except OSError:
+                pass
+
+    def accept_connections(self, ss):
+        '''
+        Accepts new connections of remote peers and hands them over to the
+        workers. When the server is full, the connection is rejected right away.
+
+        Args:
+            ss (obj): Listening socket object.
+        '''
+
+        while True:
+            try:
+                peer_connection, peer_address = ss.accept()
+
+            except Exception as e:
+                with self.lock:
+                    if self.stopped: # the listening socket has been shut down
+                        return
+
+                self.metrics.increment('errors_total')
+                logger.error('an exception occurred while listening for connections: Exception = %s', e)
+                return
+
+            if not self.admit_connection(peer_connection, peer_address):
+                self.metrics.increment('connections_rejected_total')
+                logger.warning('server is full, rejecting the connection from %s:%s', peer_address[0], peer_address[1])
+                peer_connection.close()
+
+    def admit_connection(self, peer_conn, peer_address):
+        '''
+        Queues a connection for the workers, unless the server has reached
+        its max number of connections or its queue is full.
+
+        Returns:
+            bool: Whether the connection has been admitted.
         '''
 
-        print('server has received a signal to stop...')
         with self.lock:
-            if self.socket:
-                self.socket.close()
-                self.stopped = True
+            if self.max_connections and self.admitted >= self.max_connections:
+                return False
 
-    def listen_connections(self, worker_id, socket):
+            try:
+                self.pending.put_nowait((peer_conn, peer_address, time.perf_counter_ns()))
+            except queue.Full:
+                return False
+
+            self.admitted += 1
+
+        return True
+
+    def listen_connections(self, worker_id, pending):
         '''
-        Accepts new connections of remote peers.
+        Serves the connections admitted by the server, one at a time.
 
         Args:
             worker_id (int): Identifier of the worker (thread).
-            socket (obj): Inherited socket object.
+            pending (obj): Queue of admitted connections, None stops the worker.
         '''
 
         while True:
+            item = pending.get()
+            if item is None:
+                return
+
+            peer_connection, peer_address, accepted_at = item
+            self.metrics.observe('queue_wait_us', (time.perf_counter_ns() - accepted_at) // 1000)
+
             try:
-                peer_connection, peer_address = socket.accept()
                 with peer_connection:
-                    self.handle_connection(worker_id, peer_connection, peer_address)
+                    with self.lock:
+                        if self.stopped:
+                            continue
+
+                    peer_connection.settimeout(self.idle_timeout)
+                    self.serve_connection(worker_id, peer_connection, peer_address)
+
+            except socket.timeout:
+                self.metrics.increment('timeouts_total')
+                logger.warning('worker #%s: connection from %s:%s has timed out', worker_id, peer_address[0], peer_address[1])
 
             except Exception as e:
-                print(f'worker #{worker_id}: an exception occurred while listening for connections: Exception = {e}', file = sys.stderr)
-                return
+                self.metrics.increment('errors_total')
+                logger.warning('worker #%s: an exception occurred while handling a connection from peer %s:%s: Exception = %s', worker_id, peer_address[0], peer_address[1], e)
+
+            finally:
+                with self.lock:
+                    self.admitted -= 1
+
+    def serve_connection(self, worker_id, peer_conn, peer_address):
+        '''
+        Runs the connection handler, keeping track of the active connections,
+        the busy workers and the bytes exchanged with the peer.
+
+        Args:
+            worker_id (int): Identifier of the worker (thread).
+            peer_conn (obj): Inherited socket object.
+            peer_address (tuple): A tuple with the address and port from the remote peer.
+        '''
+
+        self.metrics.increment('connections_accepted_total')
+        self.metrics.increment('connections_active')
+        self.metrics.increment('workers_busy')
+
+        started_at = time.perf_counter_ns()
+
+        try:
+            self.handle_connection(worker_id, metrics.MeteredSocket(peer_conn, self.metrics), peer_address)
+
+        finally:
+            elapsed = (time.perf_counter_ns() - started_at) // 1000
+
+            self.metrics.increment('connections_active', -1)
+            self.metrics.increment('workers_busy', -1)
+            self.metrics.increment(f'worker_{worker_id}_busy_us_total', elapsed)
+            self.metrics.observe('connection_duration_us', elapsed)
 
     def handle_connection(self, worker_id, peer_conn, peer_address):
         '''
@@ -99,8 +304,13 @@ class Server:
         '''
 
         peer_id = f'{peer_address[0]}:{peer_address[1]}'
-        print(f'worker #{worker_id}: handling connection from peer {peer_id}...')
+        logger.debug('worker #%s: handling connection from peer %s...', worker_id, peer_id)
+
+        if self.splice:
+            self.splice_connection(worker_id, peer_conn, peer_id)
+            return
 
+        buffer = memoryview(bytearray(self.payload_size))
         messages_count = 0
 
         while True:
@@ -108,31 +318,764 @@ class Server:
                 if self.stopped:
                     return
 
+            started_at = None
+
             try:
                 messages_count += 1
 
-                data = peer_conn.recv(self.payload_size)
-                if not data:
-                    print(f'  > worker #{worker_id}: message #{messages_count}: no content received, closing the connection with {peer_id}...')
+                peer_conn.settimeout(self.idle_timeout)
+
+                received = peer_conn.recv_into(buffer)
+                if not received:
+                    logger.debug('  > worker #%s: message #%s: no content received, closing the connection with %s...', worker_id, messages_count, peer_id)
                     return
 
-                print(f'  > worker #{worker_id}: message #{messages_count}: echoing {data} to {peer_id}')
-                peer_conn.sendall(data)
+                started_at = time.perf_counter_ns()
+
+                peer_conn.settimeout(self.io_timeout)
+                peer_conn.sendall(self.handle_message(worker_id, peer_id, messages_count, buffer[:received]))
+
+                self.metrics.increment('requests_total')
+                self.metrics.observe('request_latency_us', (time.perf_counter_ns() - started_at) // 1000)
+
+            except socket.timeout:
+                self.report_timeout(worker_id, peer_id, started_at)
+                return
 
             except Exception as e:
-                print(f'worker #{worker_id}: an exception occurred while handling a connection from peer {peer_id}: Exception = {e}', file = sys.stderr)
+                self.metrics.increment('errors_total')
+                logger.warning('worker #%s: an exception occurred while handling a connection from peer %s: Exception = %s', worker_id, peer_id, e)
+                return
+
+    def splice_connection(self, worker_id, peer_conn, peer_id):
+        '''
+        Echoes the payload of a remote peer through a pipe, so the kernel moves
+        it from the receive queue to the send queue without copying it to the
+        user space. The messages are not seen by handle_message.
+
+        Args:
+            worker_id (int): Identifier of the worker (thread).
+            peer_conn (obj): Inherited socket object.
+            peer_id (str): Address and port from the remote peer.
+        '''
+
+        read_fd, write_fd = os.pipe()
+        messages_count = 0
+
+        peer_conn.settimeout(None) # splice needs a blocking file descriptor
+
+        try:
+            while True:
+                with self.lock:
+                    if self.stopped:
+                        return
+
+                try:
+                    messages_count += 1
+
+                    readable, _, _ = select.select([peer_conn], [], [], self.idle_timeout)
+                    if not readable:
+                        self.report_timeout(worker_id, peer_id)
+                        return
+
+                    received = os.splice(peer_conn.fileno(), write_fd, self.payload_size)
+                    if not received:
+                        logger.debug('  > worker #%s: message #%s: no content received, closing the connection with %s...', worker_id, messages_count, peer_id)
+                        return
+
+                    started_at = time.perf_counter_ns()
+
+                    pending = received
+                    while pending:
+                        pending -= os.splice(read_fd, peer_conn.fileno(), pending)
+
+                    self.metrics.increment('requests_total')
+                    self.metrics.increment('bytes_received_total', received)
+                    self.metrics.increment('bytes_sent_total', received)
+                    self.metrics.observe('request_latency_us', (time.perf_counter_ns() - started_at) // 1000)
+
+                except Exception as e:
+                    self.metrics.increment('errors_total')
+                    logger.warning('worker #%s: an exception occurred while handling a connection from peer %s: Exception = %s', worker_id, peer_id, e)
+                    return
+
+        finally:
+            os.close(read_fd)
+            os.close(write_fd)
+
+    def report_timeout(self, worker_id, peer_id, started_at = None):
+        '''
+        Reports a peer which has been dropped for stalling: either it sent
+        nothing for too long (idle) or it did not take its reply (slow client).
+
+        Args:
+            worker_id (int): Identifier of the worker (thread).
+            peer_id (str): Address and port from the remote peer.
+            started_at (int): When the stalled request has started (perf_counter_ns), None if the peer was idle.
+        '''
+
+        if started_at is None:
+            self.metrics.increment('idle_timeouts_total')
+            logger.debug('worker #%s: peer %s has been idle for too long, closing the connection...', worker_id, peer_id)
+        else:
+            self.metrics.increment('slow_clients_total')
+            logger.warning('worker #%s: peer %s is too slow to receive its reply, closing the connection...', worker_id, peer_id)
+
+    def handle_message(self, worker_id, peer_id, messages_count, data):
+        '''
+        Builds the reply for a message received from a remote peer. For
+        learning purporses, the reply is the message itself.
+
+        Args:
+            worker_id (int): Identifier of the worker (thread).
+            peer_id (str): Address and port from the remote peer.
+            messages_count (int): Sequence number of the message on the connection.
+            data (memoryview): The received message, a view on the connection's buffer which is only valid until the next read.
+
+        Returns:
+            bytes: The content which should be sent back to the peer.
+        '''
+
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug('  > worker #%s: message #%s: echoing %s to %s', worker_id, messages_count, bytes(data), peer_id)
+
+        return data
+
+
+class Connection:
+    '''
+    Connection keeps the state of a remote peer served by the event loop.
+
+    Args:
+        peer_conn (obj): Non-blocking socket object.
+        peer_address (tuple): A tuple with the address and port from the remote peer.
+        buffer_size (int): Size of the preallocated receive buffer. Defaults to 1024.
+    '''
+
+    def __init__(self, peer_conn, peer_address, buffer_size = 1024):
+        self.socket = peer_conn
+        self.peer_id = f'{peer_address[0]}:{peer_address[1]}'
+        self.messages_count = 0
+        self.last_activity = time.monotonic()
+
+        self.inbound = memoryview(bytearray(buffer_size))
+        self.outbound = bytearray()
+
+
+class SelectorServer(Server):
+    '''
+    SelectorServer serves every peer from a single event loop built on top
+    of the selectors module (epoll on Linux), instead of pinning one thread
+    per connection. Idle peers cost only a file descriptor and a few bytes of
+    buffer, so a single process can hold thousands of connected clients.
+
+    Args:
+        payload_size (int): Max size read from a peer at once. Defaults to 1024.
+        backlog (int): Max number of pending connections on the kernel queue. Defaults to 1024.
+        max_outbound (int): Max number of bytes buffered to a peer before the server stops reading from it. Defaults to 65536.
+    '''
+
+    def __init__(self, payload_size = 1024, backlog = 1024, max_outbound = 65536):
+        super().__init__(threads = 1, payload_size = payload_size)
+
+        self.backlog = backlog
+        self.max_outbound = max_outbound
+        self.selector = None
+        self.waker = None
+
+    def start(self, host, port):
+        '''
+        Starts the server.
+
+        Args:
+            host (str): Interfaces address where the server should listen on.
+            port (int): Port number where the server should listen on.
+        '''
+
+        address = (host, port)
+        logger.info('starting the server at %s:%s (event loop)...', address[0], address[1])
+
+        self.start_stats_server(host)
+
+        with socket.create_server(address, reuse_port = True, backlog = self.backlog) as ss:
+            ss.setblocking(False)
+
+            reader, writer = socket.socketpair()
+            reader.setblocking(False)
+
+            with self.lock:
+                self.socket = ss
+                self.waker = writer
+                self.selector = selectors.DefaultSelector()
+                self.stopped = False
+
+            self.selector.register(ss, selectors.EVENT_READ)
+            self.selector.register(reader, selectors.EVENT_READ)
+
+            try:
+                self.run_event_loop(ss, reader)
+            finally:
+                for key in list(self.selector.get_map().values()):
+                    if isinstance(key.data, Connection):
+                        key.data.socket.close()
+
+                self.selector.close()
+                reader.close()
+                writer.close()
+
+        with self.lock:
+            self.socket = None
+            self.waker = None
+            self.selector = None
+
+        self.stop_stats_server()
+
+    def stop(self):
+        '''
+        Stops the server. The event loop closes the connections once it wakes
+        up. It takes no lock, since it is usually called by a signal handler
+        on the thread running the loop.
+        '''
+
+        logger.info('server has received a signal to stop...')
+        self.stopped = True
+
+        waker = self.waker
+        if not waker:
+            return
+
+        try:
+            waker.send(b'\0')
+        except OSError: # the loop has already returned and closed it
+            pass
+
+    def run_event_loop(self, ss, waker):
+        '''
+        Waits for readiness events and dispatches them until the server is stopped.
+
+        Args:
+            ss (obj): Listening socket object.
+            waker (obj): Socket which becomes readable when the server is stopped.
+        '''
+
+        swept_at = time.monotonic()
+
+        while not self.stopped:
+            if self.idle_timeout or self.io_timeout:
+                if time.monotonic() - swept_at >= 1:
+                    self.close_stalled_connections()
+                    swept_at = time.monotonic()
+
+                timeout = 1
+            else:
+                timeout = None
+
+            for key, events in self.selector.select(timeout):
+                if key.fileobj is waker:
+                    return
+
+                if key.fileobj is ss:
+                    self.accept_connections(ss)
+                    continue
+
+                connection = key.data
+
+                try:
+                    if events & selectors.EVENT_READ:
+                        self.read_from_peer(connection)
+
+                    if events & selectors.EVENT_WRITE and connection.socket.fileno() != -1:
+                        self.write_to_peer(connection)
+
+                except Exception as e:
+                    self.metrics.increment('errors_total')
+                    logger.warning('event loop: an exception occurred while handling a connection from peer %s: Exception = %s', connection.peer_id, e)
+                    self.close_connection(connection)
+
+    def accept_connections(self, ss):
+        '''
+        Accepts every pending connection on the listening socket.
+
+        Args:
+            ss (obj): Listening socket object.
+        '''
+
+        while True:
+            try:
+                peer_conn, peer_address = ss.accept()
+            except BlockingIOError:
                 return
 
+            active = len(self.selector.get_map()) - 2 # the listening socket and the waker
+            if self.max_connections and active >= self.max_connections:
+                self.metrics.increment('connections_rejected_total')
+                logger.warning('server is full, rejecting the connection from %s:%s', peer_address[0], peer_address[1])
+                peer_conn.close()
+                continue
+
+            peer_conn.setblocking(False)
+
+            connection = Connection(peer_conn, peer_address, self.payload_size)
+
+            self.metrics.increment('connections_accepted_total')
+            self.metrics.increment('connections_active')
+
+            logger.debug('event loop: handling connection from peer %s...', connection.peer_id)
+
+            self.selector.register(peer_conn, selectors.EVENT_READ, connection)
+
+    def read_from_peer(self, connection):
+        '''
+        Reads the available data from a peer into its receive buffer and
+        sends the reply straight from there. Only the part the socket does not
+        take right away is copied to the outbound buffer.
+
+        Args:
+            connection (obj): The peer's Connection.
+        '''
+
+        try:
+            received = connection.socket.recv_into(connection.inbound)
+        except BlockingIOError:
+            return
+
+        connection.messages_count += 1
+        connection.last_activity = time.monotonic()
+
+        if not received:
+            logger.debug('  > event loop: message #%s: no content received, closing the connection with %s...', connection.messages_count, connection.peer_id)
+            self.close_connection(connection)
+            return
+
+        self.metrics.increment('bytes_received_total', received)
+        self.metrics.increment('requests_total')
+
+        reply = memoryview(self.handle_message(0, connection.peer_id, connection.messages_count, connection.inbound[:received]))
+
+        sent = 0
+        if not connection.outbound:
+            try:
+                sent = connection.socket.send(reply)
+            except BlockingIOError:
+                pass
+
+            self.metrics.increment('bytes_sent_total', sent)
+
+        connection.outbound += reply[sent:]
+
+        self.update_interest(connection)
+
+    def write_to_peer(self, connection):
+        '''
+        Flushes as much as possible of the peer's outbound buffer.
+
+        Args:
+            connection (obj): The peer's Connection.
+        '''
+
+        try:
+            sent = connection.socket.send(connection.outbound)
+        except BlockingIOError:
+            return
+
+        self.metrics.increment('bytes_sent_total', sent)
+        connection.last_activity = time.monotonic()
+
+        del connection.outbound[:sent] # cheap, bytearray only moves its start forward
+        self.update_interest(connection)
+
+    def update_interest(self, connection):
+        '''
+        Watches a peer for writability while there is pending output and stops
+        reading from it while its outbound buffer is full.
+
+        Args:
+            connection (obj): The peer's Connection.
+        '''
+
+        events = 0
+
+        if len(connection.outbound) < self.max_outbound:
+            events |= selectors.EVENT_READ
+
+        if connection.outbound:
+            events |= selectors.EVENT_WRITE
+
+        self.selector.modify(connection.socket, events, connection)
+
+    def close_stalled_connections(self):
+        '''
+        Closes the peers which have not sent anything for longer than the idle
+        timeout, and those which have not taken their pending output for
+        longer than the I/O timeout.
+        '''
+
+        now = time.monotonic()
+
+        for key in list(self.selector.get_map().values()):
+            connection = key.data
+            if not isinstance(connection, Connection):
+                continue
+
+            stalled_for = now - connection.last_activity
+
+            if connection.outbound:
+                if self.io_timeout and stalled_for > self.io_timeout:
+                    self.metrics.increment('slow_clients_total')
+                    logger.warning('event loop: peer %s is too slow to receive its reply, closing the connection...', connection.peer_id)
+                    self.close_connection(connection)
+
+            elif self.idle_timeout and stalled_for > self.idle_timeout:
+                self.metrics.increment('idle_timeouts_total')
+                logger.debug('event loop: peer %s has been idle for too long, closing the connection...', connection.peer_id)
+                self.close_connection(connection)
+
+    def close_connection(self, connection):
+        '''
+        Unregisters and closes a peer's socket.
+
+        Args:
+            connection (obj): The peer's Connection.
+        '''
+
+        if connection.socket.fileno() == -1:
+            return
+
+        self.selector.unregister(connection.socket)
+        connection.socket.close()
+
+        self.metrics.increment('connections_active', -1)
+
+class AsyncServer(BaseServer):
+    '''
+    AsyncServer is the asyncio-native counterpart of Server. Every peer is
+    served by a coroutine on a single event loop, so waiting for the network
+    does not hold a thread.
+
+    For learning purporses, all incoming messages are echoed to its related peer.
+
+    Args:
+        payload_size (int): Max size of an incoming message. Defaults to 1024.
+    '''
+
+    def __init__(self, payload_size = 1024):
+        super().__init__(payload_size)
+
+        self.loop = None
+        self.server = None
+        self.tasks = set()
+
+    def start(self, host, port):
+        '''
+        Starts the server.
+
+        Args:
+            host (str): Interfaces address where the server should listen on.
+            port (int): Port number where the server should listen on.
+        '''
+
+        logger.info('starting the server at %s:%s (asyncio)...', host, port)
+
+        self.start_stats_server(host)
+
+        try:
+            asyncio.run(self.serve(host, port))
+        finally:
+            self.stop_stats_server()
+
+    async def serve(self, host, port):
+        '''
+        Listens for incoming connections until the server is stopped.
+
+        Args:
+            host (str): Interfaces address where the server should listen on.
+            port (int): Port number where the server should listen on.
+        '''
+
+        self.loop = asyncio.get_running_loop()
+        self.server = await asyncio.start_server(self.accept_connection, host, port, reuse_port = True)
+
+        try:
+            async with self.server:
+                await self.server.serve_forever()
+
+        except asyncio.CancelledError:
+            pass
+
+        finally:
+            for task in list(self.tasks):
+                task.cancel()
+
+            await asyncio.gather(*self.tasks, return_exceptions = True)
+
+            self.server = None
+            self.loop = None
+
+    def stop(self):
+        '''
+        Stops the server.
+        '''
+
+        logger.info('server has received a signal to stop...')
+        if self.loop and self.server:
+            self.loop.call_soon_threadsafe(self.server.close)
+
+    async def accept_connection(self, reader, writer):
+        '''
+        Runs the connection handler of a new peer and releases its resources
+        once it has finished.
+
+        Args:
+            reader (obj): Stream where the peer's messages are read from.
+            writer (obj): Stream where the replies are written to.
+        '''
+
+        peer_address = writer.get_extra_info('peername')
+
+        if self.max_connections and len(self.tasks) >= self.max_connections:
+            self.metrics.increment('connections_rejected_total')
+            logger.warning('server is full, rejecting the connection from %s:%s', peer_address[0], peer_address[1])
+            writer.close()
+            return
+
+        task = asyncio.current_task()
+        self.tasks.add(task)
+
+        self.metrics.increment('connections_accepted_total')
+        self.metrics.increment('connections_active')
+
+        started_at = time.perf_counter_ns()
+
+        try:
+            await self.handle_connection(reader, writer, peer_address)
+
+        except asyncio.CancelledError:
+            pass
+
+        except Exception as e:
+            self.metrics.increment('errors_total')
+            logger.warning('an exception occurred while handling a connection from peer %s:%s: Exception = %s', peer_address[0], peer_address[1], e)
+
+        finally:
+            self.tasks.discard(task)
+            writer.close()
+
+            self.metrics.increment('connections_active', -1)
+            self.metrics.observe('connection_duration_us', (time.perf_counter_ns() - started_at) // 1000)
+
+    async def handle_connection(self, reader, writer, peer_address):
+        '''
+        Handles the connection from a remote peer, extracts the payload and
+        replies with the content built by the request handler.
+
+        Args:
+            reader (obj): Stream where the peer's messages are read from.
+            writer (obj): Stream where the replies are written to.
+            peer_address (tuple): A tuple with the address and port from the remote peer.
+        '''
+
+        peer_id = f'{peer_address[0]}:{peer_address[1]}'
+        logger.debug('handling connection from peer %s...', peer_id)
+
+        messages_count = 0
+
+        while True:
+            messages_count += 1
+
+            try:
+                data = await asyncio.wait_for(reader.read(self.payload_size), self.idle_timeout)
+            except asyncio.TimeoutError:
+                self.metrics.increment('idle_timeouts_total')
+                logger.debug('peer %s has been idle for too long, closing the connection...', peer_id)
+                return
+
+            if not data:
+                logger.debug('  > message #%s: no content received, closing the connection with %s...', messages_count, peer_id)
+                return
+
+            started_at = time.perf_counter_ns()
+
+            reply = await self.request_handler(peer_id, messages_count, data)
+            writer.write(reply)
+
+            try:
+                await asyncio.wait_for(writer.drain(), self.io_timeout)
+            except asyncio.TimeoutError:
+                self.metrics.increment('slow_clients_total')
+                logger.warning('peer %s is too slow to receive its reply, closing the connection...', peer_id)
+                return
+
+            self.metrics.increment('requests_total')
+            self.metrics.increment('bytes_received_total', len(data))
+            self.metrics.increment('bytes_sent_total', len(reply))
+            self.metrics.observe('request_latency_us', (time.perf_counter_ns() - started_at) // 1000)
+
+    async def request_handler(self, peer_id, messages_count, data):
+        '''
+        Builds the reply for a message received from a remote peer.
+
+        Args:
+            peer_id (str): Address and port from the remote peer.
+            messages_count (int): Sequence number of the message on the connection.
+            data (bytes): The received message.
+
+        Returns:
+            bytes: The content which should be sent back to the peer.
+        '''
+
+        logger.debug('  > message #%s: echoing %s to %s', messages_count, data, peer_id)
+        return data
+
+
+class Supervisor:
+    '''
+    Supervisor forks a number of worker processes, each one running its own
+    accept loop of the same server. Since the listening sockets are created
+    with SO_REUSEPORT, every worker binds to the same port and the kernel
+    balances the incoming connections among them, so the server is no longer
+    bound to a single core.
+
+    Crashed workers are restarted and the stop signal is forwarded to all of
+    them.
+
+    Args:
+        server (obj): Server which is run by every worker.
+        workers (int): Number of worker processes. Defaults to 2.
+        restart_delay (float): Seconds to wait before restarting a crashed worker. Defaults to 1.
+    '''
+
+    def __init__(self, server, workers = 2, restart_delay = 1.0):
+        self.server = server
+        self.workers = workers
+        self.restart_delay = restart_delay
+
+        self.pid = os.getpid()
+        self.children = {}
+        self.stopped = True
+
+    def start(self, host, port):
+        '''
+        Starts the workers and supervises them until the server is stopped.
+
+        Args:
+            host (str): Interfaces address where the server should listen on.
+            port (int): Port number where the server should listen on.
+        '''
+
+        logger.info('starting %s workers at %s:%s...', self.workers, host, port)
+        self.stopped = False
+
+        for worker_id in range(self.workers):
+            self.spawn(worker_id, host, port)
+
+        while self.children:
+            try:
+                pid, status = os.wait()
+            except ChildProcessError:
+                break
+
+            worker_id = self.children.pop(pid, None)
+            if worker_id is None:
+                continue
+
+            exit_code = os.waitstatus_to_exitcode(status)
+            if self.stopped or exit_code == 0:
+                logger.info('worker #%s (pid %s) has exited', worker_id, pid)
+                continue
+
+            logger.error('worker #%s (pid %s) has crashed with exit code %s, restarting it...', worker_id, pid, exit_code)
+            time.sleep(self.restart_delay)
+
+            if not self.stopped:
+                self.spawn(worker_id, host, port)
+
+    def stop(self):
+        '''
+        Stops the server, forwarding the signal to every worker.
+        '''
+
+        if os.getpid() != self.pid:
+            return
+
+        logger.info('supervisor has received a signal to stop...')
+        self.stopped = True
+
+        for pid in list(self.children):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    def spawn(self, worker_id, host, port):
+        '''
+        Forks a new worker process which runs the server.
+
+        Args:
+            worker_id (int): Identifier of the worker (process).
+            host (str): Interfaces address where the server should listen on.
+            port (int): Port number where the server should listen on.
+        '''
+
+        pid = os.fork()
+        if pid > 0:
+            self.children[pid] = worker_id
+            return
+
+        for ss in [signal.SIGINT, signal.SIGTERM]:
+            signal.signal(ss, lambda received_signal, frame: self.server.stop())
+
+        if self.server.stats_port:
+            self.server.stats_port += worker_id # every worker serves its own metrics
+
+        exit_code = 0
+
+        try:
+            self.server.start(host, port)
+
+        except Exception as e:
+            logger.error('worker #%s: an exception occurred while running the server: Exception = %s', worker_id, e)
+            exit_code = 1
+
+        finally:
+            log.shutdown()
+            os._exit(exit_code)
+
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description = 'starts server which echoes incoming messages from remote clients')
 
     parser.add_argument('--host', '-H', type = str, default = 'localhost', help = 'local address (default localhost)')
     parser.add_argument('--port', '-p', type = int, default = 8080, help = 'local port (default 8080)')
     parser.add_argument('--threads', '-t', type = int, default = 2, help = 'max number of simultaneous clients (default 2)')
+    parser.add_argument('--mode', '-m', type = str, default = 'threads', choices = ['threads', 'selectors', 'asyncio'], help = 'serving mode: one thread per client, a selectors event loop or an asyncio event loop (default threads)')
+    parser.add_argument('--buffer-size', type = int, default = 1024, help = 'size of the per-connection receive buffer (default 1024)')
+    parser.add_argument('--splice', action = 'store_true', help = 'echoes through a kernel pipe without copying the payload to the user space, Linux only (threads mode)')
+    parser.add_argument('--backlog', type = int, default = 1024, help = 'max number of pending connections on event loop mode (default 1024)')
+    parser.add_argument('--max-connections', type = int, default = 0, help = 'max number of simultaneous connections, the extra ones are rejected, 0 means no limit (default 0)')
+    parser.add_argument('--max-pending', type = int, default = 64, help = 'max number of accepted connections waiting for a free thread (default 64)')
+    parser.add_argument('--idle-timeout', type = float, default = 0, help = 'seconds after which a silent peer is disconnected, 0 disables it (default 0)')
+    parser.add_argument('--io-timeout', type = float, default = 0, help = 'seconds after which a peer not taking its reply is disconnected, 0 disables it (default 0)')
+    parser.add_argument('--log-level', type = str, default = 'info', choices = log.LEVELS, help = 'min level of the logged messages, debug traces every message (default info)')
+    parser.add_argument('--log-sample', type = float, default = 1.0, help = 'fraction of the debug and info messages which are logged (default 1)')
+    parser.add_argument('--stats-port', type = int, default = 0, help = 'port where the metrics are served over HTTP, 0 disables it (default 0)')
+    parser.add_argument('--workers', '-w', type = int, default = 0, help = 'number of worker processes sharing the port, 0 runs a single process (default 0)')
 
     args = parser.parse_args()
 
-    server = Server(threads = args.threads)
+    log.setup(level = args.log_level, sample_rate = args.log_sample)
+
+    if args.mode == 'selectors':
+        server = SelectorServer(payload_size = args.buffer_size, backlog = args.backlog)
+    elif args.mode == 'asyncio':
+        server = AsyncServer(payload_size = args.buffer_size)
+    else:
+        server = Server(threads = args.threads, payload_size = args.buffer_size, splice = args.splice)
+
+    server.expose_metrics(args.stats_port)
+    server.limit_connections(args.max_connections, args.max_pending, args.idle_timeout or None, args.io_timeout or None)
+
+    if args.workers > 0:
+        server = Supervisor(server, workers = args.workers)
 
     for ss in [signal.SIGINT, signal.SIGTERM]:
         signal.signal(ss, lambda received_signal, frame: server.stop())
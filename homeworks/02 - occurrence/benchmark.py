@@ -0,0 +1,260 @@
+#!/usr/bin/env python3
+
+import argparse
+import framing
+import itertools
+import json
+import random
+import socket
+import sys
+import threading
+import time
+
+import log
+
+from data import Data
+from metrics import Histogram
+from interface import Interface
+from processing import Processing
+
+
+class Stats:
+    '''
+    Stats accumulates the outcome of the requests issued by one connection.
+    '''
+
+    def __init__(self):
+        self.latencies = Histogram()
+        self.requests = 0
+        self.errors = 0
+        self.bytes_sent = 0
+        self.bytes_received = 0
+
+    def merge(self, other):
+        self.latencies.merge(other.latencies)
+        self.requests += other.requests
+        self.errors += other.errors
+        self.bytes_sent += other.bytes_sent
+        self.bytes_received += other.bytes_received
+
+
+def parse_file_mix(value, separator = ','):
+    '''
+    Parses a filename mix such as "lorem.txt:0.9,other.txt:0.1".
+
+    Args:
+        value (str): Filenames separated by "separator", each one optionally followed by its weight.
+        separator (str): Separator of the filenames. Defaults to a comma.
+
+    Returns:
+        tuple: The list of filenames and the list of their weights.
+    '''
+
+    filenames, weights = [], []
+
+    for item in value.split(separator):
+        filename, _, weight = item.rpartition(':') if ':' in item else (item, '', '')
+        filenames.append(filename)
+        weights.append(float(weight or 1))
+
+    return filenames, weights
+
+def request_file(ss, request_id, filename):
+    '''
+    Requests a file to the Interface (or Data) Server and reads the whole response.
+
+    Returns:
+        tuple: The number of bytes sent and received.
+    '''
+
+    message = framing.encode_frame(framing.REQUEST, request_id, filename.encode())
+    ss.sendall(message)
+
+    header = framing.recv_header(ss, max_size = None)
+    if header is None:
+        raise ConnectionError('server has closed the connection')
+
+    _, _, length = header
+
+    for _ in framing.recv_chunks(ss, length): # the payload is drained, so large files do not fill the memory
+        pass
+
+    return len(message), framing.HEADER.size + length
+
+def run_connection(address, filenames, weights, deadline, max_requests, stats):
+    '''
+    Issues requests one after another over a single connection, as a single
+    client would do, and records how long every response takes to be fully
+    received. The connection is reopened after an error.
+    '''
+
+    rng = random.Random()
+    request_ids = itertools.count(1)
+
+    ss = None
+
+    while time.monotonic() < deadline and stats.requests < max_requests:
+        filename = rng.choices(filenames, weights)[0]
+
+        try:
+            if ss is None:
+                ss = socket.create_connection(address)
+                ss.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+            started_at = time.perf_counter_ns()
+            sent, received = request_file(ss, next(request_ids), filename)
+
+            stats.latencies.record((time.perf_counter_ns() - started_at) // 1000)
+            stats.requests += 1
+            stats.bytes_sent += sent
+            stats.bytes_received += received
+
+        except Exception as e:
+            stats.errors += 1
+            print(f'an exception occurred while benchmarking: Exception = {e}', file = sys.stderr)
+
+            if ss:
+                ss.close()
+                ss = None
+
+    if ss:
+        ss.close()
+
+def run_benchmark(address, connections, filenames, weights, duration, max_requests):
+    '''
+    Runs a number of concurrent clients against the server until the
+    duration elapses (or every client issues max_requests).
+
+    Returns:
+        tuple: The merged Stats and the elapsed time in seconds.
+    '''
+
+    deadline = time.monotonic() + duration
+
+    stats = [Stats() for _ in range(connections)]
+    threads = [threading.Thread(target = run_connection, args = (address, filenames, weights, deadline, max_requests, s)) for s in stats]
+
+    started_at = time.monotonic()
+
+    for t in threads:
+        t.start()
+
+    for t in threads:
+        t.join()
+
+    elapsed = time.monotonic() - started_at
+
+    total = Stats()
+    for s in stats:
+        total.merge(s)
+
+    return total, elapsed
+
+def build_report(stats, elapsed):
+    latencies = stats.latencies
+
+    return {
+        'requests': stats.requests,
+        'errors': stats.errors,
+        'elapsed_seconds': round(elapsed, 3),
+        'requests_per_second': round(stats.requests / elapsed, 2) if elapsed else 0,
+        'bytes_per_second': round((stats.bytes_sent + stats.bytes_received) / elapsed, 2) if elapsed else 0,
+        'latency_us': {
+            'min': latencies.min or 0,
+            'mean': round(latencies.mean(), 1),
+            'p50': latencies.percentile(50),
+            'p95': latencies.percentile(95),
+            'p99': latencies.percentile(99),
+            'p99.9': latencies.percentile(99.9),
+            'max': latencies.max or 0,
+        },
+        'histogram_us': [[lower, upper, count] for lower, upper, count in latencies.buckets()],
+    }
+
+def print_report(report, output_file = sys.stdout):
+    print(f'requests:     {report["requests"]} ({report["errors"]} errors) in {report["elapsed_seconds"]}s', file = output_file)
+    print(f'throughput:   {report["requests_per_second"]} req/s, {report["bytes_per_second"]} bytes/s', file = output_file)
+
+    latency = report['latency_us']
+    print(f'latency (us): min {latency["min"]}  mean {latency["mean"]}  p50 {latency["p50"]}  p95 {latency["p95"]}  p99 {latency["p99"]}  p99.9 {latency["p99.9"]}  max {latency["max"]}', file = output_file)
+
+    histogram = report['histogram_us']
+    if not histogram:
+        return
+
+    widest = max(count for _, _, count in histogram)
+    for lower, upper, count in histogram:
+        print(f'  {lower:>9} - {upper:<9} {count:>9} {"#" * max(1, 40 * count // widest)}', file = output_file)
+
+def start_in_background(ss):
+    '''
+    Starts a server in a background thread on an ephemeral port.
+
+    Returns:
+        tuple: The address the server is listening on.
+    '''
+
+    threading.Thread(target = ss.start, args = ('localhost', 0), daemon = True).start()
+
+    while not ss.socket:
+        time.sleep(0.01)
+
+    return ss.socket.getsockname()[:2]
+
+def start_in_process(data_dir, threads):
+    '''
+    Starts the Data, Processing and Interface servers in-process, each one on
+    an ephemeral port.
+
+    Returns:
+        tuple: The running servers and the addresses of the Interface and Data servers.
+    '''
+
+    data = Data(data_dir = data_dir, threads = threads)
+    data_address = start_in_background(data)
+
+    processing = Processing(data_address = data_address[0], data_port = data_address[1], threads = threads, pool_size = threads)
+    processing_address = start_in_background(processing)
+
+    interface = Interface(processing_address = processing_address[0], processing_port = processing_address[1], threads = threads, pool_size = threads)
+    interface_address = start_in_background(interface)
+
+    return [interface, processing, data], interface_address, data_address
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = 'measures the throughput and the latency of the interface or the data server')
+
+    parser.add_argument('--host', '-H', type = str, default = 'localhost', help = 'remote server\'s address (default localhost)')
+    parser.add_argument('--port', '-p', type = int, default = 8080, help = 'remote server\'s port (default 8080)')
+    parser.add_argument('--target', type = str, default = 'interface', choices = ['interface', 'data'], help = 'which server is benchmarked when running in-process (default interface)')
+    parser.add_argument('--connections', '-c', type = int, default = 2, help = 'number of concurrent clients (default 2)')
+    parser.add_argument('--duration', '-d', type = float, default = 10, help = 'seconds to run the benchmark for (default 10)')
+    parser.add_argument('--requests', '-n', type = int, default = sys.maxsize, help = 'max number of requests per client (default unlimited)')
+    parser.add_argument('--files', '-f', type = str, default = 'lorem.txt', help = 'requested filenames with optional weights, e.g. lorem.txt:0.9,other.txt:0.1 (default lorem.txt)')
+    parser.add_argument('--in-process', action = 'store_true', help = 'starts the servers in-process on ephemeral ports instead of connecting to --host/--port')
+    parser.add_argument('--data-dir', type = str, default = './testdata', help = 'data dir of the in-process data server (default ./testdata)')
+    parser.add_argument('--json', action = 'store_true', help = 'writes the report as JSON')
+
+    args = parser.parse_args()
+
+    address = (args.host, args.port)
+    in_process_servers = []
+
+    if args.in_process:
+        log.setup(level = 'warning')
+        in_process_servers, interface_address, data_address = start_in_process(args.data_dir, args.connections)
+        address = data_address if args.target == 'data' else interface_address
+
+    filenames, weights = parse_file_mix(args.files)
+    stats, elapsed = run_benchmark(address, args.connections, filenames, weights, args.duration, args.requests)
+
+    for ss in in_process_servers:
+        ss.stop()
+
+    report = build_report(stats, elapsed)
+
+    if args.json:
+        print(json.dumps(report))
+    else:
+        print_report(report)
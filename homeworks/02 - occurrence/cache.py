@@ -0,0 +1,91 @@
+import collections
+import threading
+
+
+class ResultCache:
+    '''
+    ResultCache keeps the latest results computed for a number of files,
+    each one tagged with the version of the file it was computed from, so a
+    result is only served while the file has not changed. Once the results
+    take more than the memory budget, the least recently used are evicted.
+
+    Args:
+        max_bytes (int): Memory budget of the cached results, 0 disables the cache. Defaults to 64 MiB.
+    '''
+
+    def __init__(self, max_bytes = 64 * 1024 * 1024):
+        self.max_bytes = max_bytes
+
+        self.lock = threading.Lock()
+        self.entries = collections.OrderedDict()
+        self.bytes = 0
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key, version):
+        '''
+        Looks a result up.
+
+        Args:
+            key (obj): The request the result was computed for, such as the file name.
+            version (bytes): The current version of the file.
+
+        Returns:
+            bytes: The cached result, or None if there is none for this version.
+        '''
+
+        with self.lock:
+            entry = self.entries.get(key)
+
+            if entry is None or entry[0] != version:
+                self.misses += 1
+                return None
+
+            self.entries.move_to_end(key)
+            self.hits += 1
+
+            return entry[1]
+
+    def put(self, key, version, result):
+        '''
+        Stores a result, replacing the one of an older version.
+
+        Args:
+            key (obj): The request the result was computed for, such as the file name.
+            version (bytes): The version of the file the result was computed from.
+            result (bytes): The result.
+        '''
+
+        if len(result) > self.max_bytes:
+            return
+
+        with self.lock:
+            previous = self.entries.pop(key, None)
+            if previous is not None:
+                self.bytes -= len(previous[1])
+
+            self.entries[key] = (version, result)
+            self.bytes += len(result)
+
+            while self.bytes > self.max_bytes:
+                _, (_, evicted) = self.entries.popitem(last = False)
+                self.bytes -= len(evicted)
+                self.evictions += 1
+
+    def stats(self):
+        with self.lock:
+            return {
+                'entries': len(self.entries),
+                'bytes': self.bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+            }
+
+
+def expose_cache_metrics(registry, cache):
+    registry.gauge('cache_entries', lambda: len(cache.entries))
+    registry.gauge('cache_bytes', lambda: cache.bytes)
+    registry.gauge('cache_evictions', lambda: cache.evictions)
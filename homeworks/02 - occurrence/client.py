@@ -1,6 +1,10 @@
 #!/usr/bin/env python3
 
 import argparse
+import framing
+import itertools
+import json
+import os
 import socket
 import sys
 
@@ -9,14 +13,17 @@ class Client:
     '''
     Client is the active side of client/server architeture model. It connects
     to the remote server, sends the message from standard input and writes
-    the received reply on the standard output.
+    the received reply on the standard output. Every line is sent as a request
+    frame over the same connection.
 
     Args:
         payload_size (int): Max size of an incoming message. Defaults to 1024.
+        trace (bool): Whether the requests are sent as TRACE frames, whose span records are written on STDERR as JSON lines. Defaults to False.
     '''
 
-    def __init__(self, payload_size = 1024):
+    def __init__(self, payload_size = 1024, trace = False):
         self.payload_size = payload_size
+        self.trace = trace
 
     def connect_on_server(self, address, port, input_file = sys.stdin, output_file = sys.stdout):
         '''
@@ -38,20 +45,46 @@ class Client:
                 return
 
 
+            request_ids = itertools.count(1)
+
             for sent_message in input_file:
-                ss.sendall(sent_message.encode())
+                sent_message = sent_message.rstrip(os.linesep)
+
+                if not sent_message:
+                    continue
+
+                request_id = next(request_ids)
+                framing.send_frame(ss, framing.TRACE if self.trace else framing.REQUEST, request_id, sent_message.encode())
+
+                reply = framing.recv_frame(ss)
+                if reply is None:
+                    print('remote server has closed the connection', file = sys.stderr)
+                    break
 
-                received_message = ss.recv(self.payload_size)
-                print(str(received_message, encoding = 'utf-8'), end = '', file = output_file)
+                if reply.request_id != request_id:
+                    raise framing.ProtocolError(f'expected the reply of request #{request_id}, got #{reply.request_id}')
+
+                print(str(reply.payload, encoding = 'utf-8'), end = '' if reply.type == framing.RESPONSE else os.linesep, file = output_file)
+
+                if self.trace:
+                    self.print_trace(framing.recv_frame(ss))
 
         print(f'closing connection with {address}:{port}...')
 
+    def print_trace(self, frame):
+        if frame is None or frame.type != framing.TRACE:
+            raise framing.ProtocolError('expected the trace of the request')
+
+        for record in json.loads(frame.payload):
+            print(json.dumps(record), file = sys.stderr)
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description = 'reads messages from STDIN, sends them to remote server and writes the reply on STDOUT')
 
     parser.add_argument('--host', '-H', type = str, default = 'localhost', help = 'remote server\'s address (default localhost)')
     parser.add_argument('--port', '-p', type = int, default = 8080, help = 'remote server\'s port (default 8080)')
+    parser.add_argument('--trace', action = 'store_true', help = 'writes the span records of every tier for each request on STDERR')
 
     args = parser.parse_args()
 
-    Client().connect_on_server(args.host, args.port)
\ No newline at end of file
+    Client(trace = args.trace).connect_on_server(args.host, args.port)
\ No newline at end of file
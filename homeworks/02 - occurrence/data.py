@@ -1,18 +1,32 @@
 #!/usr/bin/env python3
 
 import argparse
+import asyncio
+import framing
+import log
 import os
 import pathlib
 import server
 import signal
-import sys
+import tracing
 
+from cache import ResultCache, expose_cache_metrics
+from indexer import Indexer, file_version
+from server import Supervisor
 
-def read_file(path):
-    with open(path, 'r') as fh:
-        return fh.read()
 
-class Data(server.Server):
+logger = log.get_logger(__name__)
+
+
+def open_file(path):
+    return open(path, 'rb')
+
+def expose_file_cache_metrics(registry, cache):
+    expose_cache_metrics(registry, cache)
+    registry.gauge('cache_hits', lambda: cache.hits)
+    registry.gauge('cache_misses', lambda: cache.misses)
+
+class Data(server.FramedServer):
     '''
     Connects to the remote server, sends the messages from STDIN to there
     and writes the replies on STDOUT.
@@ -25,37 +39,233 @@ class Data(server.Server):
     ERROR_FILE_NOT_FOUND        = 'error: file not found'
     ERROR_INTERNAL_SERVER_ERROR = 'error: internal server error'
 
-    def __init__(self, data_dir, threads = 2, payload_size = 1024):
+    ERROR_INVALID_PATTERN       = 'error: invalid pattern'
+    ERROR_NOT_INDEXED           = 'error: not indexed'
+
+    NAME = 'data'
+
+    REQUEST_TYPES = (framing.REQUEST, framing.STAT, framing.LIST, framing.INDEX)
+
+    def __init__(self, data_dir, threads = 2, payload_size = 1024, cache = None, max_cached_file_size = 1024 * 1024, indexer = None):
         super().__init__(threads = threads, payload_size = payload_size)
         self.data_dir = data_dir
 
-    def handle_connection(self, worker_id, peer_conn, peer_address):
-        data = peer_conn.recv(self.payload_size)
-        if not data:
-            print(f'worker #{worker_id}: {peer_address[0]}:{peer_address[1]} sent no data, closing connection', file = sys.stderr)
-            return
+        self.cache = cache or ResultCache(max_bytes = 0)
+        self.max_cached_file_size = max_cached_file_size
+        expose_file_cache_metrics(self.metrics, self.cache)
+
+        self.indexer = indexer
+
+    def request_handler(self, worker_id, peer_address, frame):
+        filename = str(frame.payload, encoding = 'utf-8')
+
+        if frame.type == framing.STAT:
+            logger.debug('worker #%s: %s:%s has requested the version of the %s file', worker_id, peer_address[0], peer_address[1], filename)
+            return Data.stat_file(self.data_dir, filename)
+
+        if frame.type == framing.LIST:
+            logger.info('worker #%s: %s:%s has listed the files matching %s', worker_id, peer_address[0], peer_address[1], filename)
+            return Data.list_files(self.data_dir, filename)
 
-        message = ''
+        if frame.type == framing.INDEX:
+            logger.info('worker #%s: %s:%s has requested the index of the %s file', worker_id, peer_address[0], peer_address[1], filename)
+            return Data.load_index(self.data_dir, filename, self.indexer)
+
+        logger.info('worker #%s: %s:%s has requested the %s file', worker_id, peer_address[0], peer_address[1], filename)
+        return Data.load_file(self.data_dir, filename, self.cache, self.max_cached_file_size)
+
+    @staticmethod
+    def load_file(data_dir, filename, cache = None, max_cached_file_size = 0):
+        '''
+        Opens a file from the data dir. A large file is not read here: it is
+        streamed to the peer with sendfile, so serving it takes the same memory
+        whatever its size. A small file is served from the cache while it
+        keeps the same version, at the cost of a stat instead of opening,
+        sending and closing it.
+
+        Args:
+            data_dir (str): Path at filesystem which the files are stored.
+            filename (str): The requested file name.
+            cache (ResultCache): The contents of the small files, keyed by path. Defaults to None.
+            max_cached_file_size (int): Max size in bytes of a cached file. Defaults to 0.
+
+        Returns:
+            tuple: RESPONSE and the open file or its content, or ERROR and an error message.
+        '''
+
+        path = pathlib.Path(data_dir, filename)
 
         try:
-            filename = str(data, encoding='utf-8').rstrip(os.linesep)
-            print(f'worker #{worker_id}: {peer_address[0]}:{peer_address[1]} has requested the {filename} file', file = sys.stderr)
+            if cache is not None and cache.max_bytes:
+                stat = os.stat(path)
+
+                if stat.st_size <= max_cached_file_size:
+                    return framing.RESPONSE, Data.load_cached_file(path, file_version(stat), cache)
 
-            message = read_file(pathlib.Path(self.data_dir, filename))
+            return framing.RESPONSE, open_file(path)
 
         except FileNotFoundError as e:
-            message = Data.ERROR_FILE_NOT_FOUND
+            return framing.ERROR, Data.ERROR_FILE_NOT_FOUND.encode()
 
         except Exception as e:
-            message = Data.ERROR_INTERNAL_SERVER_ERROR
-            print(f'worker #{worker_id}: an exception occurred while reading file {filename}: Exception = {e}', file = sys.stderr)
+            logger.error('an exception occurred while reading file %s: Exception = %s', filename, e)
+            return framing.ERROR, Data.ERROR_INTERNAL_SERVER_ERROR.encode()
+
+    @staticmethod
+    def load_cached_file(path, version, cache):
+        '''
+        Reads a file through the cache, which is refreshed when the file has changed.
+
+        Args:
+            path (obj): Path of the file.
+            version (bytes): The current version of the file.
+            cache (ResultCache): The contents of the small files.
 
-        finally:
-            peer_conn.send(f'{message}{os.linesep}'.encode())
+        Returns:
+            bytes: The content of the file.
+        '''
+
+        key = str(path)
+
+        content = cache.get(key, version)
+        if content is None:
+            with tracing.span('read'), open_file(path) as fh:
+                content = fh.read()
+
+            cache.put(key, version, content)
+
+        return content
+
+    @staticmethod
+    def stat_file(data_dir, filename):
+        '''
+        Reports the version of a file from the data dir (see file_version),
+        without reading it.
+
+        Args:
+            data_dir (str): Path at filesystem which the files are stored.
+            filename (str): The requested file name.
+
+        Returns:
+            tuple: RESPONSE and the version as JSON, or ERROR and an error message.
+        '''
+
+        try:
+            stat = os.stat(pathlib.Path(data_dir, filename))
+
+        except FileNotFoundError as e:
+            return framing.ERROR, Data.ERROR_FILE_NOT_FOUND.encode()
+
+        except Exception as e:
+            logger.error('an exception occurred while reading file %s: Exception = %s', filename, e)
+            return framing.ERROR, Data.ERROR_INTERNAL_SERVER_ERROR.encode()
+
+        return framing.RESPONSE, file_version(stat)
 
     @staticmethod
-    def is_error(message):
-        return Data.ERROR_INTERNAL_SERVER_ERROR in message or Data.ERROR_FILE_NOT_FOUND in message
+    def load_index(data_dir, filename, indexer = None):
+        '''
+        Reads the precomputed word occurrences of a file from the data dir,
+        as long as its index is as recent as the file and fits in a frame.
+
+        Args:
+            data_dir (str): Path at filesystem which the files are stored.
+            filename (str): The requested file name.
+            indexer (Indexer): The index of the data dir, None if it is not indexed. Defaults to None.
+
+        Returns:
+            tuple: RESPONSE and the word occurrences in the binary-zlib encoding, or ERROR and an error message.
+        '''
+
+        try:
+            stat = os.stat(pathlib.Path(data_dir, filename))
+
+            payload = indexer.lookup(filename, file_version(stat)) if indexer else None
+            if payload is None or len(payload) > framing.MAX_PAYLOAD_SIZE: # the file is counted instead
+                return framing.ERROR, Data.ERROR_NOT_INDEXED.encode()
+
+        except FileNotFoundError as e:
+            return framing.ERROR, Data.ERROR_FILE_NOT_FOUND.encode()
+
+        except Exception as e:
+            logger.error('an exception occurred while reading the index of file %s: Exception = %s', filename, e)
+            return framing.ERROR, Data.ERROR_INTERNAL_SERVER_ERROR.encode()
+
+        return framing.RESPONSE, payload
+
+    @staticmethod
+    def list_files(data_dir, pattern):
+        '''
+        Lists the files of the data dir matching a glob pattern, such as
+        "*.txt" or "**/*.txt" to include the subdirectories.
+
+        Args:
+            data_dir (str): Path at filesystem which the files are stored.
+            pattern (str): The glob pattern, relative to the data dir.
+
+        Returns:
+            tuple: RESPONSE and the sorted file names, one per line, or ERROR and an error message.
+        '''
+
+        root = pathlib.Path(data_dir)
+
+        if '..' in pathlib.PurePath(pattern).parts: # the listing stays inside the data dir
+            return framing.ERROR, Data.ERROR_INVALID_PATTERN.encode()
+
+        try:
+            filenames = sorted(str(path.relative_to(root)) for path in root.glob(pattern) if path.is_file())
+
+        except (ValueError, NotImplementedError) as e:
+            return framing.ERROR, Data.ERROR_INVALID_PATTERN.encode()
+
+        except Exception as e:
+            logger.error('an exception occurred while listing files %s: Exception = %s', pattern, e)
+            return framing.ERROR, Data.ERROR_INTERNAL_SERVER_ERROR.encode()
+
+        return framing.RESPONSE, '\n'.join(filenames).encode()
+
+
+class AsyncData(server.AsyncFramedServer):
+    '''
+    Reimplements the AsyncFramedServer Class, serving the same requests as Data
+    without holding a thread while peers are sending or receiving.
+
+    Args:
+        data_dir (str): Path at filesystem which the files are stored.
+        payload_size (int): Max size of an incoming message. Defaults to 1024.
+    '''
+
+    NAME = Data.NAME
+
+    REQUEST_TYPES = Data.REQUEST_TYPES
+
+    def __init__(self, data_dir, payload_size = 1024, cache = None, max_cached_file_size = 1024 * 1024, indexer = None):
+        super().__init__(payload_size = payload_size)
+        self.data_dir = data_dir
+
+        self.cache = cache or ResultCache(max_bytes = 0)
+        self.max_cached_file_size = max_cached_file_size
+        expose_file_cache_metrics(self.metrics, self.cache)
+
+        self.indexer = indexer
+
+    async def request_handler(self, peer_address, frame):
+        filename = str(frame.payload, encoding = 'utf-8')
+
+        if frame.type == framing.STAT:
+            logger.debug('%s:%s has requested the version of the %s file', peer_address[0], peer_address[1], filename)
+            return await asyncio.to_thread(Data.stat_file, self.data_dir, filename)
+
+        if frame.type == framing.LIST:
+            logger.info('%s:%s has listed the files matching %s', peer_address[0], peer_address[1], filename)
+            return await asyncio.to_thread(Data.list_files, self.data_dir, filename)
+
+        if frame.type == framing.INDEX:
+            logger.info('%s:%s has requested the index of the %s file', peer_address[0], peer_address[1], filename)
+            return await asyncio.to_thread(Data.load_index, self.data_dir, filename, self.indexer)
+
+        logger.info('%s:%s has requested the %s file', peer_address[0], peer_address[1], filename)
+        return await asyncio.to_thread(Data.load_file, self.data_dir, filename, self.cache, self.max_cached_file_size)
 
 
 if __name__ == '__main__':
@@ -64,13 +274,46 @@ if __name__ == '__main__':
     parser.add_argument('--host', '-H', type = str, default = 'localhost', help = 'local address (default localhost)')
     parser.add_argument('--port', '-p', type = int, default = 8080, help = 'local port (default 8080)')
     parser.add_argument('--threads', '-t', type = int, default = 2, help = 'max number of simultaneous clients (default 2)')
+    parser.add_argument('--mode', '-m', type = str, default = 'threads', choices = ['threads', 'asyncio'], help = 'serving mode: one thread per client or an asyncio event loop (default threads)')
     parser.add_argument('--data-dir', type = str, default = './files', help = 'path at filesystem which the files are stored (default ./files)')
+    parser.add_argument('--cache-size', type = int, default = 64 * 1024 * 1024, help = 'memory budget in bytes of the cached small files, 0 disables the cache (default 64 MiB)')
+    parser.add_argument('--cache-max-file-size', type = int, default = 1024 * 1024, help = 'max size in bytes of a cached file, the larger ones are streamed from the disk (default 1 MiB)')
+    parser.add_argument('--index-dir', type = str, default = None, help = 'path at filesystem where the word occurrences of every file are indexed in the background, none disables the index (default none)')
+    parser.add_argument('--index-interval', type = float, default = 5, help = 'seconds between two scans of the data dir for new and changed files to index (default 5)')
+    parser.add_argument('--index-cache-size', type = int, default = 16 * 1024 * 1024, help = 'memory budget in bytes of the index files kept in memory, 0 disables it (default 16 MiB)')
+    parser.add_argument('--log-level', type = str, default = 'info', choices = log.LEVELS, help = 'min level of the logged messages, debug traces every message (default info)')
+    parser.add_argument('--log-sample', type = float, default = 1.0, help = 'fraction of the debug and info messages which are logged (default 1)')
+    parser.add_argument('--max-connections', type = int, default = 0, help = 'max number of simultaneous connections, the extra ones are rejected, 0 means no limit (default 0)')
+    parser.add_argument('--max-pending', type = int, default = 64, help = 'max number of accepted connections waiting for a free thread (default 64)')
+    parser.add_argument('--idle-timeout', type = float, default = 0, help = 'seconds after which a stalled peer is disconnected, 0 disables it (default 0)')
+    parser.add_argument('--stats-port', type = int, default = 0, help = 'port where the metrics are served over HTTP, 0 disables it (default 0)')
+    parser.add_argument('--workers', '-w', type = int, default = 0, help = 'number of worker processes sharing the port, 0 runs a single process (default 0)')
 
     args = parser.parse_args()
 
-    server = Data(data_dir = args.data_dir, threads = args.threads)
+    log.setup(level = args.log_level, sample_rate = args.log_sample)
+
+    cache = ResultCache(max_bytes = args.cache_size)
+    indexer = Indexer(args.data_dir, args.index_dir, interval = args.index_interval, cache_size = args.index_cache_size) if args.index_dir else None
+
+    if args.mode == 'asyncio':
+        server = AsyncData(data_dir = args.data_dir, cache = cache, max_cached_file_size = args.cache_max_file_size, indexer = indexer)
+    else:
+        server = Data(data_dir = args.data_dir, threads = args.threads, cache = cache, max_cached_file_size = args.cache_max_file_size, indexer = indexer)
+
+    server.expose_metrics(args.stats_port)
+    server.limit_connections(args.max_connections, args.max_pending, args.idle_timeout or None)
+
+    if args.workers > 0:
+        server = Supervisor(server, workers = args.workers)
 
     for ss in [signal.SIGINT, signal.SIGTERM]:
         signal.signal(ss, lambda received_signal, frame: server.stop())
 
-    server.start(host = args.host, port = args.port)
\ No newline at end of file
+    if indexer:
+        indexer.start() # a single indexer, the workers read its index files
+
+    server.start(host = args.host, port = args.port)
+
+    if indexer:
+        indexer.stop()
\ No newline at end of file
@@ -1,30 +1,43 @@
 #!/usr/bin/env python3
 
 import argparse
-import csv
-import io
+import asyncio
+import collections
+import concurrent.futures
+import contextvars
+import framing
+import heapq
+import log
+import occurrences
 import os
-import pathlib
 import server
 import signal
-import socket
-import sys
+import time
+import tracing
 
-from data import Data
+from pool import AsyncConnectionPool, ConnectionPool, expose_pool_metrics
+from server import Supervisor
+from singleflight import AsyncSingleFlight, SingleFlight, expose_single_flight_metrics
 
 
-def format_user_response(content):
+logger = log.get_logger(__name__)
+
+# words requested to the Processing Server, which selects them so the response does not grow with the vocabulary
+TOP_WORDS = 10
+
+
+def format_user_response(count):
     '''
-    Decode the CSV, sort the occurrences and filter the top 10 words that appeared the most.
+    Sort the occurrences and filter the top 10 words that appeared the most.
 
     Args:
-        content (str): A CSV str content.
+        count (dict): Contains the word as a key and it's occurence as a value.
 
     Returns:
         str: A string that will be sent to the client.
     '''
 
-    top10 = filter_top10_occurrences(decode_word_occurrences_from_csv(content))
+    top10 = filter_top10_occurrences(count)
 
     response = f'WORD\t\tOCCURRENCES{os.linesep}'
     for item in top10:
@@ -32,131 +45,412 @@ def format_user_response(content):
 
     return response
 
-def filter_top10_occurrences(count):
+def build_interface_response(frame, encoding = occurrences.CSV):
     '''
-    Filter the top 10 word occurrence.
+    Builds the response for the word occurrences received from the Processing Server.
 
     Args:
-        count (dict): Contains the word as a key and it's occurence as a value.
+        frame (Frame): The reply of the Processing Server, with the encoded word occurrences.
+        encoding (str): Encoding of the word occurrences, as requested to the Processing Server. Defaults to CSV.
 
     Returns:
-        list (tuples): Each element is a word and it's ocurrences, 
-        first by the most occurrence and, if needed a lexicographical order (in case two words tie).
+        tuple: RESPONSE and the formatted top 10 words, or the error sent by the upstream servers.
     '''
 
-    count_by_occurrences = aggregate_words_by_occurrence(count)
+    if frame.type == framing.ERROR:
+        return frame.type, frame.payload
 
-    desc_occurrences = list(count_by_occurrences.keys())
-    desc_occurrences.sort(reverse = True)
+    with tracing.span('decode'):
+        count = occurrences.decode_word_occurrences(frame.payload, encoding)
 
-    result = []
-    for occurrence in desc_occurrences:
-        words = count_by_occurrences[occurrence]
-        words.sort()
+    with tracing.span('top10'):
+        return framing.RESPONSE, format_user_response(count).encode()
 
-        for word in words:
-            if len(result) == 10:
-                return result
+def filter_top10_occurrences(count):
+    '''
+    Filter the top 10 word occurrence.
+
+    Args:
+        count (dict): Contains the word as a key and it's occurence as a value.
 
-            item = (word, occurrence)
-            result.append(item)
+    Returns:
+        list (tuples): Each element is a word and it's ocurrences, 
+        first by the most occurrence and, if needed a lexicographical order (in case two words tie).
+    '''
 
-    return result
+    return heapq.nsmallest(10, count.items(), key = lambda item: (-item[1], item[0]))
 
-def aggregate_words_by_occurrence(count):
+def parse_filenames(request):
     '''
-    Aggregate word with the same count on the same "structure", so they don't "compete" with each other.
+    Splits a request into the requested file names, separated by commas.
+    A file name may also be a glob pattern, such as "*.txt".
 
     Args:
-        count (dict): Contains the word as a key and it's occurence as a value.
+        request (str): The request sent by the client.
 
     Returns:
-        dict: Contains the words as values and their ocurrences as keys.
+        list: The file names and the glob patterns.
     '''
 
-    count_by_occurrences = {}
-    for word, occurrences in count.items():
-        count_by_occurrences[occurrences] = count_by_occurrences.get(occurrences, []) + [word]
+    return [filename.strip() for filename in request.split(',') if filename.strip()]
 
-    return count_by_occurrences
+def is_pattern(filename):
+    return any(char in filename for char in '*?[')
 
-def decode_word_occurrences_from_csv(content):
+def merge_word_occurrences(count, payload, encoding):
     '''
-    Decodes a received CSV to a dict.
+    Adds the word occurrences of a file, as received from the Processing
+    Server, to the occurrences of the files received before.
 
     Args:
-        count (csv): A received CSV.
+        count (Counter): The merged word occurrences, updated in place.
+        payload (bytes): The encoded word occurrences of the file.
+        encoding (str): Encoding of the word occurrences.
+    '''
 
-    Returns:
-        dict: Contains the words as keys and their ocurrences as values.
+    with tracing.span('merge'):
+        count.update(occurrences.decode_word_occurrences(payload, encoding))
+
+class InterfaceMixin:
+    '''
+    InterfaceMixin holds what Interface and AsyncInterface share: the name of
+    the tier, its errors and the start of the traces.
     '''
 
-    count = {}
-    for row in csv.reader(io.StringIO(content)):
-        word, occurrences = row[0], int(row[1])
-        count[word] = occurrences
+    ERROR_FILE_NOT_FOUND = 'error: file not found'
+
+    NAME = 'interface'
+
+    def trace_id(self, frame):
+        return tracing.new_trace_id() # the traces start here, the request IDs of the clients are only unique per connection
 
-    return count
 
-class Interface(server.Server):
+class Interface(InterfaceMixin, server.FramedServer):
     '''
-    Reimplements the Server Class.
+    Reimplements the FramedServer Class.
     '''
 
-    def __init__(self, processing_address = 'localhost', processing_port = 8080, threads = 2, payload_size = 1024):
+    def __init__(self, processing_address = 'localhost', processing_port = 8080, threads = 2, payload_size = 1024, encoding = occurrences.BINARY, pool_size = 2, fanout = 4, upstream_timeout = None):
         super().__init__(threads = threads, payload_size = payload_size)
 
         self.processing_address = processing_address
         self.processing_port = processing_port
+        self.encoding = encoding
 
-    def handle_connection(self, worker_id, peer_conn, peer_address):
-        data = peer_conn.recv(self.payload_size)
-        if not data:
-            print(f'worker #{worker_id}: {peer_address[0]}:{peer_address[1]} sent no data, closing connection', file = sys.stderr)
-            return
+        self.processing_pool = ConnectionPool(processing_address, processing_port, max_size = pool_size, timeout = upstream_timeout)
+        expose_pool_metrics(self.metrics, self.processing_pool, 'processing')
 
-        filename = str(data, encoding = 'utf-8').rstrip(os.linesep)
-        print(f'worker #{worker_id}: {peer_address[0]}:{peer_address[1]} has requested the {filename} file', file = sys.stderr)
+        # concurrent requests for the same file share a single reply of the Processing Server
+        self.flights = SingleFlight()
+        expose_single_flight_metrics(self.metrics, self.flights)
 
-        content = self.get_word_occurrences(worker_id, filename)
+        # the files of a multi-file request are fetched by these threads, shared by every request
+        self.fanout_executor = concurrent.futures.ThreadPoolExecutor(max_workers = fanout)
 
-        response = ''
+    def shutdown(self):
+        super().shutdown()
+        self.fanout_executor.shutdown()
+        self.processing_pool.close()
 
-        if Data.is_error(content):
-            response = content
+    def request_handler(self, worker_id, peer_address, frame):
+        request = str(frame.payload, encoding = 'utf-8')
+        logger.info('worker #%s: %s:%s has requested the %s file', worker_id, peer_address[0], peer_address[1], request)
+
+        started_at = time.perf_counter_ns()
+
+        filenames = parse_filenames(request)
+
+        if len(filenames) == 1 and not is_pattern(filenames[0]):
+            with tracing.span('fetch'):
+                reply = self.get_word_occurrences(worker_id, filenames[0])
+
+            response = build_interface_response(reply, self.encoding)
         else:
-            response = format_user_response(content)
+            response = self.get_merged_word_occurrences(worker_id, filenames)
+
+        self.metrics.observe('upstream_latency_us', (time.perf_counter_ns() - started_at) // 1000)
+
+        return response
+
+    def get_merged_word_occurrences(self, worker_id, filenames):
+        '''
+        Gets the word occurrences of several files from the Processing Server,
+        up to "fanout" of them at once, and merges them as they arrive, so
+        the request takes about as long as the slowest file.
+
+        Args:
+            filenames (list): The requested file names, or glob patterns.
+
+        Returns:
+            tuple: RESPONSE and the formatted top 10 words of all the files, or the first error sent by the upstream servers.
+        '''
+
+        frame_type, filenames = self.expand_filenames(worker_id, filenames)
+        if frame_type == framing.ERROR:
+            return frame_type, filenames
+
+        if not filenames:
+            return framing.ERROR, self.ERROR_FILE_NOT_FOUND.encode()
+
+        # each file is fetched in a copy of the context, so its spans are added to the trace of the request
+        futures = [self.fanout_executor.submit(contextvars.copy_context().run, self.get_word_occurrences, worker_id, filename, None) for filename in filenames]
+        count = collections.Counter()
+
+        try:
+            for future in tracing.timed(concurrent.futures.as_completed(futures), 'fetch'):
+                reply = future.result()
+                if reply.type == framing.ERROR:
+                    return reply.type, reply.payload
+
+                merge_word_occurrences(count, reply.payload, self.encoding)
+
+        finally:
+            for future in futures:
+                future.cancel()
+
+        with tracing.span('top10'):
+            return framing.RESPONSE, format_user_response(count).encode()
+
+    def expand_filenames(self, worker_id, filenames):
+        '''
+        Replaces the glob patterns among the requested file names by the
+        files matching them, as listed by the Data Server.
+
+        Args:
+            filenames (list): The requested file names, or glob patterns.
+
+        Returns:
+            tuple: RESPONSE and the file names without duplicates, or ERROR and the error sent by the upstream servers.
+        '''
+
+        expanded = {}
+
+        for filename in filenames:
+            if not is_pattern(filename):
+                expanded[filename] = None
+                continue
+
+            with tracing.span('list'):
+                reply = self.list_files(worker_id, filename)
+            if reply.type == framing.ERROR:
+                return reply.type, reply.payload
+
+            expanded.update(dict.fromkeys(str(reply.payload, encoding = 'utf-8').splitlines()))
+
+        return framing.RESPONSE, list(expanded)
+
+    def list_files(self, worker_id, pattern):
+        '''
+        Lists the files matching a glob pattern, on a pooled connection.
+
+        Args:
+            pattern (str): The glob pattern.
+
+        Returns:
+            Frame: The reply of the Processing Server, with the file names or an error.
+        '''
+
+        def match(processing_conn):
+            framing.send_frame(processing_conn, framing.LIST, tracing.upstream_request_id(), pattern.encode())
+            logger.debug('worker #%s: listing the files matching %s on processing service', worker_id, pattern)
+
+            reply = framing.recv_frame(processing_conn)
+            if reply is None:
+                raise ConnectionError('processing service has closed the connection')
+
+            return reply
 
-        peer_conn.send(response.encode())
+        return self.processing_pool.run(match)
 
-    def get_word_occurrences(self, worker_id, filename):
+    def get_word_occurrences(self, worker_id, filename, top = TOP_WORDS):
         '''
-        Connects on the Processing Server and gets the word occurrence list.
+        Gets the word occurrence list from the Processing Server, on a pooled
+        connection, unless the same request is already in progress.
 
         Args:
             filename (str): The name of the requested file.
+            top (int): Number of words that appeared the most to get, None gets every word. Defaults to TOP_WORDS.
 
         Returns:
-            csv: Contains the words and their occurrences on a CSV format.
+            Frame: The reply of the Processing Server, with the encoded word occurrences or an error.
         '''
 
-        content = ''
+        def get(processing_conn):
+            framing.send_frame(processing_conn, tracing.upstream_request_type(), tracing.upstream_request_id(), framing.encode_query(filename, top = top, encoding = self.encoding))
+            logger.debug('worker #%s: requesting the word occurrences of %s on processing service', worker_id, filename)
 
-        with socket.socket() as processing_conn:
-            print(f'worker #{worker_id}: connecting to processing service at {self.processing_address}:{self.processing_port}', file = sys.stderr)
-            processing_conn.connect((self.processing_address, self.processing_port))
+            reply = framing.recv_frame(processing_conn)
+            if reply is None:
+                raise ConnectionError('processing service has closed the connection')
 
-            processing_conn.sendall(filename.encode())
-            print(f'worker #{worker_id}: requesting the content of {filename} on data service', file = sys.stderr)
+            tracing.recv_upstream_records(processing_conn)
+            return reply
 
-            while True:
-                raw = processing_conn.recv(self.payload_size)
-                if not raw:
-                    break
+        return self.flights.run((filename, top), lambda: self.processing_pool.run(get))
 
-                content += str(raw, encoding = 'utf-8')
 
-        return content
+class AsyncInterface(InterfaceMixin, server.AsyncFramedServer):
+    '''
+    Reimplements the AsyncFramedServer Class, serving the same requests as
+    Interface. The Processing Server is awaited without holding a thread.
+    '''
+
+    def __init__(self, processing_address = 'localhost', processing_port = 8080, payload_size = 1024, encoding = occurrences.BINARY, pool_size = 2, fanout = 4, upstream_timeout = None):
+        super().__init__(payload_size = payload_size)
+
+        self.processing_address = processing_address
+        self.processing_port = processing_port
+        self.encoding = encoding
+
+        self.processing_pool = AsyncConnectionPool(processing_address, processing_port, max_size = pool_size, timeout = upstream_timeout)
+        expose_pool_metrics(self.metrics, self.processing_pool, 'processing')
+
+        self.flights = AsyncSingleFlight()
+        expose_single_flight_metrics(self.metrics, self.flights)
+
+        self.fanout = fanout
+        self.fanout_slots = None # created on the event loop
+
+    def shutdown(self):
+        super().shutdown()
+        self.processing_pool.close()
+
+    async def request_handler(self, peer_address, frame):
+        request = str(frame.payload, encoding = 'utf-8')
+        logger.info('%s:%s has requested the %s file', peer_address[0], peer_address[1], request)
+
+        started_at = time.perf_counter_ns()
+
+        filenames = parse_filenames(request)
+
+        if len(filenames) == 1 and not is_pattern(filenames[0]):
+            with tracing.span('fetch'):
+                reply = await self.get_word_occurrences(filenames[0])
+
+            response = build_interface_response(reply, self.encoding)
+        else:
+            response = await self.get_merged_word_occurrences(filenames)
+
+        self.metrics.observe('upstream_latency_us', (time.perf_counter_ns() - started_at) // 1000)
+
+        return response
+
+    async def get_merged_word_occurrences(self, filenames):
+        '''
+        Gets the word occurrences of several files from the Processing Server,
+        up to "fanout" of them at once, and merges them as they arrive, as
+        Interface.get_merged_word_occurrences does.
+
+        Args:
+            filenames (list): The requested file names, or glob patterns.
+
+        Returns:
+            tuple: RESPONSE and the formatted top 10 words of all the files, or the first error sent by the upstream servers.
+        '''
+
+        frame_type, filenames = await self.expand_filenames(filenames)
+        if frame_type == framing.ERROR:
+            return frame_type, filenames
+
+        if not filenames:
+            return framing.ERROR, self.ERROR_FILE_NOT_FOUND.encode()
+
+        if self.fanout_slots is None:
+            self.fanout_slots = asyncio.Semaphore(self.fanout)
+
+        async def fetch(filename):
+            async with self.fanout_slots:
+                return await self.get_word_occurrences(filename, None)
+
+        tasks = [asyncio.ensure_future(fetch(filename)) for filename in filenames]
+        count = collections.Counter()
+
+        try:
+            for next_reply in asyncio.as_completed(tasks):
+                with tracing.span('fetch'):
+                    reply = await next_reply
+                if reply.type == framing.ERROR:
+                    return reply.type, reply.payload
+
+                await asyncio.to_thread(merge_word_occurrences, count, reply.payload, self.encoding)
+
+        finally:
+            for task in tasks:
+                task.cancel()
+
+        with tracing.span('top10'):
+            return framing.RESPONSE, format_user_response(count).encode()
+
+    async def expand_filenames(self, filenames):
+        '''
+        Replaces the glob patterns among the requested file names by the
+        files matching them, as Interface.expand_filenames does.
+        '''
+
+        expanded = {}
+
+        for filename in filenames:
+            if not is_pattern(filename):
+                expanded[filename] = None
+                continue
+
+            with tracing.span('list'):
+                reply = await self.list_files(filename)
+            if reply.type == framing.ERROR:
+                return reply.type, reply.payload
+
+            expanded.update(dict.fromkeys(str(reply.payload, encoding = 'utf-8').splitlines()))
+
+        return framing.RESPONSE, list(expanded)
+
+    async def list_files(self, pattern):
+        '''
+        Lists the files matching a glob pattern, on a pooled connection.
+
+        Args:
+            pattern (str): The glob pattern.
+
+        Returns:
+            Frame: The reply of the Processing Server, with the file names or an error.
+        '''
+
+        async def match(reader, writer):
+            await framing.write_frame(writer, framing.LIST, tracing.upstream_request_id(), pattern.encode())
+            logger.debug('listing the files matching %s on processing service', pattern)
+
+            reply = await framing.read_frame(reader)
+            if reply is None:
+                raise ConnectionError('processing service has closed the connection')
+
+            return reply
+
+        return await self.processing_pool.run(match)
+
+    async def get_word_occurrences(self, filename, top = TOP_WORDS):
+        '''
+        Gets the word occurrence list from the Processing Server, on a pooled
+        connection, unless the same request is already in progress.
+
+        Args:
+            filename (str): The name of the requested file.
+            top (int): Number of words that appeared the most to get, None gets every word. Defaults to TOP_WORDS.
+
+        Returns:
+            Frame: The reply of the Processing Server, with the encoded word occurrences or an error.
+        '''
+
+        async def get(reader, writer):
+            await framing.write_frame(writer, tracing.upstream_request_type(), tracing.upstream_request_id(), framing.encode_query(filename, top = top, encoding = self.encoding))
+            logger.debug('requesting the word occurrences of %s on processing service', filename)
+
+            reply = await framing.read_frame(reader)
+            if reply is None:
+                raise ConnectionError('processing service has closed the connection')
+
+            await tracing.read_upstream_records(reader)
+            return reply
+
+        return await self.flights.run((filename, top), lambda: self.processing_pool.run(get))
 
 
 if __name__ == '__main__':
@@ -165,12 +459,35 @@ if __name__ == '__main__':
     parser.add_argument('--host', '-H', type = str, default = 'localhost', help = 'local address (default localhost)')
     parser.add_argument('--port', '-p', type = int, default = 8080, help = 'local port (default 8080)')
     parser.add_argument('--threads', '-t', type = int, default = 2, help = 'max number of simultaneous clients (default 2)')
+    parser.add_argument('--mode', '-m', type = str, default = 'threads', choices = ['threads', 'asyncio'], help = 'serving mode: one thread per client or an asyncio event loop (default threads)')
     parser.add_argument('--processing-address', type = str, default = 'localhost', help = 'processing server\'s address (default localhost)')
     parser.add_argument('--processing-port', type = int, default = 8080, help = 'processing server\'s port (default 8080)')
+    parser.add_argument('--pool-size', type = int, default = 2, help = 'max number of connections kept open with the processing server, which should serve as many threads (default 2)')
+    parser.add_argument('--upstream-timeout', type = float, default = 0, help = 'seconds after which a read from the processing server waiting for its next bytes fails, which includes the time it counts a file, 0 disables it (default 0)')
+    parser.add_argument('--fanout', type = int, default = 4, help = 'max number of files of a multi-file request fetched at the same time (default 4)')
+    parser.add_argument('--encoding', type = str, default = occurrences.BINARY, choices = occurrences.ENCODINGS, help = 'encoding of the word occurrences requested to the processing server (default binary)')
+    parser.add_argument('--log-level', type = str, default = 'info', choices = log.LEVELS, help = 'min level of the logged messages, debug traces every message (default info)')
+    parser.add_argument('--log-sample', type = float, default = 1.0, help = 'fraction of the debug and info messages which are logged (default 1)')
+    parser.add_argument('--max-connections', type = int, default = 0, help = 'max number of simultaneous connections, the extra ones are rejected, 0 means no limit (default 0)')
+    parser.add_argument('--max-pending', type = int, default = 64, help = 'max number of accepted connections waiting for a free thread (default 64)')
+    parser.add_argument('--idle-timeout', type = float, default = 0, help = 'seconds after which a stalled peer is disconnected, 0 disables it (default 0)')
+    parser.add_argument('--stats-port', type = int, default = 0, help = 'port where the metrics are served over HTTP, 0 disables it (default 0)')
+    parser.add_argument('--workers', '-w', type = int, default = 0, help = 'number of worker processes sharing the port, 0 runs a single process (default 0)')
 
     args = parser.parse_args()
 
-    server = Interface(processing_address = args.processing_address, processing_port = args.processing_port, threads = args.threads)
+    log.setup(level = args.log_level, sample_rate = args.log_sample)
+
+    if args.mode == 'asyncio':
+        server = AsyncInterface(processing_address = args.processing_address, processing_port = args.processing_port, encoding = args.encoding, pool_size = args.pool_size, fanout = args.fanout, upstream_timeout = args.upstream_timeout or None)
+    else:
+        server = Interface(processing_address = args.processing_address, processing_port = args.processing_port, threads = args.threads, encoding = args.encoding, pool_size = args.pool_size, fanout = args.fanout, upstream_timeout = args.upstream_timeout or None)
+
+    server.expose_metrics(args.stats_port)
+    server.limit_connections(args.max_connections, args.max_pending, args.idle_timeout or None)
+
+    if args.workers > 0:
+        server = Supervisor(server, workers = args.workers)
 
     for ss in [signal.SIGINT, signal.SIGTERM]:
         signal.signal(ss, lambda received_signal, frame: server.stop())
@@ -0,0 +1,370 @@
+import http.server
+import json
+import threading
+import time
+
+
+class Histogram:
+    '''
+    Histogram records values (latencies in microseconds) on log-linear
+    buckets, in the same fashion as HDR histograms: every power of two is
+    split into 2^precision buckets, so the relative error of any reported
+    percentile is bounded by 2^-precision while the memory stays constant.
+    A bucket keeps the leading bit of the value besides its next "precision"
+    bits, and the values below 2^(precision + 1) have a bucket of their own.
+
+    Args:
+        precision (int): Number of bits used to split every power of two. Defaults to 5 (about 3% of error).
+    '''
+
+    def __init__(self, precision = 5):
+        self.precision = precision
+
+        self.counts = {}
+        self.total = 0
+        self.sum = 0
+        self.min = None
+        self.max = None
+
+    def bucket_of(self, value):
+        if value < (2 << self.precision):
+            return value
+
+        shift = value.bit_length() - self.precision - 1
+        return (shift << (self.precision + 1)) | (value >> shift)
+
+    def bounds_of(self, bucket):
+        if bucket < (2 << self.precision):
+            return bucket, bucket
+
+        shift = bucket >> (self.precision + 1)
+        lower = (bucket & ((2 << self.precision) - 1)) << shift
+        return lower, lower + (1 << shift) - 1
+
+    def record(self, value):
+        value = max(int(value), 0)
+
+        bucket = self.bucket_of(value)
+        self.counts[bucket] = self.counts.get(bucket, 0) + 1
+
+        self.total += 1
+        self.sum += value
+        self.min = value if self.min is None else min(self.min, value)
+        self.max = value if self.max is None else max(self.max, value)
+
+    def merge(self, other):
+        for bucket, count in list(other.counts.items()):
+            self.counts[bucket] = self.counts.get(bucket, 0) + count
+
+        self.total += other.total
+        self.sum += other.sum
+
+        if other.total:
+            self.min = other.min if self.min is None else min(self.min, other.min)
+            self.max = other.max if self.max is None else max(self.max, other.max)
+
+    def percentile(self, percentile):
+        '''
+        Returns the value below which the given percentile of the records fall.
+
+        Args:
+            percentile (float): A number between 0 and 100.
+
+        Returns:
+            int: The upper bound of the bucket holding the percentile.
+        '''
+
+        if not self.total:
+            return 0
+
+        threshold = self.total * percentile / 100
+        seen = 0
+
+        for bucket in sorted(self.counts):
+            seen += self.counts[bucket]
+            if seen >= threshold:
+                return min(self.bounds_of(bucket)[1], self.max)
+
+        return self.max
+
+    def mean(self):
+        return self.sum / self.total if self.total else 0
+
+    def buckets(self, groups = 12):
+        '''
+        Groups the buckets in a few ranges, so they fit on a terminal.
+
+        Args:
+            groups (int): Max number of ranges. Defaults to 12.
+
+        Returns:
+            list (tuples): Each element is the lower bound, upper bound and count of a range.
+        '''
+
+        ordered = sorted(self.counts)
+        if not ordered:
+            return []
+
+        size = max(1, -(-len(ordered) // groups))
+
+        result = []
+        for i in range(0, len(ordered), size):
+            chunk = ordered[i:i + size]
+            result.append((self.bounds_of(chunk[0])[0], self.bounds_of(chunk[-1])[1], sum(self.counts[b] for b in chunk)))
+
+        return result
+
+    def summary(self):
+        return {
+            'count': self.total,
+            'min': self.min or 0,
+            'mean': round(self.mean(), 1),
+            'p50': self.percentile(50),
+            'p95': self.percentile(95),
+            'p99': self.percentile(99),
+            'p99.9': self.percentile(99.9),
+            'max': self.max or 0,
+        }
+
+
+class Shard:
+    '''
+    Shard holds the counters and histograms updated by a single thread, so
+    recording a metric never contends on a lock.
+    '''
+
+    def __init__(self):
+        self.counters = {}
+        self.histograms = {}
+
+    def merge(self, other):
+        for name, value in list(other.counters.items()):
+            self.counters[name] = self.counters.get(name, 0) + value
+
+        for name, histogram in list(other.histograms.items()):
+            self.histograms.setdefault(name, Histogram()).merge(histogram)
+
+
+class Registry:
+    '''
+    Registry collects the metrics of a server. Every thread writes on its
+    own Shard and the shards are only merged when a snapshot is taken. The
+    shards of the threads which have exited are folded into a single retired
+    shard, so the threads coming and going do not pile shards up.
+    '''
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.shards = {} # thread -> its Shard
+        self.retired = Shard()
+        self.gauges = {}
+        self.started_at = time.monotonic()
+
+    def shard(self):
+        shard = getattr(self.local, 'shard', None)
+        if shard is None:
+            shard = Shard()
+            self.local.shard = shard
+
+            with self.lock:
+                self.retire_shards()
+                self.shards[threading.current_thread()] = shard
+
+        return shard
+
+    def retire_shards(self):
+        '''
+        Folds the shards of the threads which have exited into the retired
+        shard. The lock must be held.
+        '''
+
+        for thread in [thread for thread in self.shards if not thread.is_alive()]:
+            self.retired.merge(self.shards.pop(thread))
+
+    def increment(self, name, value = 1):
+        '''
+        Adds "value" to a counter. Negative values are allowed, so counters
+        are also used to track levels such as active connections.
+        '''
+
+        counters = self.shard().counters
+        counters[name] = counters.get(name, 0) + value
+
+    def observe(self, name, value):
+        '''
+        Records a value (usually a latency in microseconds) on a histogram.
+        '''
+
+        histograms = self.shard().histograms
+
+        histogram = histograms.get(name)
+        if histogram is None:
+            histogram = histograms[name] = Histogram()
+
+        histogram.record(value)
+
+    def gauge(self, name, function):
+        '''
+        Registers a function which is called to read a value when a snapshot is taken.
+        '''
+
+        with self.lock:
+            self.gauges[name] = function
+
+    def snapshot(self):
+        '''
+        Merges the shards of every thread.
+
+        Returns:
+            dict: The counters, the per-second rates, the gauges and the histogram summaries.
+        '''
+
+        merged = Shard()
+
+        with self.lock:
+            self.retire_shards()
+
+            shards = list(self.shards.values())
+            gauges = dict(self.gauges)
+
+            merged.merge(self.retired)
+
+        uptime = time.monotonic() - self.started_at
+
+        for shard in shards:
+            merged.merge(shard)
+
+        counters = merged.counters
+        histograms = merged.histograms
+
+        return {
+            'uptime_seconds': round(uptime, 3),
+            'counters': counters,
+            'rates': {name: round(value / uptime, 2) for name, value in counters.items() if uptime and name.endswith('_total')},
+            'gauges': {name: function() for name, function in gauges.items()},
+            'histograms': {name: histogram.summary() for name, histogram in histograms.items()},
+        }
+
+
+def format_text(snapshot):
+    '''
+    Formats a snapshot as plain text, one metric per line.
+
+    Args:
+        snapshot (dict): A Registry snapshot.
+
+    Returns:
+        str: Lines such as "connections_active 3" or "request_latency_us{p99} 812".
+    '''
+
+    lines = [f'uptime_seconds {snapshot["uptime_seconds"]}']
+
+    for group in ['counters', 'gauges']:
+        for name, value in sorted(snapshot[group].items()):
+            lines.append(f'{name} {value}')
+
+    for name, value in sorted(snapshot['rates'].items()):
+        lines.append(f'{name}{{per_second}} {value}')
+
+    for name, summary in sorted(snapshot['histograms'].items()):
+        for key, value in summary.items():
+            lines.append(f'{name}{{{key}}} {value}')
+
+    return '\n'.join(lines) + '\n'
+
+
+class StatsServer:
+    '''
+    StatsServer exposes a Registry over HTTP on its own port: "/" replies
+    with plain text and "/json" with JSON.
+
+    Args:
+        registry (obj): The Registry which is exposed.
+    '''
+
+    def __init__(self, registry):
+        self.registry = registry
+        self.httpd = None
+
+    def start(self, host, port):
+        '''
+        Starts serving the metrics from a background thread.
+
+        Args:
+            host (str): Interfaces address where the stats server should listen on.
+            port (int): Port number where the stats server should listen on.
+        '''
+
+        registry = self.registry
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                snapshot = registry.snapshot()
+
+                if self.path.rstrip('/').endswith('json'):
+                    body, content_type = json.dumps(snapshot).encode(), 'application/json'
+                else:
+                    body, content_type = format_text(snapshot).encode(), 'text/plain'
+
+                self.send_response(200)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.httpd = http.server.ThreadingHTTPServer((host, port), Handler)
+        self.httpd.daemon_threads = True
+
+        threading.Thread(target = self.httpd.serve_forever, daemon = True).start()
+
+    def stop(self):
+        if self.httpd:
+            self.httpd.shutdown()
+            self.httpd.server_close()
+            self.httpd = None
+
+
+class MeteredSocket:
+    '''
+    MeteredSocket wraps a connected socket and counts the bytes received from
+    and sent to the peer. Every other attribute is looked up on the socket.
+
+    Args:
+        peer_conn (obj): The wrapped socket object.
+        registry (obj): The Registry where the bytes are counted.
+    '''
+
+    def __init__(self, peer_conn, registry):
+        self.socket = peer_conn
+        self.registry = registry
+
+    def __getattr__(self, name):
+        return getattr(self.socket, name)
+
+    def recv(self, *args):
+        data = self.socket.recv(*args)
+        self.registry.increment('bytes_received_total', len(data))
+        return data
+
+    def recv_into(self, *args):
+        received = self.socket.recv_into(*args)
+        self.registry.increment('bytes_received_total', received)
+        return received
+
+    def send(self, data, *args):
+        sent = self.socket.send(data, *args)
+        self.registry.increment('bytes_sent_total', sent)
+        return sent
+
+    def sendall(self, data, *args):
+        self.socket.sendall(data, *args)
+        self.registry.increment('bytes_sent_total', memoryview(data).nbytes)
+
+    def sendfile(self, file, offset = 0, count = None):
+        sent = self.socket.sendfile(file, offset, count)
+        self.registry.increment('bytes_sent_total', sent)
+        return sent
@@ -0,0 +1,233 @@
+#!/usr/bin/env python3
+
+import argparse
+import itertools
+import json
+import os
+import random
+import string
+import sys
+import time
+
+import log
+import occurrences
+
+from words import CountingPool, WordCounter, count_word_occurrences, count_word_occurrences_in_parallel
+
+
+def generate_words(rng, vocabulary):
+    return [''.join(rng.choices(string.ascii_lowercase, k = rng.randint(2, 10))) for _ in range(vocabulary)]
+
+def generate_word_occurrences(vocabulary, seed = 0):
+    '''
+    Generates the word occurrences of a large text, following Zipf's law as
+    generate_corpus does, without generating the text.
+
+    Args:
+        vocabulary (int): Number of distinct words, before the duplicates generated by chance are merged.
+        seed (int): Seed of the random generator, so runs are comparable. Defaults to 0.
+
+    Returns:
+        dict: Contains the words as keys and their ocurrences as values, the word of rank r appears about 1000000 / r times.
+    '''
+
+    rng = random.Random(seed)
+
+    return {word: 1000000 // rank + 1 for rank, word in enumerate(generate_words(rng, vocabulary), start = 1)}
+
+def iter_corpus(size, vocabulary = 50000, seed = 0, chunk_size = 1024 * 1024):
+    '''
+    Generates a text whose word frequencies follow Zipf's law, as natural
+    languages do, piece by piece so a large corpus can be written to a file
+    without being held in memory.
+
+    Args:
+        size (int): Approximate size of the text in bytes.
+        vocabulary (int): Number of distinct words. Defaults to 50000.
+        seed (int): Seed of the random generator, so runs are comparable. Defaults to 0.
+        chunk_size (int): Approximate size in bytes of the yielded pieces. Defaults to 1 MiB.
+
+    Yields:
+        bytes: UTF-8 encoded lines of 16 words.
+    '''
+
+    rng = random.Random(seed)
+
+    words = generate_words(rng, vocabulary)
+    cum_weights = list(itertools.accumulate(1 / rank for rank in range(1, vocabulary + 1)))
+
+    lines = []
+    written = pending = 0
+
+    while written < size:
+        line = ' '.join(rng.choices(words, cum_weights = cum_weights, k = 16)) + '\n'
+        lines.append(line)
+        written += len(line)
+        pending += len(line)
+
+        if pending >= chunk_size:
+            yield ''.join(lines).encode()
+            lines, pending = [], 0
+
+    if lines:
+        yield ''.join(lines).encode()
+
+def generate_corpus(size, vocabulary = 50000, seed = 0):
+    '''
+    Generates a text whose word frequencies follow Zipf's law (see iter_corpus).
+
+    Returns:
+        bytes: UTF-8 encoded text, one line every 16 words.
+    '''
+
+    return b''.join(iter_corpus(size, vocabulary, seed))
+
+def measure(function, repeat):
+    '''
+    Runs "function" a number of times.
+
+    Returns:
+        tuple: The best elapsed time in seconds and the last result.
+    '''
+
+    best, result = None, None
+
+    for _ in range(repeat):
+        started_at = time.perf_counter()
+        result = function()
+        elapsed = time.perf_counter() - started_at
+
+        best = elapsed if best is None else min(best, elapsed)
+
+    return best, result
+
+def count_streaming(data):
+    counter = WordCounter()
+
+    view = memoryview(data)
+    for offset in range(0, len(data), 64 * 1024):
+        counter.feed(view[offset:offset + 64 * 1024])
+
+    return counter.finish()
+
+def run_count(args):
+    '''
+    Compares the single-threaded count_word_occurrences with the streaming
+    counter and with the map-reduce engine on a pool of processes.
+    '''
+
+    if args.file:
+        with open(args.file, 'rb') as fh:
+            data = fh.read()
+    else:
+        data = generate_corpus(args.size * 1024 * 1024)
+
+    pool = CountingPool(processes = args.processes, threshold = 0, shard_size = args.shard_size * 1024 * 1024)
+    count_word_occurrences_in_parallel(b'warm up', pool) # starts the processes out of the measures
+
+    try:
+        variants = [
+            ('count_word_occurrences', lambda: count_word_occurrences(str(data, encoding = 'utf-8'))),
+            ('streaming', lambda: count_streaming(data)),
+            (f'parallel ({args.processes} processes)', lambda: count_word_occurrences_in_parallel(data, pool)),
+        ]
+
+        results = []
+        expected = None
+
+        for name, function in variants:
+            elapsed, count = measure(function, args.repeat)
+
+            if expected is None:
+                expected = count
+            elif dict(count) != expected:
+                raise AssertionError(f'{name} does not count the same words as count_word_occurrences')
+
+            results.append({'variant': name, 'seconds': round(elapsed, 4), 'megabytes_per_second': round(len(data) / elapsed / 1024 / 1024, 2)})
+
+    finally:
+        pool.shutdown()
+
+    baseline = results[0]['seconds']
+    for result in results:
+        result['speedup'] = round(baseline / result['seconds'], 2)
+
+    return {'bytes': len(data), 'words': sum(expected.values()), 'vocabulary': len(expected), 'cpus': os.cpu_count(), 'results': results}
+
+def run_codec(args):
+    '''
+    Compares the CSV encoding of the word occurrences with the binary ones,
+    unsorted and sorted (front-coded), with and without zlib.
+    '''
+
+    count = generate_word_occurrences(args.vocabulary)
+
+    variants = [
+        ('csv', lambda: occurrences.encode_word_occurrences_to_csv(count).encode(), lambda payload: occurrences.decode_word_occurrences_from_csv(str(payload, encoding = 'utf-8'))),
+        ('binary', lambda: occurrences.encode_word_occurrences_to_binary(count), occurrences.decode_word_occurrences_from_binary),
+        ('binary sorted', lambda: occurrences.encode_word_occurrences_to_binary(count, sort = True), occurrences.decode_word_occurrences_from_binary),
+        ('binary zlib', lambda: occurrences.encode_word_occurrences_to_binary(count, compress = True), occurrences.decode_word_occurrences_from_binary),
+        ('binary sorted zlib', lambda: occurrences.encode_word_occurrences_to_binary(count, sort = True, compress = True), occurrences.decode_word_occurrences_from_binary),
+    ]
+
+    results = []
+
+    for name, encode, decode in variants:
+        encode_seconds, payload = measure(encode, args.repeat)
+        decode_seconds, decoded = measure(lambda: decode(payload), args.repeat)
+
+        if decoded != count:
+            raise AssertionError(f'{name} does not decode the word occurrences it has encoded')
+
+        results.append({'variant': name, 'bytes': len(payload), 'encode_seconds': round(encode_seconds, 4), 'decode_seconds': round(decode_seconds, 4)})
+
+    baseline = results[0]
+    for result in results:
+        result['size_ratio'] = round(result['bytes'] / baseline['bytes'], 3)
+        result['decode_speedup'] = round(baseline['decode_seconds'] / result['decode_seconds'], 2)
+
+    return {'vocabulary': len(count), 'results': results}
+
+def print_count_report(report, output_file = sys.stdout):
+    print(f'{report["bytes"]} bytes, {report["words"]} words, {report["vocabulary"]} distinct, {report["cpus"]} CPUs', file = output_file)
+
+    for result in report['results']:
+        print(f'  {result["variant"]:<28} {result["seconds"]:>9}s {result["megabytes_per_second"]:>9} MB/s  x{result["speedup"]}', file = output_file)
+
+def print_codec_report(report, output_file = sys.stdout):
+    print(f'{report["vocabulary"]} distinct words', file = output_file)
+
+    for result in report['results']:
+        print(f'  {result["variant"]:<20} {result["bytes"]:>10} bytes (x{result["size_ratio"]:<5}) encode {result["encode_seconds"]:>8}s  decode {result["decode_seconds"]:>8}s  x{result["decode_speedup"]}', file = output_file)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = 'measures the building blocks of the services in isolation')
+    subparsers = parser.add_subparsers(dest = 'command', required = True)
+
+    count_parser = subparsers.add_parser('count', help = 'compares the word counting engines')
+    count_parser.add_argument('--size', '-s', type = int, default = 64, help = 'size in MiB of the generated corpus (default 64)')
+    count_parser.add_argument('--file', '-f', type = str, default = None, help = 'counts this file instead of a generated corpus')
+    count_parser.add_argument('--processes', '-P', type = int, default = os.cpu_count(), help = 'number of counting processes (default the number of CPUs)')
+    count_parser.add_argument('--shard-size', type = int, default = 4, help = 'size in MiB of the shards counted by the processes (default 4)')
+    count_parser.add_argument('--repeat', '-r', type = int, default = 3, help = 'runs of every variant, the best one is reported (default 3)')
+    count_parser.add_argument('--json', action = 'store_true', help = 'writes the report as JSON')
+
+    codec_parser = subparsers.add_parser('codec', help = 'compares the encodings of the word occurrences')
+    codec_parser.add_argument('--vocabulary', '-V', type = int, default = 200000, help = 'number of distinct words (default 200000)')
+    codec_parser.add_argument('--repeat', '-r', type = int, default = 3, help = 'runs of every variant, the best one is reported (default 3)')
+    codec_parser.add_argument('--json', action = 'store_true', help = 'writes the report as JSON')
+
+    args = parser.parse_args()
+
+    log.setup(level = 'warning')
+
+    if args.command == 'count':
+        report, print_report = run_count(args), print_count_report
+    elif args.command == 'codec':
+        report, print_report = run_codec(args), print_codec_report
+
+    if args.json:
+        print(json.dumps(report))
+    else:
+        print_report(report)
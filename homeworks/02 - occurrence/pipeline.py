@@ -0,0 +1,338 @@
+#!/usr/bin/env python3
+
+import argparse
+import datetime
+import json
+import multiprocessing
+import os
+import pathlib
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+
+import log
+import occurrences
+
+from benchmark import build_report, parse_file_mix, print_report, run_benchmark, start_in_background
+from cache import ResultCache
+from data import Data
+from indexer import Indexer
+from interface import Interface
+from microbench import iter_corpus
+from processing import Processing
+from words import CountingPool
+
+
+# started in this order, each one on an ephemeral port, and stopped the other way around
+TIERS = ('data', 'processing', 'interface')
+
+SIZE_UNITS = {'K': 1024, 'M': 1024 * 1024, 'G': 1024 * 1024 * 1024}
+
+
+def parse_size(value):
+    '''
+    Parses a size such as "64K", "16M" or "1G" (binary units), or a number of bytes.
+    '''
+
+    unit = value[-1:].upper()
+    if unit in SIZE_UNITS:
+        return int(float(value[:-1]) * SIZE_UNITS[unit])
+
+    return int(value)
+
+def peak_rss_bytes():
+    '''
+    Returns the peak resident memory of this process, from VmHWM in
+    /proc/self/status. The ru_maxrss of getrusage is not used: on Linux, a
+    process started with fork and exec keeps the high-water mark of its
+    parent, so every tier would report at least the memory of the benchmark
+    process.
+
+    Returns:
+        int: The peak RSS in bytes, or None where /proc is not available.
+    '''
+
+    try:
+        with open('/proc/self/status') as fh:
+            for line in fh:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * 1024 # in kB
+    except OSError:
+        pass
+
+    return None
+
+def prepare_corpora(corpus_dir, sizes, vocabulary, seed):
+    '''
+    Writes a Zipf-distributed corpus (see microbench.iter_corpus) for every
+    size, unless a previous run has already written it, since a large one
+    takes a while to generate.
+
+    Args:
+        corpus_dir (str): Directory where the corpora are written, the data dir of the Data Server.
+        sizes (list): The sizes of the corpora, such as "64K" or "1G".
+        vocabulary (int): Number of distinct words.
+        seed (int): Seed of the random generator.
+
+    Returns:
+        list: The file names of the corpora, in the order of "sizes".
+    '''
+
+    filenames = []
+
+    for size in sizes:
+        filename = f'zipf-{size}-v{vocabulary}-s{seed}.txt'
+        path = pathlib.Path(corpus_dir, filename)
+
+        if not path.exists():
+            print(f'generating {filename}...', file = sys.stderr)
+
+            temporary = path.with_suffix('.tmp')
+            with open(temporary, 'wb') as fh:
+                for chunk in iter_corpus(parse_size(size), vocabulary, seed):
+                    fh.write(chunk)
+
+            os.replace(temporary, path)
+
+        filenames.append(filename)
+
+    return filenames
+
+def build_tier(tier, options, upstream):
+    '''
+    Builds the server of a tier.
+
+    Args:
+        tier (str): One of TIERS.
+        options (dict): The options of the run.
+        upstream (tuple): The address of the server of the previous tier, None for the Data Server.
+    '''
+
+    threads = options['threads']
+
+    if tier == 'data':
+        indexer = None
+
+        if options['index']:
+            indexer = Indexer(options['corpus_dir'], pathlib.Path(options['corpus_dir'], '.index'))
+            indexer.scan() # built before the measures, not while they run
+
+        return Data(data_dir = options['corpus_dir'], threads = threads, cache = ResultCache(max_bytes = options['data_cache_size']), indexer = indexer)
+
+    if tier == 'processing':
+        counting_pool = CountingPool(processes = options['count_processes'])
+        cache = ResultCache(max_bytes = options['cache_size'])
+
+        return Processing(data_address = upstream[0], data_port = upstream[1], threads = threads, counting_pool = counting_pool, cache = cache, pool_size = threads, use_index = options['index'])
+
+    return Interface(processing_address = upstream[0], processing_port = upstream[1], threads = threads, encoding = options['encoding'], pool_size = threads)
+
+def run_tier(tier, options, upstream, conn):
+    '''
+    Runs the server of a tier in its own process, so its memory and CPU
+    time are measured apart from the other tiers. It sends the address it
+    listens on, then its measures once it is told to stop: the metrics, the
+    CPU time and the peak RSS of the process, the counting processes of the
+    Processing Server left out.
+
+    Args:
+        tier (str): One of TIERS.
+        options (dict): The options of the run.
+        upstream (tuple): The address of the server of the previous tier.
+        conn (obj): End of the pipe with the benchmark process.
+    '''
+
+    log.setup(level = 'warning')
+
+    server = build_tier(tier, options, upstream)
+    conn.send(start_in_background(server))
+
+    conn.recv()
+
+    snapshot = server.metrics.snapshot()
+    server.stop()
+
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    conn.send({'metrics': snapshot, 'peak_rss_bytes': peak_rss_bytes(), 'cpu_seconds': round(usage.ru_utime + usage.ru_stime, 3)})
+
+def start_tiers(options):
+    '''
+    Starts the tiers, each one in its own process and on an ephemeral port.
+
+    Returns:
+        tuple: The (tier, process, pipe) of every tier and the address of the Interface Server.
+    '''
+
+    context = multiprocessing.get_context('spawn')
+
+    tiers, upstream = [], None
+
+    for tier in TIERS:
+        conn, child_conn = context.Pipe()
+
+        process = context.Process(target = run_tier, args = (tier, options, upstream, child_conn), name = tier)
+        process.start()
+
+        upstream = conn.recv()
+        tiers.append((tier, process, conn))
+
+    return tiers, upstream
+
+def stop_tiers(tiers):
+    '''
+    Stops the tiers, the Interface Server first.
+
+    Returns:
+        dict: The measures of every tier.
+    '''
+
+    measures = {}
+
+    for tier, process, conn in reversed(tiers):
+        conn.send('stop')
+        measures[tier] = conn.recv()
+        process.join()
+
+    return measures
+
+def build_tier_report(measures, elapsed):
+    counters = measures['metrics']['counters']
+    histograms = measures['metrics']['histograms']
+
+    requests = counters.get('requests_total', 0)
+
+    return {
+        'requests': requests,
+        'errors': counters.get('errors_total', 0),
+        'requests_per_second': round(requests / elapsed, 2) if elapsed else 0,
+        'request_latency_us': histograms.get('request_latency_us'),
+        'upstream_latency_us': histograms.get('upstream_latency_us'),
+        'peak_rss_bytes': measures['peak_rss_bytes'],
+        'cpu_seconds': measures['cpu_seconds'],
+    }
+
+def current_commit():
+    '''
+    Returns the short hash of the checked out commit, so results can be
+    compared over time, or None out of a git repository.
+    '''
+
+    try:
+        result = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output = True, text = True, check = True, cwd = os.path.dirname(os.path.abspath(__file__)))
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+    return result.stdout.strip()
+
+def run_pipeline(args, corpus_dir):
+    '''
+    Generates the corpora, starts the three tiers and replays the query mix
+    against the Interface Server.
+
+    Returns:
+        dict: The report of the run.
+    '''
+
+    started_at = datetime.datetime.now(datetime.timezone.utc)
+
+    corpora = prepare_corpora(corpus_dir, args.sizes.split(','), args.vocabulary, args.seed)
+
+    # every corpus is asked as often by default
+    queries = args.queries or ';'.join(corpora)
+    filenames, weights = parse_file_mix(queries, separator = ';')
+
+    options = {
+        'corpus_dir': corpus_dir,
+        'threads': args.connections,
+        'encoding': args.encoding,
+        'cache_size': args.cache_size,
+        'data_cache_size': args.data_cache_size,
+        'count_processes': args.count_processes,
+        'index': args.index,
+    }
+
+    tiers, address = start_tiers(options)
+
+    try:
+        stats, elapsed = run_benchmark(address, args.connections, filenames, weights, args.duration, args.requests)
+    finally:
+        measures = stop_tiers(tiers)
+
+    client = build_report(stats, elapsed)
+    client['peak_rss_bytes'] = peak_rss_bytes()
+
+    return {
+        'run': {
+            'started_at': started_at.isoformat(timespec = 'seconds'),
+            'commit': current_commit(),
+            'python': platform.python_version(),
+            'cpus': os.cpu_count(),
+        },
+        'config': {
+            'sizes': args.sizes.split(','),
+            'vocabulary': args.vocabulary,
+            'seed': args.seed,
+            'queries': dict(zip(filenames, weights)),
+            'connections': args.connections,
+            'duration_seconds': args.duration,
+            'encoding': args.encoding,
+            'cache_size': args.cache_size,
+            'data_cache_size': args.data_cache_size,
+            'count_processes': args.count_processes,
+            'index': args.index,
+        },
+        'corpora': [{'filename': filename, 'bytes': os.path.getsize(pathlib.Path(corpus_dir, filename))} for filename in corpora],
+        'client': client,
+        'tiers': {tier: build_tier_report(measures[tier], elapsed) for tier in TIERS},
+    }
+
+def print_pipeline_report(report, output_file = sys.stdout):
+    for corpus in report['corpora']:
+        print(f'corpus:       {corpus["filename"]} ({corpus["bytes"]} bytes)', file = output_file)
+
+    print_report(report['client'], output_file)
+
+    for tier, result in report['tiers'].items():
+        latency = result['request_latency_us'] or {}
+        peak_rss = f'{result["peak_rss_bytes"] // 1024} KiB' if result['peak_rss_bytes'] is not None else 'unknown'
+        print(f'{tier + ":":<13} {result["requests"]} requests ({result["errors"]} errors), {result["requests_per_second"]} req/s, latency (us) p50 {latency.get("p50")} p99 {latency.get("p99")}, peak RSS {peak_rss}, CPU {result["cpu_seconds"]}s', file = output_file)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = 'measures the whole Interface -> Processing -> Data pipeline on generated Zipf-distributed corpora')
+
+    parser.add_argument('--sizes', '-s', type = str, default = '64K,1M,16M', help = 'comma separated sizes of the generated corpora, such as 64K, 16M or 1G (default 64K,1M,16M)')
+    parser.add_argument('--vocabulary', '-V', type = int, default = 50000, help = 'number of distinct words of the corpora (default 50000)')
+    parser.add_argument('--seed', type = int, default = 0, help = 'seed of the generated corpora (default 0)')
+    parser.add_argument('--corpus-dir', type = str, default = None, help = 'directory where the corpora are kept between runs (default a temporary directory)')
+    parser.add_argument('--queries', '-q', type = str, default = None, help = 'query mix separated by semicolons, each query with an optional weight, such as "zipf-64K-v50000-s0.txt:0.9;zipf-*.txt:0.1" (default every corpus equally)')
+    parser.add_argument('--connections', '-c', type = int, default = 4, help = 'number of concurrent clients, and of threads of every tier (default 4)')
+    parser.add_argument('--duration', '-d', type = float, default = 10, help = 'seconds to run the benchmark for (default 10)')
+    parser.add_argument('--requests', '-n', type = int, default = sys.maxsize, help = 'max number of requests per client (default unlimited)')
+    parser.add_argument('--encoding', type = str, default = occurrences.BINARY, choices = occurrences.ENCODINGS, help = 'encoding of the word occurrences between processing and interface (default binary)')
+    parser.add_argument('--cache-size', type = int, default = 0, help = 'memory budget in bytes of the processing results cache, 0 counts every request (default 0)')
+    parser.add_argument('--data-cache-size', type = int, default = 0, help = 'memory budget in bytes of the data file cache (default 0)')
+    parser.add_argument('--count-processes', type = int, default = os.cpu_count(), help = 'number of processes counting the large files (default the number of CPUs)')
+    parser.add_argument('--index', action = 'store_true', help = 'indexes the corpora before the run and answers from the index')
+    parser.add_argument('--json', action = 'store_true', help = 'writes the report as JSON')
+    parser.add_argument('--output', '-o', type = str, default = None, help = 'appends the JSON report as a line of this file, to compare runs over time')
+
+    args = parser.parse_args()
+
+    if args.corpus_dir:
+        os.makedirs(args.corpus_dir, exist_ok = True)
+        report = run_pipeline(args, args.corpus_dir)
+    else:
+        with tempfile.TemporaryDirectory(prefix = 'pipeline-') as corpus_dir:
+            report = run_pipeline(args, corpus_dir)
+
+    if args.output:
+        with open(args.output, 'a') as fh:
+            fh.write(json.dumps(report) + '\n')
+
+    if args.json:
+        print(json.dumps(report))
+    else:
+        print_pipeline_report(report)
@@ -0,0 +1,417 @@
+import asyncio
+import framing
+import log
+import select
+import socket
+import threading
+import time
+
+
+logger = log.get_logger(__name__)
+
+# a request failing on a reused connection is retried on a new one: the upstream may have closed it meanwhile
+RETRIABLE_ERRORS = (OSError, EOFError, framing.ProtocolError)
+
+
+def is_alive(conn):
+    '''
+    Checks an idle connection: it is readable only if the peer has closed it,
+    or has sent something nobody asked for.
+    '''
+
+    try:
+        readable, _, _ = select.select([conn], [], [], 0)
+    except (OSError, ValueError):
+        return False
+
+    return not readable
+
+
+class ConnectionPool:
+    '''
+    ConnectionPool keeps the connections with an upstream server open between
+    requests, so a request does not pay the connection setup. Connections
+    closed by the upstream are replaced by new ones. It is thread-safe: a
+    connection is used by a single thread at a time, and the threads wait for
+    a free connection once "max_size" of them are open.
+
+    The upstream serves a connection on a thread for as long as it is open,
+    so "max_size" should not exceed the threads of the upstream server, and
+    a background thread closes the connections idle for longer than
+    "max_idle_time" so they do not hold those threads once the traffic stops.
+
+    Args:
+        address (str): Address of the upstream server.
+        port (int): Port of the upstream server.
+        max_size (int): Max number of open connections. Defaults to 2.
+        max_idle_time (float): Seconds after which an idle connection is closed. Defaults to 5.
+        connect_timeout (float): Max seconds to open a connection. Defaults to 5.
+        timeout (float): Max seconds a single read or write on a connection may block, None means no limit. It is an idle timeout, not a limit on the whole request: a large file keeps arriving chunk by chunk, but a reply is only sent once the upstream has counted the file. Defaults to None.
+    '''
+
+    def __init__(self, address, port, max_size = 2, max_idle_time = 5, connect_timeout = 5, timeout = None):
+        self.address = address
+        self.port = port
+        self.max_size = max_size
+        self.max_idle_time = max_idle_time
+        self.connect_timeout = connect_timeout
+        self.timeout = timeout
+
+        self.lock = threading.Lock()
+        self.slots = threading.BoundedSemaphore(max_size)
+        self.idle = [] # (connection, idle since), the most recently used last
+
+        self.closed = threading.Event()
+        self.reaper = None # started once a connection is first given back
+
+        self.opened = 0
+        self.connects = 0
+        self.retries = 0
+
+    def acquire(self):
+        '''
+        Takes an idle connection, or opens a new one.
+
+        Returns:
+            tuple: The connection and whether it has been used before.
+        '''
+
+        self.slots.acquire()
+
+        with self.lock:
+            while self.idle:
+                conn, idle_since = self.idle.pop()
+
+                if time.monotonic() - idle_since < self.max_idle_time and is_alive(conn):
+                    return conn, True
+
+                conn.close()
+                self.opened -= 1
+
+        try:
+            conn = socket.create_connection((self.address, self.port), timeout = self.connect_timeout)
+            conn.settimeout(self.timeout)
+        except BaseException:
+            self.slots.release()
+            raise
+
+        with self.lock:
+            self.opened += 1
+            self.connects += 1
+
+        logger.debug('opened a connection with %s:%s', self.address, self.port)
+        return conn, False
+
+    def release(self, conn, reusable = True):
+        '''
+        Gives a connection back, closing it if it is not "reusable", that is,
+        when a request has failed and left it in an unknown state.
+        '''
+
+        with self.lock:
+            if reusable and not self.closed.is_set():
+                self.idle.append((conn, time.monotonic()))
+
+                if self.reaper is None:
+                    self.reaper = threading.Thread(target = self.reap_idle, name = 'pool-reaper', daemon = True)
+                    self.reaper.start()
+            else:
+                conn.close()
+                self.opened -= 1
+
+        self.slots.release()
+
+    def reap_idle(self):
+        '''
+        Closes the connections idle for longer than "max_idle_time", until
+        the pool is closed.
+        '''
+
+        while not self.closed.wait(self.max_idle_time / 2):
+            expired_at = time.monotonic() - self.max_idle_time
+
+            with self.lock:
+                while self.idle and self.idle[0][1] <= expired_at: # the least recently used first
+                    conn, _ = self.idle.pop(0)
+                    conn.close()
+                    self.opened -= 1
+
+    def run(self, function):
+        '''
+        Runs a request on a pooled connection. The requests between the tiers
+        have no side effects, so a request failing on a reused connection is
+        retried once on a new one.
+
+        Args:
+            function (function): Sends the request and reads the reply, it receives the connection.
+
+        Returns:
+            obj: What "function" returns.
+        '''
+
+        while True:
+            conn, reused = self.acquire()
+
+            try:
+                result = function(conn)
+
+            except TimeoutError: # the upstream is stalled rather than gone, a new connection would wait as long
+                logger.warning('a request to %s:%s has timed out', self.address, self.port)
+                self.release(conn, reusable = False)
+                raise
+
+            except RETRIABLE_ERRORS as e:
+                self.release(conn, reusable = False)
+
+                if not reused:
+                    raise
+
+                logger.debug('a reused connection with %s:%s has failed, retrying on a new one: %s', self.address, self.port, e)
+
+                with self.lock:
+                    self.retries += 1
+
+                continue
+
+            except BaseException:
+                self.release(conn, reusable = False)
+                raise
+
+            self.release(conn)
+            return result
+
+    def close(self):
+        '''
+        Closes the idle connections, and the ones given back from now on.
+        '''
+
+        self.closed.set()
+
+        with self.lock:
+            for conn, _ in self.idle:
+                conn.close()
+                self.opened -= 1
+
+            self.idle = []
+
+    def stats(self):
+        with self.lock:
+            return {
+                'connections': self.opened,
+                'idle': len(self.idle),
+                'connects': self.connects,
+                'retries': self.retries,
+            }
+
+
+class TimedReader:
+    '''
+    TimedReader wraps an asyncio stream so that every read waits for at most
+    "timeout" seconds for the next bytes, as a socket timeout does. A read of
+    an exact length is made of as many reads as it takes for the bytes to
+    arrive, so a large payload arriving steadily never times out.
+
+    Args:
+        reader (obj): The wrapped stream.
+        timeout (float): Max seconds a single read may wait.
+    '''
+
+    def __init__(self, reader, timeout):
+        self.reader = reader
+        self.timeout = timeout
+
+    async def read(self, n = -1):
+        return await asyncio.wait_for(self.reader.read(n), self.timeout)
+
+    async def readexactly(self, n):
+        data = bytearray()
+
+        while len(data) < n:
+            chunk = await self.read(n - len(data))
+            if not chunk:
+                raise asyncio.IncompleteReadError(bytes(data), n)
+
+            data += chunk
+
+        return bytes(data)
+
+    def at_eof(self):
+        return self.reader.at_eof()
+
+
+class AsyncConnectionPool:
+    '''
+    AsyncConnectionPool keeps the asyncio streams with an upstream server
+    open between requests, as ConnectionPool does for sockets. The idle
+    connections are closed by a callback of the event loop rather than by a
+    thread.
+
+    Args:
+        address (str): Address of the upstream server.
+        port (int): Port of the upstream server.
+        max_size (int): Max number of open connections. Defaults to 2.
+        max_idle_time (float): Seconds after which an idle connection is closed. Defaults to 5.
+        connect_timeout (float): Max seconds to open a connection. Defaults to 5.
+        timeout (float): Max seconds a single read on a connection may wait, as for ConnectionPool, None means no limit. Defaults to None.
+    '''
+
+    def __init__(self, address, port, max_size = 2, max_idle_time = 5, connect_timeout = 5, timeout = None):
+        self.address = address
+        self.port = port
+        self.max_size = max_size
+        self.max_idle_time = max_idle_time
+        self.connect_timeout = connect_timeout
+        self.timeout = timeout
+
+        self.loop = None
+        self.slots = None # created on the event loop
+        self.idle = [] # (reader, writer, idle since), the most recently used last
+        self.reaper = None # handle of the next call to reap_idle
+        self.closed = False
+
+        self.opened = 0
+        self.connects = 0
+        self.retries = 0
+
+    async def acquire(self):
+        '''
+        Takes an idle connection, or opens a new one.
+
+        Returns:
+            tuple: The reader, the writer and whether they have been used before.
+        '''
+
+        if self.slots is None:
+            self.loop = asyncio.get_running_loop()
+            self.slots = asyncio.Semaphore(self.max_size)
+
+        await self.slots.acquire()
+
+        while self.idle:
+            reader, writer, idle_since = self.idle.pop()
+
+            if time.monotonic() - idle_since < self.max_idle_time and not reader.at_eof() and not writer.is_closing():
+                return reader, writer, True
+
+            writer.close()
+            self.opened -= 1
+
+        try:
+            reader, writer = await asyncio.wait_for(asyncio.open_connection(self.address, self.port), self.connect_timeout)
+        except BaseException:
+            self.slots.release()
+            raise
+
+        if self.timeout:
+            reader = TimedReader(reader, self.timeout)
+
+        self.opened += 1
+        self.connects += 1
+
+        logger.debug('opened a connection with %s:%s', self.address, self.port)
+        return reader, writer, False
+
+    def release(self, reader, writer, reusable = True):
+        '''
+        Gives a connection back, closing it if it is not "reusable".
+        '''
+
+        if reusable and not self.closed:
+            self.idle.append((reader, writer, time.monotonic()))
+
+            if self.reaper is None:
+                self.reaper = self.loop.call_later(self.max_idle_time, self.reap_idle)
+        else:
+            writer.close()
+            self.opened -= 1
+
+        self.slots.release()
+
+    def reap_idle(self):
+        '''
+        Closes the connections idle for longer than "max_idle_time", and
+        comes back when the next one expires.
+        '''
+
+        self.reaper = None
+        now = time.monotonic()
+
+        while self.idle and now - self.idle[0][2] >= self.max_idle_time: # the least recently used first
+            _, writer, _ = self.idle.pop(0)
+            writer.close()
+            self.opened -= 1
+
+        if self.idle:
+            self.reaper = self.loop.call_later(self.idle[0][2] + self.max_idle_time - now, self.reap_idle)
+
+    async def run(self, function):
+        '''
+        Runs a request on a pooled connection, retrying it once on a new
+        connection if a reused one fails, as ConnectionPool.run does.
+
+        Args:
+            function (function): Coroutine function sending the request and reading the reply, it receives the reader and the writer.
+
+        Returns:
+            obj: What "function" returns.
+        '''
+
+        while True:
+            reader, writer, reused = await self.acquire()
+
+            try:
+                result = await function(reader, writer)
+
+            except TimeoutError: # not retried, as in ConnectionPool.run
+                logger.warning('a request to %s:%s has timed out', self.address, self.port)
+                self.release(reader, writer, reusable = False)
+                raise
+
+            except RETRIABLE_ERRORS as e:
+                self.release(reader, writer, reusable = False)
+
+                if not reused:
+                    raise
+
+                logger.debug('a reused connection with %s:%s has failed, retrying on a new one: %s', self.address, self.port, e)
+                self.retries += 1
+                continue
+
+            except BaseException:
+                self.release(reader, writer, reusable = False)
+                raise
+
+            self.release(reader, writer)
+            return result
+
+    def close(self):
+        '''
+        Closes the idle connections, and the ones given back from now on.
+        The streams belong to the event loop, so they are closed there: the
+        pool is usually closed by a signal handler, which may interrupt the
+        loop while it walks through them.
+        '''
+
+        if self.loop is None or self.loop.is_closed():
+            self.close_idle()
+        else:
+            self.loop.call_soon_threadsafe(self.close_idle)
+
+    def close_idle(self):
+        self.closed = True
+
+        if self.reaper:
+            self.reaper.cancel()
+            self.reaper = None
+
+        for _, writer, _ in self.idle:
+            writer.close()
+            self.opened -= 1
+
+        self.idle = []
+
+
+def expose_pool_metrics(registry, pool, name):
+    registry.gauge(f'{name}_pool_connections', lambda: pool.opened)
+    registry.gauge(f'{name}_pool_connects', lambda: pool.connects)
+    registry.gauge(f'{name}_pool_retries', lambda: pool.retries)
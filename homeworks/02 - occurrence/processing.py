@@ -1,113 +1,447 @@
 #!/usr/bin/env python3
 
 import argparse
-import csv
-import io
+import asyncio
+import framing
+import heapq
+import log
+import occurrences
 import os
-import pathlib
 import server
 import signal
-import socket
-import sys
+import time
+import tracing
 
-from data import Data
+from cache import ResultCache, expose_cache_metrics
+from pool import AsyncConnectionPool, ConnectionPool, expose_pool_metrics
+from server import Supervisor
+from singleflight import AsyncSingleFlight, SingleFlight, expose_single_flight_metrics
+from words import CountingPool
 
 
-def count_word_occurrences(content):
+logger = log.get_logger(__name__)
+
+
+def select_top_occurrences(count, k):
     '''
-    Count the occurrence of the words in "content".
+    Selects the k words that appeared the most with a heap of k elements,
+    which takes O(n log k) instead of sorting the whole vocabulary.
 
     Args:
-        content (str): The received content from a requested file.
+        count (dict): Contains the words as keys and their ocurrences as values.
+        k (int): Number of words to select.
 
     Returns:
-        dict: Contains the words as keys and their ocurrences as values.
+        dict: The k words, first by the most occurrences and, in case two words tie, in lexicographical order.
     '''
 
-    count = dict()
-    for word in content.split():
-        count[word] = count.get(word, 0) + 1
+    return dict(heapq.nsmallest(k, count.items(), key = lambda item: (-item[1], item[0])))
 
-    return count
-
-def encode_word_occurrences_to_csv(count):
+def build_processing_response(frame_type, result, top = None, encoding = occurrences.CSV):
     '''
-    Encodes a received dict to a CSV.
+    Builds the response for a file counted while it was received from the Data Server.
 
     Args:
-        count (dict): Contains the words as keys and their ocurrences as values.
+        frame_type (int): Type of the reply of the Data Server, RESPONSE or ERROR.
+        result (obj): The word occurrences, or the error message sent by the Data Server.
+        top (int): Number of words that appeared the most to respond with, None responds with every word. Defaults to None.
+        encoding (str): Encoding of the word occurrences, one of occurrences.ENCODINGS. Defaults to CSV.
 
     Returns:
-        csv: The count is just reestructured as a CSV, without nothing additional.
+        tuple: RESPONSE and the encoded word occurrences, or the error sent by the Data Server.
     '''
 
-    r = io.StringIO()
+    if frame_type == framing.ERROR:
+        return frame_type, result
 
-    writer = csv.writer(r)
-    for word in count:
-        writer.writerow([word, count[word]])
+    if top is not None:
+        with tracing.span('select_top'):
+            result = select_top_occurrences(result, top)
 
-    return r.getvalue()
+    with tracing.span('encode'):
+        return framing.RESPONSE, occurrences.encode_word_occurrences(result, encoding)
 
 
-class Processing(server.Server):
+class Processing(server.FramedServer):
     '''
-    Reimplements the Server Class.
+    Reimplements the FramedServer Class.
     '''
 
-    def __init__(self, data_address = 'localhost', data_port = 8080, threads = 2, payload_size = 1024):
+    NAME = 'processing'
+
+    REQUEST_TYPES = (framing.REQUEST, framing.LIST)
+
+    def __init__(self, data_address = 'localhost', data_port = 8080, threads = 2, payload_size = 1024, counting_pool = None, cache = None, pool_size = 2, use_index = True, upstream_timeout = None):
         super().__init__(threads = threads, payload_size = payload_size)
 
         self.data_address = data_address
         self.data_port = data_port
+        self.counting_pool = counting_pool or CountingPool(processes = 0)
+
+        self.cache = cache or ResultCache(max_bytes = 0)
+        expose_cache_metrics(self.metrics, self.cache)
+
+        self.data_pool = ConnectionPool(data_address, data_port, max_size = pool_size, timeout = upstream_timeout)
+        expose_pool_metrics(self.metrics, self.data_pool, 'data')
+
+        # concurrent requests for the same file share a single fetch and count
+        self.flights = SingleFlight()
+        expose_single_flight_metrics(self.metrics, self.flights)
+
+        self.use_index = use_index
+
+    def shutdown(self):
+        super().shutdown()
+        self.counting_pool.shutdown()
+        self.data_pool.close()
+
+    def request_handler(self, worker_id, peer_address, frame):
+        if frame.type == framing.LIST:
+            reply = self.list_files(worker_id, str(frame.payload, encoding = 'utf-8'))
+            return reply.type, reply.payload
+
+        try:
+            query = framing.decode_query(frame.payload)
+        except framing.ProtocolError as e:
+            return framing.ERROR, f'error: {e}'.encode()
+
+        filename, top, encoding = query['filename'], query.get('top'), query.get('encoding', occurrences.CSV)
+        if encoding not in occurrences.ENCODINGS:
+            return framing.ERROR, f'error: unknown encoding {encoding}'.encode()
+
+        logger.info('worker #%s: %s:%s has requested the %s file', worker_id, peer_address[0], peer_address[1], filename)
+
+        version = None
+
+        if self.cache.max_bytes:
+            with tracing.span('stat'):
+                reply = self.stat_file(worker_id, filename)
+            if reply.type == framing.ERROR:
+                return reply.type, reply.payload
+
+            version = reply.payload
+
+            response = self.cache.get((filename, top, encoding), version)
+            if response is not None:
+                self.metrics.increment('cache_hits_total')
+                return framing.RESPONSE, response
+
+            self.metrics.increment('cache_misses_total')
+
+        started_at = time.perf_counter_ns()
+        with tracing.span('fetch'):
+            # keyed by the version too, so a request never shares a count started before the file changed, nor caches it
+            frame_type, result = self.flights.run((filename, version), lambda: self.count_file_words(worker_id, filename))
+        self.metrics.observe('upstream_latency_us', (time.perf_counter_ns() - started_at) // 1000)
+
+        frame_type, response = build_processing_response(frame_type, result, top, encoding)
+
+        if version is not None and frame_type == framing.RESPONSE:
+            self.cache.put((filename, top, encoding), version, response)
+
+        return frame_type, response
+
+    def list_files(self, worker_id, pattern):
+        '''
+        Asks the Data Server for the files matching a glob pattern.
+
+        Args:
+            pattern (str): The glob pattern.
+
+        Returns:
+            Frame: The reply of the Data Server, with the file names or an error.
+        '''
+
+        def match(data_conn):
+            framing.send_frame(data_conn, framing.LIST, tracing.upstream_request_id(), pattern.encode())
+            logger.debug('worker #%s: listing the files matching %s on data service', worker_id, pattern)
+
+            reply = framing.recv_frame(data_conn)
+            if reply is None:
+                raise ConnectionError('data service has closed the connection')
+
+            return reply
+
+        return self.data_pool.run(match)
+
+    def stat_file(self, worker_id, filename):
+        '''
+        Asks the Data Server for the version of a file, which is much cheaper
+        than fetching it.
+
+        Args:
+            filename (str): The requested file name.
+
+        Returns:
+            Frame: The reply of the Data Server, with the version of the file or an error.
+        '''
+
+        def stat(data_conn):
+            framing.send_frame(data_conn, framing.STAT, tracing.upstream_request_id(), filename.encode())
+            logger.debug('worker #%s: requesting the version of %s on data service', worker_id, filename)
+
+            reply = framing.recv_frame(data_conn)
+            if reply is None:
+                raise ConnectionError('data service has closed the connection')
+
+            return reply
+
+        return self.data_pool.run(stat)
+
+    def count_file_words(self, worker_id, filename):
+        '''
+        Sends the received file name to the Data Server, on a pooled
+        connection, and counts the words of the content while it is being
+        received. The precomputed word occurrences are asked first, unless
+        "use_index" is off, and the file is only counted if it has not been
+        indexed.
+
+        Args:
+            filename (str): The requested file name.
+
+        Returns:
+            tuple: RESPONSE and the word occurrences, or ERROR and the error message sent by the Data Server.
+        '''
+
+        def count(data_conn):
+            if self.use_index:
+                with tracing.span('index'):
+                    framing.send_frame(data_conn, tracing.upstream_request_type(framing.INDEX), tracing.upstream_request_id(), filename.encode())
+                    logger.debug('worker #%s: requesting the index of %s on data service', worker_id, filename)
+
+                    reply = framing.recv_frame(data_conn)
+                    if reply is None:
+                        raise ConnectionError('data service has closed the connection')
+
+                    tracing.recv_upstream_records(data_conn)
+
+                    if reply.type == framing.RESPONSE:
+                        self.metrics.increment('index_hits_total')
+                        return reply.type, occurrences.decode_word_occurrences_from_binary(reply.payload)
+
+                self.metrics.increment('index_misses_total')
+
+            framing.send_frame(data_conn, tracing.upstream_request_type(), tracing.upstream_request_id(), filename.encode())
+            logger.debug('worker #%s: requesting the content of %s on data service', worker_id, filename)
+
+            with tracing.span('transfer'):
+                header = framing.recv_header(data_conn, max_size = None)
+                if header is None:
+                    raise ConnectionError('data service has closed the connection')
+
+            frame_type, _, length = header
+
+            if frame_type == framing.ERROR:
+                if length > framing.MAX_PAYLOAD_SIZE:
+                    raise framing.ProtocolError(f'error of {length} bytes exceeds the limit of {framing.MAX_PAYLOAD_SIZE} bytes')
+
+                result = framing.recv_exactly(data_conn, length)
+
+            else:
+                counter = self.counting_pool.counter(length)
+
+                for chunk in tracing.timed(framing.recv_chunks(data_conn, length), 'transfer'):
+                    with tracing.span('count'):
+                        counter.feed(chunk)
+
+                with tracing.span('count'):
+                    result = counter.finish()
+
+            tracing.recv_upstream_records(data_conn)
+            return frame_type, result
+
+        return self.data_pool.run(count)
+
+
+class AsyncProcessing(server.AsyncFramedServer):
+    '''
+    Reimplements the AsyncFramedServer Class, serving the same requests as
+    Processing. The Data Server is awaited without holding a thread and the
+    counting runs off the event loop.
+    '''
+
+    NAME = Processing.NAME
+
+    REQUEST_TYPES = Processing.REQUEST_TYPES
+
+    def __init__(self, data_address = 'localhost', data_port = 8080, payload_size = 1024, counting_pool = None, cache = None, pool_size = 2, use_index = True, upstream_timeout = None):
+        super().__init__(payload_size = payload_size)
+
+        self.data_address = data_address
+        self.data_port = data_port
+        self.counting_pool = counting_pool or CountingPool(processes = 0)
+
+        self.cache = cache or ResultCache(max_bytes = 0)
+        expose_cache_metrics(self.metrics, self.cache)
 
-    def handle_connection(self, worker_id, peer_conn, peer_address):
-        data = peer_conn.recv(self.payload_size)
-        if not data:
-            print(f'worker #{worker_id}: {peer_address[0]}:{peer_address[1]} sent no data, closing connection', file = sys.stderr)
-            return
+        self.data_pool = AsyncConnectionPool(data_address, data_port, max_size = pool_size, timeout = upstream_timeout)
+        expose_pool_metrics(self.metrics, self.data_pool, 'data')
 
-        filename = str(data, encoding = 'utf-8').rstrip(os.linesep)
-        print(f'worker #{worker_id}: {peer_address[0]}:{peer_address[1]} has requested the {filename} file', file = sys.stderr)
+        self.flights = AsyncSingleFlight()
+        expose_single_flight_metrics(self.metrics, self.flights)
 
-        content = self.get_file_content(worker_id, filename)
+        self.use_index = use_index
 
-        response = ''
+    def shutdown(self):
+        super().shutdown()
+        self.counting_pool.shutdown()
+        self.data_pool.close()
 
-        if Data.is_error(content):
-            response = content
-        else:
-            response = encode_word_occurrences_to_csv(count_word_occurrences(content))
+    async def request_handler(self, peer_address, frame):
+        if frame.type == framing.LIST:
+            reply = await self.list_files(str(frame.payload, encoding = 'utf-8'))
+            return reply.type, reply.payload
 
-        peer_conn.send(response.encode())
+        try:
+            query = framing.decode_query(frame.payload)
+        except framing.ProtocolError as e:
+            return framing.ERROR, f'error: {e}'.encode()
 
-    def get_file_content(self, worker_id, filename):
+        filename, top, encoding = query['filename'], query.get('top'), query.get('encoding', occurrences.CSV)
+        if encoding not in occurrences.ENCODINGS:
+            return framing.ERROR, f'error: unknown encoding {encoding}'.encode()
+
+        logger.info('%s:%s has requested the %s file', peer_address[0], peer_address[1], filename)
+
+        version = None
+
+        if self.cache.max_bytes:
+            with tracing.span('stat'):
+                reply = await self.stat_file(filename)
+            if reply.type == framing.ERROR:
+                return reply.type, reply.payload
+
+            version = reply.payload
+
+            response = self.cache.get((filename, top, encoding), version)
+            if response is not None:
+                self.metrics.increment('cache_hits_total')
+                return framing.RESPONSE, response
+
+            self.metrics.increment('cache_misses_total')
+
+        started_at = time.perf_counter_ns()
+        with tracing.span('fetch'):
+            # keyed by the version too, so a request never shares a count started before the file changed, nor caches it
+            frame_type, result = await self.flights.run((filename, version), lambda: self.count_file_words(filename))
+        self.metrics.observe('upstream_latency_us', (time.perf_counter_ns() - started_at) // 1000)
+
+        frame_type, response = await asyncio.to_thread(build_processing_response, frame_type, result, top, encoding)
+
+        if version is not None and frame_type == framing.RESPONSE:
+            self.cache.put((filename, top, encoding), version, response)
+
+        return frame_type, response
+
+    async def list_files(self, pattern):
         '''
-        Connects with Data Server and sends the received file name.
+        Asks the Data Server for the files matching a glob pattern.
+
+        Args:
+            pattern (str): The glob pattern.
+
+        Returns:
+            Frame: The reply of the Data Server, with the file names or an error.
+        '''
+
+        async def match(reader, writer):
+            await framing.write_frame(writer, framing.LIST, tracing.upstream_request_id(), pattern.encode())
+            logger.debug('listing the files matching %s on data service', pattern)
+
+            reply = await framing.read_frame(reader)
+            if reply is None:
+                raise ConnectionError('data service has closed the connection')
+
+            return reply
+
+        return await self.data_pool.run(match)
+
+    async def stat_file(self, filename):
+        '''
+        Asks the Data Server for the version of a file, which is much cheaper
+        than fetching it.
+
+        Args:
+            filename (str): The requested file name.
+
+        Returns:
+            Frame: The reply of the Data Server, with the version of the file or an error.
+        '''
+
+        async def stat(reader, writer):
+            await framing.write_frame(writer, framing.STAT, tracing.upstream_request_id(), filename.encode())
+            logger.debug('requesting the version of %s on data service', filename)
+
+            reply = await framing.read_frame(reader)
+            if reply is None:
+                raise ConnectionError('data service has closed the connection')
+
+            return reply
+
+        return await self.data_pool.run(stat)
+
+    async def count_file_words(self, filename):
+        '''
+        Sends the received file name to the Data Server, on a pooled
+        connection, and counts the words of the content while it is being
+        received, as Processing.count_file_words does. The chunks are
+        counted off the event loop.
 
         Args:
             filename (str): The requested file name.
 
         Returns:
-            str: The content of the file name requested to the Data Server.
+            tuple: RESPONSE and the word occurrences, or ERROR and the error message sent by the Data Server.
         '''
-        content = ''
 
-        with socket.socket() as data_conn:
-            print(f'worker #{worker_id}: connecting to data service at {self.data_address}:{self.data_port}', file = sys.stderr)
-            data_conn.connect((self.data_address, self.data_port))
+        async def count(reader, writer):
+            if self.use_index:
+                with tracing.span('index'):
+                    await framing.write_frame(writer, tracing.upstream_request_type(framing.INDEX), tracing.upstream_request_id(), filename.encode())
+                    logger.debug('requesting the index of %s on data service', filename)
+
+                    reply = await framing.read_frame(reader)
+                    if reply is None:
+                        raise ConnectionError('data service has closed the connection')
+
+                    await tracing.read_upstream_records(reader)
+
+                    if reply.type == framing.RESPONSE:
+                        self.metrics.increment('index_hits_total')
+                        return reply.type, await asyncio.to_thread(occurrences.decode_word_occurrences_from_binary, reply.payload)
+
+                self.metrics.increment('index_misses_total')
+
+            await framing.write_frame(writer, tracing.upstream_request_type(), tracing.upstream_request_id(), filename.encode())
+            logger.debug('requesting the content of %s on data service', filename)
+
+            with tracing.span('transfer'):
+                header = await framing.read_header(reader, max_size = None)
+                if header is None:
+                    raise ConnectionError('data service has closed the connection')
 
-            data_conn.sendall(filename.encode())
-            print(f'worker #{worker_id}: requesting the content of {filename} on data service', file = sys.stderr)
+            frame_type, _, length = header
 
-            while True:
-                raw = data_conn.recv(self.payload_size)
-                if not raw:
-                    break
+            if frame_type == framing.ERROR:
+                if length > framing.MAX_PAYLOAD_SIZE:
+                    raise framing.ProtocolError(f'error of {length} bytes exceeds the limit of {framing.MAX_PAYLOAD_SIZE} bytes')
 
-                content += str(raw, encoding = 'utf-8')
+                result = await reader.readexactly(length)
 
-        return content
+            else:
+                counter = self.counting_pool.counter(length)
+
+                async for chunk in tracing.timed_async(framing.read_chunks(reader, length), 'transfer'):
+                    with tracing.span('count'):
+                        await asyncio.to_thread(counter.feed, chunk)
+
+                with tracing.span('count'):
+                    result = await asyncio.to_thread(counter.finish) # waits for the shards counted by the processes
+
+            await tracing.read_upstream_records(reader)
+            return frame_type, result
+
+        return await self.data_pool.run(count)
 
 
 if __name__ == '__main__':
@@ -116,12 +450,40 @@ if __name__ == '__main__':
     parser.add_argument('--host', '-H', type = str, default = 'localhost', help = 'local address (default localhost)')
     parser.add_argument('--port', '-p', type = int, default = 8080, help = 'local port (default 8080)')
     parser.add_argument('--threads', '-t', type = int, default = 2, help = 'max number of simultaneous clients (default 2)')
+    parser.add_argument('--mode', '-m', type = str, default = 'threads', choices = ['threads', 'asyncio'], help = 'serving mode: one thread per client or an asyncio event loop (default threads)')
     parser.add_argument('--data-address', type = str, default = 'localhost', help = 'data server\'s address (default localhost)')
     parser.add_argument('--data-port', type = int, default = 8080, help = 'data server\'s port (default 8080)')
+    parser.add_argument('--count-processes', type = int, default = os.cpu_count(), help = 'number of processes counting the large files, 0 counts every file inline (default the number of CPUs)')
+    parser.add_argument('--count-threshold', type = int, default = 8 * 1024 * 1024, help = 'min size in bytes of a file counted on the processes (default 8 MiB)')
+    parser.add_argument('--pool-size', type = int, default = 2, help = 'max number of connections kept open with the data server, which should serve as many threads (default 2)')
+    parser.add_argument('--upstream-timeout', type = float, default = 0, help = 'seconds after which a read from the data server waiting for its next bytes fails, not a limit on the whole transfer, 0 disables it (default 0)')
+    parser.add_argument('--cache-size', type = int, default = 64 * 1024 * 1024, help = 'memory budget in bytes of the cached results, 0 disables the cache (default 64 MiB)')
+    parser.add_argument('--no-index', action = 'store_true', help = 'always count the files instead of asking the data server for their precomputed word occurrences first')
+    parser.add_argument('--log-level', type = str, default = 'info', choices = log.LEVELS, help = 'min level of the logged messages, debug traces every message (default info)')
+    parser.add_argument('--log-sample', type = float, default = 1.0, help = 'fraction of the debug and info messages which are logged (default 1)')
+    parser.add_argument('--max-connections', type = int, default = 0, help = 'max number of simultaneous connections, the extra ones are rejected, 0 means no limit (default 0)')
+    parser.add_argument('--max-pending', type = int, default = 64, help = 'max number of accepted connections waiting for a free thread (default 64)')
+    parser.add_argument('--idle-timeout', type = float, default = 0, help = 'seconds after which a stalled peer is disconnected, 0 disables it (default 0)')
+    parser.add_argument('--stats-port', type = int, default = 0, help = 'port where the metrics are served over HTTP, 0 disables it (default 0)')
+    parser.add_argument('--workers', '-w', type = int, default = 0, help = 'number of worker processes sharing the port, 0 runs a single process (default 0)')
 
     args = parser.parse_args()
 
-    server = Processing(data_address = args.data_address, data_port = args.data_port, threads = args.threads)
+    log.setup(level = args.log_level, sample_rate = args.log_sample)
+
+    counting_pool = CountingPool(processes = args.count_processes, threshold = args.count_threshold)
+    cache = ResultCache(max_bytes = args.cache_size)
+
+    if args.mode == 'asyncio':
+        server = AsyncProcessing(data_address = args.data_address, data_port = args.data_port, counting_pool = counting_pool, cache = cache, pool_size = args.pool_size, use_index = not args.no_index, upstream_timeout = args.upstream_timeout or None)
+    else:
+        server = Processing(data_address = args.data_address, data_port = args.data_port, threads = args.threads, counting_pool = counting_pool, cache = cache, pool_size = args.pool_size, use_index = not args.no_index, upstream_timeout = args.upstream_timeout or None)
+
+    server.expose_metrics(args.stats_port)
+    server.limit_connections(args.max_connections, args.max_pending, args.idle_timeout or None)
+
+    if args.workers > 0:
+        server = Supervisor(server, workers = args.workers)
 
     for ss in [signal.SIGINT, signal.SIGTERM]:
         signal.signal(ss, lambda received_signal, frame: server.stop())
@@ -1,13 +1,101 @@
 #!/usr/bin/env python3
 
 import argparse
+import asyncio
+import io
+import json
+import os
+import queue
 import signal
 import socket
-import sys
 import threading
+import time
 
+import framing
+import log
+import metrics
+import tracing
 
-class Server:
+
+logger = log.get_logger(__name__)
+
+class BaseServer:
+    '''
+    BaseServer holds what the threaded and the asyncio servers share: the
+    limits of the admission control and the metrics served over HTTP.
+
+    Args:
+        payload_size (int): Max size of an incoming message. Defaults to 1024.
+    '''
+
+    def __init__(self, payload_size = 1024):
+        self.payload_size = payload_size
+
+        self.metrics = metrics.Registry()
+        self.stats_port = 0
+        self.stats_server = None
+
+        self.max_connections = 0
+        self.max_pending = 0
+        self.idle_timeout = None
+        self.io_timeout = None
+
+    def limit_connections(self, max_connections = 0, max_pending = 64, idle_timeout = None, io_timeout = None):
+        '''
+        Sets the admission control of the server. Connections which can not
+        be admitted are closed right away instead of waiting on the kernel
+        backlog, and peers which stall are dropped so they can not hold a
+        worker forever.
+
+        Args:
+            max_connections (int): Max number of connections being served or waiting for a worker, 0 means no limit. Defaults to 0.
+            max_pending (int): Max number of accepted connections waiting for a free worker, 0 means no limit. Defaults to 64.
+            idle_timeout (float): Max seconds a peer may take to send its next message, None means no limit. Defaults to None.
+            io_timeout (float): Max seconds a single read or write of a request may block, None means no limit. Peers exceeding it are reported as slow clients. Defaults to None.
+        '''
+
+        self.max_connections = max_connections
+        self.max_pending = max_pending
+        self.idle_timeout = idle_timeout
+        self.io_timeout = io_timeout
+
+    def expose_metrics(self, port):
+        '''
+        Exposes the metrics of the server over HTTP on a separate port once it
+        is started: "/" replies with plain text and "/json" with JSON.
+
+        Args:
+            port (int): Port number where the metrics are served, 0 disables it.
+        '''
+
+        self.stats_port = port
+
+    def start_stats_server(self, host):
+        if not self.stats_port:
+            return
+
+        logger.info('serving metrics at %s:%s...', host, self.stats_port)
+
+        self.stats_server = metrics.StatsServer(self.metrics)
+        self.stats_server.start(host, self.stats_port)
+
+    def stop_stats_server(self):
+        if self.stats_server:
+            self.stats_server.stop()
+            self.stats_server = None
+
+    def shutdown(self):
+        '''
+        Releases the resources shared by the workers, such as the pools of
+        upstream connections. It is called once the server has stopped and
+        every worker has finished, so nothing is released under a request
+        still being served.
+        '''
+
+        pass
+
+
+class Server(BaseServer):
     '''
     Server is the passive side of client-server architecture model. It binds
     to one or more local interface and listens for incoming connection on some
@@ -21,12 +109,21 @@ class Server:
     '''
 
     def __init__(self, threads = 2, payload_size = 1024):
-        self.payload_size = payload_size
+        super().__init__(payload_size)
+
         self.threads = threads
+        self.max_pending = 64
 
         self.lock = threading.Lock()
         self.socket = None
         self.stopped = True
+        self.waiting = set() # connections waiting for the next request of their peer
+
+        self.metrics.gauge('workers', lambda: self.threads)
+
+        self.pending = None
+        self.admitted = 0
+        self.metrics.gauge('connections_pending', lambda: self.pending.qsize() if self.pending else 0)
 
     def start(self, host, port):
         '''
@@ -38,54 +135,182 @@ class Server:
         '''
 
         address = (host, port)
-        print(f'starting the server at {address[0]}:{address[1]}...')
+        logger.info('starting the server at %s:%s...', address[0], address[1])
+
+        self.start_stats_server(host)
 
         with socket.create_server(address, reuse_port = True) as ss:
             with self.lock:
                 self.socket = ss
                 self.stopped = False
+                self.pending = queue.Queue(self.max_pending)
 
             threads = []
             for tid in range(self.threads):
-                t = threading.Thread(target=self.listen_connections, args=(tid, ss))
+                t = threading.Thread(target=self.listen_connections, args=(tid, self.pending))
                 threads.append(t)
                 t.start()
 
+            self.accept_connections(ss)
+            self.wake_up_waiting()
+
+            for t in threads:
+                self.pending.put(None)
+
             for t in threads:
                 t.join()
 
         with self.lock:
             self.socket = None
 
+        self.shutdown()
+        self.stop_stats_server()
+
     def stop(self):
         '''
-        Stops the server.
+        Stops the server. It takes no lock, since it is usually called by a
+        signal handler on the thread accepting the connections, which may
+        hold the lock while admitting one: the peers waiting for a request
+        are woken up by that thread once accept returns.
+        '''
+
+        logger.info('server has received a signal to stop...')
+        self.stopped = True
+
+        ss = self.socket
+        if ss:
+            try:
+                ss.shutdown(socket.SHUT_RDWR) # wakes up the thread blocked on accept, the socket is closed once it returns
+            except OSError:
+                pass
+
+    def wake_up_waiting(self):
+        '''
+        Wakes up the workers blocked on a peer which keeps its connection
+        open without sending a request, once the server is stopped.
+        '''
+
+        with self.lock:
+            for peer_conn in self.waiting:
+                try:
+                    peer_conn.shutdown(socket.SHUT_RD)
+                except OSError:
+                    pass
+
+    def accept_connections(self, ss):
+        '''
+        Accepts new connections of remote peers and hands them over to the
+        workers. When the server is full, the connection is rejected right away.
+
+        Args:
+            ss (obj): Listening socket object.
+        '''
+
+        while True:
+            try:
+                peer_connection, peer_address = ss.accept()
+
+            except Exception as e:
+                with self.lock:
+                    if self.stopped: # the listening socket has been shut down
+                        return
+
+                self.metrics.increment('errors_total')
+                logger.error('an exception occurred while listening for connections: Exception = %s', e)
+                return
+
+            if not self.admit_connection(peer_connection, peer_address):
+                self.metrics.increment('connections_rejected_total')
+                logger.warning('server is full, rejecting the connection from %s:%s', peer_address[0], peer_address[1])
+                peer_connection.close()
+
+    def admit_connection(self, peer_conn, peer_address):
+        '''
+        Queues a connection for the workers, unless the server has reached
+        its max number of connections or its queue is full.
+
+        Returns:
+            bool: Whether the connection has been admitted.
         '''
 
-        print('server has received a signal to stop...')
         with self.lock:
-            if self.socket:
-                self.socket.close()
-                self.stopped = True
+            if self.max_connections and self.admitted >= self.max_connections:
+                return False
+
+            try:
+                self.pending.put_nowait((peer_conn, peer_address, time.perf_counter_ns()))
+            except queue.Full:
+                return False
+
+            self.admitted += 1
+
+        return True
 
-    def listen_connections(self, worker_id, socket):
+    def listen_connections(self, worker_id, pending):
         '''
-        Accepts new connections of remote peers.
+        Serves the connections admitted by the server, one at a time.
 
         Args:
             worker_id (int): Identifier of the worker (thread).
-            socket (obj): Inherited socket object.
+            pending (obj): Queue of admitted connections, None stops the worker.
         '''
 
         while True:
+            item = pending.get()
+            if item is None:
+                return
+
+            peer_connection, peer_address, accepted_at = item
+            self.metrics.observe('queue_wait_us', (time.perf_counter_ns() - accepted_at) // 1000)
+
             try:
-                peer_connection, peer_address = socket.accept()
                 with peer_connection:
-                    self.handle_connection(worker_id, peer_connection, peer_address)
+                    with self.lock:
+                        if self.stopped:
+                            continue
+
+                    peer_connection.settimeout(self.idle_timeout)
+                    self.serve_connection(worker_id, peer_connection, peer_address)
+
+            except socket.timeout:
+                self.metrics.increment('timeouts_total')
+                logger.warning('worker #%s: connection from %s:%s has timed out', worker_id, peer_address[0], peer_address[1])
 
             except Exception as e:
-                print(f'worker #{worker_id}: an exception occurred while listening for connections: Exception = {e}', file = sys.stderr)
-                return
+                self.metrics.increment('errors_total')
+                logger.warning('worker #%s: an exception occurred while handling a connection from peer %s:%s: Exception = %s', worker_id, peer_address[0], peer_address[1], e)
+
+            finally:
+                with self.lock:
+                    self.admitted -= 1
+
+    def serve_connection(self, worker_id, peer_conn, peer_address):
+        '''
+        Runs the connection handler, keeping track of the active connections,
+        the busy workers and the bytes exchanged with the peer.
+
+        Args:
+            worker_id (int): Identifier of the worker (thread).
+            peer_conn (obj): Inherited socket object.
+            peer_address (tuple): A tuple with the address and port from the remote peer.
+        '''
+
+        self.metrics.increment('connections_accepted_total')
+        self.metrics.increment('connections_active')
+        self.metrics.increment('workers_busy')
+
+        started_at = time.perf_counter_ns()
+
+        try:
+            self.handle_connection(worker_id, metrics.MeteredSocket(peer_conn, self.metrics), peer_address)
+
+        finally:
+            elapsed = (time.perf_counter_ns() - started_at) // 1000
+
+            self.metrics.increment('connections_active', -1)
+            self.metrics.increment('workers_busy', -1)
+            self.metrics.increment(f'worker_{worker_id}_busy_us_total', elapsed)
+            self.metrics.observe('connection_duration_us', elapsed)
 
     def handle_connection(self, worker_id, peer_conn, peer_address):
         '''
@@ -99,7 +324,7 @@ class Server:
         '''
 
         peer_id = f'{peer_address[0]}:{peer_address[1]}'
-        print(f'worker #{worker_id}: handling connection from peer {peer_id}...')
+        logger.debug('worker #%s: handling connection from peer %s...', worker_id, peer_id)
 
         messages_count = 0
 
@@ -108,17 +333,495 @@ class Server:
                 if self.stopped:
                     return
 
+            started_at = None
+
             try:
                 messages_count += 1
 
+                peer_conn.settimeout(self.idle_timeout)
+
                 data = peer_conn.recv(self.payload_size)
                 if not data:
-                    print(f'  > worker #{worker_id}: message #{messages_count}: no content received, closing the connection with {peer_id}...')
+                    logger.debug('  > worker #%s: message #%s: no content received, closing the connection with %s...', worker_id, messages_count, peer_id)
                     return
 
-                print(f'  > worker #{worker_id}: message #{messages_count}: echoing {data} to {peer_id}')
+                started_at = time.perf_counter_ns()
+
+                logger.debug('  > worker #%s: message #%s: echoing %s to %s', worker_id, messages_count, data, peer_id)
+                peer_conn.settimeout(self.io_timeout)
                 peer_conn.sendall(data)
 
+            except socket.timeout:
+                self.report_timeout(worker_id, peer_id, started_at)
+                return
+
             except Exception as e:
-                print(f'worker #{worker_id}: an exception occurred while handling a connection from peer {peer_id}: Exception = {e}', file = sys.stderr)
+                self.metrics.increment('errors_total')
+                logger.warning('worker #%s: an exception occurred while handling a connection from peer %s: Exception = %s', worker_id, peer_id, e)
+                return
+
+    def report_timeout(self, worker_id, peer_id, started_at = None):
+        '''
+        Reports a peer which has been dropped for stalling: either it sent
+        nothing for too long (idle) or it did not take its reply (slow client).
+
+        Args:
+            worker_id (int): Identifier of the worker (thread).
+            peer_id (str): Address and port from the remote peer.
+            started_at (int): When the stalled request has started (perf_counter_ns), None if the peer was idle.
+        '''
+
+        if started_at is None:
+            self.metrics.increment('idle_timeouts_total')
+            logger.debug('worker #%s: peer %s has been idle for too long, closing the connection...', worker_id, peer_id)
+        else:
+            self.metrics.increment('slow_clients_total')
+            logger.warning('worker #%s: peer %s is too slow to receive its reply, closing the connection...', worker_id, peer_id)
+
+
+class FramedMixin:
+    '''
+    FramedMixin holds what the threaded and the asyncio framed servers
+    share: the name of the tier, the frame types it serves as requests and
+    how the trace of a request is started.
+    '''
+
+    NAME = 'server'
+
+    REQUEST_TYPES = (framing.REQUEST,)
+
+    def start_trace(self, frame):
+        '''
+        Starts the trace of a request, carrying on the trace of the
+        downstream tier, whose ID is the request ID.
+
+        Returns:
+            Trace: The trace, with the request as it is handled, or None if the frame is not a request.
+        '''
+
+        traced_type = framing.TRACED_TYPES.get(frame.type)
+
+        debug = traced_type in self.REQUEST_TYPES
+        if debug:
+            frame = frame._replace(type = traced_type)
+
+        if frame.type not in self.REQUEST_TYPES:
+            return None
+
+        return tracing.Trace(self.trace_id(frame), self.NAME, frame, debug)
+
+    def trace_id(self, frame):
+        return frame.request_id
+
+
+class FramedServer(FramedMixin, Server):
+    '''
+    FramedServer serves peers speaking the framing protocol: a connection
+    carries any number of requests, each one answered by a single frame
+    with the same request ID, until the peer closes it.
+
+    Every request is traced (see tracing.Trace): the stages timed by the
+    handler, the handling as a whole and the sending of the reply are logged
+    as a JSON record once it has been sent. A TRACE frame is served as a
+    REQUEST, and a TRACE_INDEX one as an INDEX, and their reply is followed
+    by a TRACE frame with the records.
+    '''
+
+    def handle_connection(self, worker_id, peer_conn, peer_address):
+        while True:
+            with self.lock:
+                if self.stopped:
+                    return
+
+                self.waiting.add(peer_conn)
+
+            try:
+                frame = framing.recv_frame(peer_conn)
+            finally:
+                with self.lock:
+                    self.waiting.discard(peer_conn)
+
+            if frame is None:
+                logger.debug('worker #%s: %s:%s has closed the connection', worker_id, peer_address[0], peer_address[1])
+                return
+
+            trace = self.start_trace(frame)
+            if trace is None:
+                framing.send_frame(peer_conn, framing.ERROR, frame.request_id, f'error: unexpected frame type {frame.type}'.encode())
+                continue
+
+            frame = trace.frame
+            token = tracing.current.set(trace)
+
+            try:
+                with tracing.span('handle'):
+                    frame_type, payload = self.request_handler(worker_id, peer_address, frame)
+
+                try:
+                    with tracing.span('send'):
+                        framing.send_frame(peer_conn, frame_type, frame.request_id, payload)
+                finally:
+                    if isinstance(payload, io.IOBase):
+                        payload.close()
+
+            finally:
+                tracing.current.reset(token)
+
+            records = trace.finish(frame_type)
+            if trace.debug:
+                peer_conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1) # the records leave right after the reply instead of waiting for its delayed ACK
+                framing.send_frame(peer_conn, framing.TRACE, frame.request_id, json.dumps(records).encode())
+
+            self.metrics.increment('requests_total')
+            self.metrics.observe('request_latency_us', (time.perf_counter_ns() - trace.started_at) // 1000)
+
+    def request_handler(self, worker_id, peer_address, frame):
+        '''
+        Builds the reply for a request received from a remote peer.
+
+        Args:
+            worker_id (int): Identifier of the worker (thread).
+            peer_address (tuple): A tuple with the address and port from the remote peer.
+            frame (Frame): The received request.
+
+        Returns:
+            tuple: The type (RESPONSE or ERROR) and the payload of the reply, either bytes or a binary file which is streamed and closed.
+        '''
+
+        raise NotImplementedError('please implement this method')
+
+
+class AsyncServer(BaseServer):
+    '''
+    AsyncServer is the asyncio-native counterpart of Server. Every peer is
+    served by a coroutine on a single event loop, so waiting for the network
+    does not hold a thread.
+
+    For learning purporses, all incoming messages are echoed to its related peer.
+
+    Args:
+        payload_size (int): Max size of an incoming message. Defaults to 1024.
+    '''
+
+    def __init__(self, payload_size = 1024):
+        super().__init__(payload_size)
+
+        self.loop = None
+        self.server = None
+        self.tasks = set()
+
+    def start(self, host, port):
+        '''
+        Starts the server.
+
+        Args:
+            host (str): Interfaces address where the server should listen on.
+            port (int): Port number where the server should listen on.
+        '''
+
+        logger.info('starting the server at %s:%s (asyncio)...', host, port)
+
+        self.start_stats_server(host)
+
+        try:
+            asyncio.run(self.serve(host, port))
+        finally:
+            self.stop_stats_server()
+
+    async def serve(self, host, port):
+        '''
+        Listens for incoming connections until the server is stopped.
+
+        Args:
+            host (str): Interfaces address where the server should listen on.
+            port (int): Port number where the server should listen on.
+        '''
+
+        self.loop = asyncio.get_running_loop()
+        self.server = await asyncio.start_server(self.accept_connection, host, port, reuse_port = True)
+
+        try:
+            async with self.server:
+                await self.server.serve_forever()
+
+        except asyncio.CancelledError:
+            pass
+
+        finally:
+            for task in list(self.tasks):
+                task.cancel()
+
+            await asyncio.gather(*self.tasks, return_exceptions = True)
+            self.shutdown() # on the event loop, which the upstream streams belong to
+
+            self.server = None
+            self.loop = None
+
+    def stop(self):
+        '''
+        Stops the server.
+        '''
+
+        logger.info('server has received a signal to stop...')
+        if self.loop and self.server:
+            self.loop.call_soon_threadsafe(self.server.close)
+
+    async def accept_connection(self, reader, writer):
+        '''
+        Runs the connection handler of a new peer and releases its resources
+        once it has finished.
+
+        Args:
+            reader (obj): Stream where the peer's messages are read from.
+            writer (obj): Stream where the replies are written to.
+        '''
+
+        peer_address = writer.get_extra_info('peername')
+
+        if self.max_connections and len(self.tasks) >= self.max_connections:
+            self.metrics.increment('connections_rejected_total')
+            logger.warning('server is full, rejecting the connection from %s:%s', peer_address[0], peer_address[1])
+            writer.close()
+            return
+
+        task = asyncio.current_task()
+        self.tasks.add(task)
+
+        self.metrics.increment('connections_accepted_total')
+        self.metrics.increment('connections_active')
+
+        started_at = time.perf_counter_ns()
+
+        try:
+            await self.handle_connection(reader, writer, peer_address)
+
+        except asyncio.CancelledError:
+            pass
+
+        except asyncio.TimeoutError:
+            self.metrics.increment('timeouts_total')
+            logger.warning('connection from %s:%s has timed out', peer_address[0], peer_address[1])
+
+        except Exception as e:
+            self.metrics.increment('errors_total')
+            logger.warning('an exception occurred while handling a connection from peer %s:%s: Exception = %s', peer_address[0], peer_address[1], e)
+
+        finally:
+            self.tasks.discard(task)
+            writer.close()
+
+            self.metrics.increment('connections_active', -1)
+            self.metrics.observe('connection_duration_us', (time.perf_counter_ns() - started_at) // 1000)
+
+    async def handle_connection(self, reader, writer, peer_address):
+        '''
+        Handles the connection from a remote peer, extracts the payload and
+        replies with the content built by the request handler.
+
+        Args:
+            reader (obj): Stream where the peer's messages are read from.
+            writer (obj): Stream where the replies are written to.
+            peer_address (tuple): A tuple with the address and port from the remote peer.
+        '''
+
+        peer_id = f'{peer_address[0]}:{peer_address[1]}'
+        logger.debug('handling connection from peer %s...', peer_id)
+
+        messages_count = 0
+
+        while True:
+            messages_count += 1
+
+            data = await asyncio.wait_for(reader.read(self.payload_size), self.idle_timeout)
+            if not data:
+                logger.debug('  > message #%s: no content received, closing the connection with %s...', messages_count, peer_id)
                 return
+
+            writer.write(await self.request_handler(peer_id, messages_count, data))
+            await writer.drain()
+
+    async def request_handler(self, peer_id, messages_count, data):
+        '''
+        Builds the reply for a message received from a remote peer.
+
+        Args:
+            peer_id (str): Address and port from the remote peer.
+            messages_count (int): Sequence number of the message on the connection.
+            data (bytes): The received message.
+
+        Returns:
+            bytes: The content which should be sent back to the peer.
+        '''
+
+        logger.debug('  > message #%s: echoing %s to %s', messages_count, data, peer_id)
+        return data
+
+
+class AsyncFramedServer(FramedMixin, AsyncServer):
+    '''
+    AsyncFramedServer is the asyncio-native counterpart of FramedServer.
+    '''
+
+    async def handle_connection(self, reader, writer, peer_address):
+        while True:
+            frame = await asyncio.wait_for(framing.read_frame(reader), self.idle_timeout)
+            if frame is None:
+                logger.debug('%s:%s has closed the connection', peer_address[0], peer_address[1])
+                return
+
+            trace = self.start_trace(frame)
+            if trace is None:
+                await framing.write_frame(writer, framing.ERROR, frame.request_id, f'error: unexpected frame type {frame.type}'.encode())
+                continue
+
+            frame = trace.frame
+            token = tracing.current.set(trace)
+
+            try:
+                with tracing.span('handle'):
+                    frame_type, payload = await self.request_handler(peer_address, frame)
+
+                try:
+                    with tracing.span('send'):
+                        await framing.write_frame(writer, frame_type, frame.request_id, payload)
+                finally:
+                    if isinstance(payload, io.IOBase):
+                        payload.close()
+
+            finally:
+                tracing.current.reset(token)
+
+            records = trace.finish(frame_type)
+            if trace.debug:
+                await framing.write_frame(writer, framing.TRACE, frame.request_id, json.dumps(records).encode())
+
+            self.metrics.increment('requests_total')
+            self.metrics.observe('request_latency_us', (time.perf_counter_ns() - trace.started_at) // 1000)
+
+    async def request_handler(self, peer_address, frame):
+        '''
+        Builds the reply for a request received from a remote peer.
+
+        Args:
+            peer_address (tuple): A tuple with the address and port from the remote peer.
+            frame (Frame): The received request.
+
+        Returns:
+            tuple: The type (RESPONSE or ERROR) and the payload of the reply.
+        '''
+
+        raise NotImplementedError('please implement this method')
+
+
+class Supervisor:
+    '''
+    Supervisor forks a number of worker processes, each one running its own
+    accept loop of the same server. Since the listening sockets are created
+    with SO_REUSEPORT, every worker binds to the same port and the kernel
+    balances the incoming connections among them, so the server is no longer
+    bound to a single core.
+
+    Crashed workers are restarted and the stop signal is forwarded to all of
+    them.
+
+    Args:
+        server (obj): Server which is run by every worker.
+        workers (int): Number of worker processes. Defaults to 2.
+        restart_delay (float): Seconds to wait before restarting a crashed worker. Defaults to 1.
+    '''
+
+    def __init__(self, server, workers = 2, restart_delay = 1.0):
+        self.server = server
+        self.workers = workers
+        self.restart_delay = restart_delay
+
+        self.pid = os.getpid()
+        self.children = {}
+        self.stopped = True
+
+    def start(self, host, port):
+        '''
+        Starts the workers and supervises them until the server is stopped.
+
+        Args:
+            host (str): Interfaces address where the server should listen on.
+            port (int): Port number where the server should listen on.
+        '''
+
+        logger.info('starting %s workers at %s:%s...', self.workers, host, port)
+        self.stopped = False
+
+        for worker_id in range(self.workers):
+            self.spawn(worker_id, host, port)
+
+        while self.children:
+            try:
+                pid, status = os.wait()
+            except ChildProcessError:
+                break
+
+            worker_id = self.children.pop(pid, None)
+            if worker_id is None:
+                continue
+
+            exit_code = os.waitstatus_to_exitcode(status)
+            if self.stopped or exit_code == 0:
+                logger.info('worker #%s (pid %s) has exited', worker_id, pid)
+                continue
+
+            logger.error('worker #%s (pid %s) has crashed with exit code %s, restarting it...', worker_id, pid, exit_code)
+            time.sleep(self.restart_delay)
+
+            if not self.stopped:
+                self.spawn(worker_id, host, port)
+
+    def stop(self):
+        '''
+        Stops the server, forwarding the signal to every worker.
+        '''
+
+        if os.getpid() != self.pid:
+            return
+
+        logger.info('supervisor has received a signal to stop...')
+        self.stopped = True
+
+        for pid in list(self.children):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    def spawn(self, worker_id, host, port):
+        '''
+        Forks a new worker process which runs the server.
+
+        Args:
+            worker_id (int): Identifier of the worker (process).
+            host (str): Interfaces address where the server should listen on.
+            port (int): Port number where the server should listen on.
+        '''
+
+        pid = os.fork()
+        if pid > 0:
+            self.children[pid] = worker_id
+            return
+
+        for ss in [signal.SIGINT, signal.SIGTERM]:
+            signal.signal(ss, lambda received_signal, frame: self.server.stop())
+
+        if self.server.stats_port:
+            self.server.stats_port += worker_id # every worker serves its own metrics
+
+        exit_code = 0
+
+        try:
+            self.server.start(host, port)
+
+        except Exception as e:
+            logger.error('worker #%s: an exception occurred while running the server: Exception = %s', worker_id, e)
+            exit_code = 1
+
+        finally:
+            log.shutdown()
+            os._exit(exit_code)
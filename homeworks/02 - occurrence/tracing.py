@@ -0,0 +1,269 @@
+import contextlib
+import contextvars
+import json
+import logging
+import random
+import threading
+import time
+
+import framing
+import log
+
+
+logger = log.get_logger('trace')
+
+FRAME_TYPES = {framing.REQUEST: 'request', framing.STAT: 'stat', framing.LIST: 'list', framing.INDEX: 'index'}
+
+# the type of a request whose records are wanted back, such as TRACE for REQUEST
+DEBUG_TYPES = {frame_type: debug_type for debug_type, frame_type in framing.TRACED_TYPES.items()}
+
+MAX_LOGGED_REQUEST = 256
+
+# the trace of the request being handled, set by the servers for the thread or the task handling it
+current = contextvars.ContextVar('trace', default = None)
+
+
+def new_trace_id():
+    '''
+    Generates the ID of a trace. It is random rather than sequential, since
+    several processes may serve the same tier, and it fits the request ID of
+    a frame header so it is carried to the upstream tiers as is.
+    '''
+
+    return random.getrandbits(32) or 1
+
+
+class Trace:
+    '''
+    Trace keeps the timings of the stages of a request on a tier, as spans
+    named after the stage. A stage run several times by the same request,
+    such as receiving the chunks of a file, is summed up in a single span.
+
+    The trace ID is generated by the Interface Server and sent as the
+    request ID of the frames to the upstream tiers, so the records of the
+    three tiers for a request share the same ID.
+
+    The spans are only timed when the record is wanted, either logged or
+    sent back, so tracing costs next to nothing when the "trace" logger is
+    above the info level; the trace ID is carried to the upstream tiers
+    anyway.
+
+    Args:
+        trace_id (int): Identifier of the trace.
+        tier (str): Name of the tier, such as "interface".
+        frame (Frame): The request being traced.
+        debug (bool): Whether the span records of every tier are sent back to the peer in a TRACE frame. Defaults to False.
+    '''
+
+    def __init__(self, trace_id, tier, frame, debug = False):
+        self.trace_id = trace_id
+        self.tier = tier
+        self.frame = frame
+        self.debug = debug
+
+        self.logged = logger.isEnabledFor(logging.INFO)
+        self.recording = self.logged or debug
+
+        self.lock = threading.Lock() # the files of a multi-file request are fetched by several threads
+        self.started_at = time.perf_counter_ns()
+        self.spans = {} # stage -> nanoseconds
+        self.upstream = [] # records returned by the upstream tiers, for a debug trace
+
+    def add(self, name, elapsed):
+        with self.lock:
+            self.spans[name] = self.spans.get(name, 0) + elapsed
+
+    def record(self, frame_type):
+        '''
+        Builds the record of the trace once the reply has been sent.
+
+        Args:
+            frame_type (int): Type of the reply, RESPONSE or ERROR.
+
+        Returns:
+            dict: The trace ID, the tier, the request and the spans in microseconds.
+        '''
+
+        with self.lock:
+            spans = {name: elapsed // 1000 for name, elapsed in self.spans.items()}
+
+        return {
+            'trace_id': f'{self.trace_id:08x}',
+            'tier': self.tier,
+            'type': FRAME_TYPES.get(self.frame.type, self.frame.type),
+            'request': str(self.frame.payload[:MAX_LOGGED_REQUEST], encoding = 'utf-8', errors = 'replace'),
+            'status': 'ok' if frame_type == framing.RESPONSE else 'error',
+            'total_us': (time.perf_counter_ns() - self.started_at) // 1000,
+            'spans': spans,
+        }
+
+    def finish(self, frame_type):
+        '''
+        Logs the record of the trace as JSON on the "trace" logger, at the
+        info level.
+
+        Returns:
+            list: The record of this tier followed by the ones of the upstream tiers, empty if it is not recorded.
+        '''
+
+        if not self.recording:
+            return []
+
+        record = self.record(frame_type)
+        if self.logged:
+            logger.info('%s', json.dumps(record))
+
+        return [record] + self.upstream
+
+
+class Span:
+    '''
+    Span times the enclosed block as a stage of a trace.
+    '''
+
+    __slots__ = ('trace', 'name', 'started_at')
+
+    def __init__(self, trace, name):
+        self.trace = trace
+        self.name = name
+
+    def __enter__(self):
+        self.started_at = time.perf_counter_ns()
+
+    def __exit__(self, *exc_info):
+        self.trace.add(self.name, time.perf_counter_ns() - self.started_at)
+
+
+NO_SPAN = contextlib.nullcontext()
+
+
+def span(name):
+    '''
+    Times the enclosed block as the span "name" of the current trace, if it
+    is recorded.
+    '''
+
+    trace = current.get()
+    if trace is None or not trace.recording:
+        return NO_SPAN
+
+    return Span(trace, name)
+
+def timed(iterable, name):
+    '''
+    Yields the items of "iterable", timing the waits for the next item as
+    the span "name" of the current trace, such as the chunks of a payload
+    received from the network.
+    '''
+
+    trace = current.get()
+    if trace is None or not trace.recording:
+        yield from iterable
+        return
+
+    iterator = iter(iterable)
+
+    elapsed = 0
+
+    try:
+        while True:
+            started_at = time.perf_counter_ns()
+
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+            finally:
+                elapsed += time.perf_counter_ns() - started_at
+
+            yield item
+
+    finally:
+        trace.add(name, elapsed)
+
+async def timed_async(iterable, name):
+    '''
+    Yields the items of an asynchronous "iterable", as timed does.
+    '''
+
+    trace = current.get()
+    if trace is None or not trace.recording:
+        async for item in iterable:
+            yield item
+
+        return
+
+    iterator = aiter(iterable)
+
+    elapsed = 0
+
+    try:
+        while True:
+            started_at = time.perf_counter_ns()
+
+            try:
+                item = await anext(iterator)
+            except StopAsyncIteration:
+                return
+            finally:
+                elapsed += time.perf_counter_ns() - started_at
+
+            yield item
+
+    finally:
+        trace.add(name, elapsed)
+
+def upstream_request_id():
+    '''
+    Returns the request ID of a frame sent to the upstream tier: the ID of
+    the current trace, so the upstream records can be joined with it.
+    '''
+
+    trace = current.get()
+    return trace.trace_id if trace else 1
+
+def upstream_request_type(frame_type = framing.REQUEST):
+    '''
+    Returns the type of a request sent to the upstream tier: its traced
+    variant while serving a debug trace, such as TRACE for REQUEST, so the
+    upstream tier sends its records back too, otherwise "frame_type".
+    '''
+
+    trace = current.get()
+    return DEBUG_TYPES[frame_type] if trace and trace.debug else frame_type
+
+def keep_upstream_records(frame):
+    '''
+    Keeps the records sent back by the upstream tier in the TRACE frame
+    following the reply to a debug trace.
+    '''
+
+    if frame is None:
+        raise ConnectionError('upstream service has closed the connection')
+
+    if frame.type != framing.TRACE:
+        raise framing.ProtocolError(f'expected the trace of request #{frame.request_id}, got a frame of type {frame.type}')
+
+    current.get().upstream.extend(json.loads(frame.payload))
+
+def recv_upstream_records(conn):
+    '''
+    Receives the records of the upstream tier while serving a debug trace,
+    after the reply to a request sent with upstream_request_type.
+
+    Args:
+        conn (obj): The connection with the upstream tier.
+    '''
+
+    trace = current.get()
+    if trace and trace.debug:
+        keep_upstream_records(framing.recv_frame(conn))
+
+async def read_upstream_records(reader):
+    '''
+    Reads the records of the upstream tier from an asyncio stream, as recv_upstream_records does.
+    '''
+
+    trace = current.get()
+    if trace and trace.debug:
+        keep_upstream_records(await framing.read_frame(reader))
@@ -1,25 +1,31 @@
 #!/usr/bin/env python3
 
 import argparse
-import csv
-import io
+import framing
+import heapq
+import itertools
+import occurrences
 import socket
 import sys
 import os
 
 
-def format_user_response(content):
+# words requested to the Processing Server, which selects them so the response does not grow with the vocabulary
+TOP_WORDS = 10
+
+
+def format_user_response(count):
     '''
-    Decode the CSV, sort the occurrences and filter the top 10 words that appeared the most.
+    Sort the occurrences and filter the top 10 words that appeared the most.
 
     Args:
-        content (str): A CSV str content.
+        count (dict): Contains the word as a key and it's occurence as a value.
 
     Returns:
         str: A string that will be sent to the client.
     '''
 
-    top10 = filter_top10_occurrences(decode_word_occurrences_from_csv(content))
+    top10 = filter_top10_occurrences(count)
 
     response = f'WORD\t\tOCCURRENCES{os.linesep}'
     for item in top10:
@@ -39,59 +45,7 @@ def filter_top10_occurrences(count):
         first by the most occurrence and, if needed a lexicographical order (in case two words tie).
     '''
 
-    count_by_occurrences = aggregate_words_by_occurrence(count)
-
-    desc_occurrences = list(count_by_occurrences.keys())
-    desc_occurrences.sort(reverse = True)
-
-    result = []
-    for occurrence in desc_occurrences:
-        words = count_by_occurrences[occurrence]
-        words.sort()
-
-        for word in words:
-            if len(result) == 10:
-                return result
-
-            item = (word, occurrence)
-            result.append(item)
-
-    return result
-
-def aggregate_words_by_occurrence(count):
-    '''
-    Aggregate word with the same count on the same "structure", so they don't "compete" with each other.
-
-    Args:
-        count (dict): Contains the word as a key and it's occurence as a value.
-
-    Returns:
-        dict: Contains the words as values and their ocurrences as keys.
-    '''
-
-    count_by_occurrences = {}
-    for word, occurrences in count.items():
-        count_by_occurrences[occurrences] = count_by_occurrences.get(occurrences, []) + [word]
-
-    return count_by_occurrences
-
-def decode_word_occurrences_from_csv(content):
-    '''
-    Decodes a received CSV to a dict.
-
-    Args:
-        count (csv): A received CSV.
-
-    Returns:
-        dict: Contains the words as keys and their ocurrences as values.
-    '''
-
-    count = {}
-    for row in csv.reader(io.StringIO(content)):
-        word, occurrences = row[0], int(row[1])
-        count[word] = occurrences
-
-    return count
+    return heapq.nsmallest(10, count.items(), key = lambda item: (-item[1], item[0]))
 
 
 class Client:
@@ -102,10 +56,12 @@ class Client:
 
     Args:
         payload_size (int): Max size of an incoming message. Defaults to 1024.
+        encoding (str): Encoding of the word occurrences requested to the server, one of occurrences.ENCODINGS. Defaults to binary.
     '''
 
-    def __init__(self, payload_size = 1024):
+    def __init__(self, payload_size = 1024, encoding = occurrences.BINARY):
         self.payload_size = payload_size
+        self.encoding = encoding
 
     def connect_on_server(self, address, port, input_file = sys.stdin, output_file = sys.stdout):
         '''
@@ -126,26 +82,30 @@ class Client:
                 print(f'an exception occurred while connecting on remote server: Exception = {e}', file = sys.stderr)
                 return
 
+            request_ids = itertools.count(1)
+
             for sent_message in input_file:
                 sent_message = sent_message.rstrip(os.linesep)
 
                 if not sent_message:
                     continue
 
-                ss.sendall(sent_message.encode())
+                request_id = next(request_ids)
+                framing.send_frame(ss, framing.REQUEST, request_id, framing.encode_query(sent_message, top = TOP_WORDS, encoding = self.encoding))
 
-                content = ''
-                while True:
-                    received_message = ss.recv(self.payload_size)
-                    if not received_message:
-                        break
+                reply = framing.recv_frame(ss)
+                if reply is None:
+                    print('remote server has closed the connection', file = sys.stderr)
+                    break
 
-                    content += str(received_message, encoding = 'utf-8')
+                if reply.request_id != request_id:
+                    raise framing.ProtocolError(f'expected the reply of request #{request_id}, got #{reply.request_id}')
 
-                    if len(received_message) < self.payload_size:
-                        break
+                if reply.type == framing.ERROR:
+                    print(str(reply.payload, encoding = 'utf-8'), file = output_file)
+                    continue
 
-                print(format_user_response(content), file = output_file)
+                print(format_user_response(occurrences.decode_word_occurrences(reply.payload, self.encoding)), file = output_file)
 
 
         print(f'closing connection with {address}:{port}...')
@@ -156,7 +116,8 @@ if __name__ == '__main__':
 
     parser.add_argument('--host', '-H', type = str, default = 'localhost', help = 'remote server\'s address (default localhost)')
     parser.add_argument('--port', '-p', type = int, default = 8080, help = 'remote server\'s port (default 8080)')
+    parser.add_argument('--encoding', type = str, default = occurrences.BINARY, choices = occurrences.ENCODINGS, help = 'encoding of the word occurrences requested to the server (default binary)')
 
     args = parser.parse_args()
 
-    Client().connect_on_server(args.host, args.port)
\ No newline at end of file
+    Client(encoding = args.encoding).connect_on_server(args.host, args.port)
\ No newline at end of file
@@ -4,14 +4,20 @@ import argparse
 import os
 import pathlib
 import signal
-import sys
 
+import framing
+import log
 import server
 
+from cache import ResultCache
+from indexer import Indexer, file_version
 
-def read_file(path):
-    with open(path, 'r') as fh:
-        return fh.read()
+
+logger = log.get_logger(__name__)
+
+
+def open_file(path):
+    return open(path, 'rb')
 
 
 class Data(server.Server):
@@ -26,48 +32,160 @@ class Data(server.Server):
 
     ERROR_FILE_NOT_FOUND        = 'error: file not found'
     ERROR_INTERNAL_SERVER_ERROR = 'error: internal server error'
+    ERROR_NOT_INDEXED           = 'error: not indexed'
 
-    def __init__(self, data_dir, payload_size = 1024):
-        super().__init__(payload_size = payload_size)
+    REQUEST_TYPES = (framing.REQUEST, framing.STAT, framing.INDEX)
+
+    def __init__(self, data_dir, payload_size = 1024, cache = None, max_cached_file_size = 1024 * 1024, indexer = None, threads = 16, max_pending = 64):
+        super().__init__(payload_size = payload_size, threads = threads, max_pending = max_pending)
         self.data_dir = data_dir
 
-    def request_handler(self, peer_conn, peer_address, data = ''):
-        message = ''
+        self.cache = cache or ResultCache(max_bytes = 0)
+        self.max_cached_file_size = max_cached_file_size
+
+        self.indexer = indexer
+
+    def stop(self):
+        super().stop()
+
+        if self.cache.max_bytes:
+            logger.info('file cache: %s', self.cache.stats())
+
+    def request_handler(self, peer_address, frame):
+        if frame.type == framing.STAT:
+            return self.stat_handler(peer_address, frame)
+
+        if frame.type == framing.INDEX:
+            return self.index_handler(peer_address, frame)
+
+        try:
+            filename = str(frame.payload, encoding = 'utf-8')
+            logger.info('  > %s:%s has requested the %s file', peer_address[0], peer_address[1], filename)
+
+            path = pathlib.Path(self.data_dir, filename)
+
+            content = self.load_cached_file(path)
+            if content is not None:
+                return framing.RESPONSE, content
+
+            return framing.RESPONSE, open_file(path) # streamed with sendfile by the event loop, whatever the file size
+
+        except FileNotFoundError as e:
+            return framing.ERROR, Data.ERROR_FILE_NOT_FOUND.encode()
+
+        except Exception as e:
+            logger.error('an exception occurred while reading file %s: Exception = %s', filename, e)
+            return framing.ERROR, Data.ERROR_INTERNAL_SERVER_ERROR.encode()
+
+    def load_cached_file(self, path):
+        '''
+        Reads a small file through the cache, which is refreshed when the
+        file has changed. Serving a cached file costs a stat instead of
+        opening, sending and closing it.
+
+        Args:
+            path (obj): Path of the file.
+
+        Returns:
+            bytes: The content of the file, or None if it is too large to be cached.
+        '''
+
+        if not self.cache.max_bytes:
+            return None
+
+        stat = os.stat(path)
+        if stat.st_size > self.max_cached_file_size:
+            return None
+
+        key, version = str(path), file_version(stat)
+
+        content = self.cache.get(key, version)
+        if content is None:
+            with open_file(path) as fh:
+                content = fh.read()
+
+            self.cache.put(key, version, content)
+
+        return content
+
+    def stat_handler(self, peer_address, frame):
+        '''
+        Replies with the version of a file (see file_version), without reading it.
+        '''
 
         try:
-            filename = data.rstrip(os.linesep)
-            print(f'  > {peer_address[0]}:{peer_address[1]} has requested the {filename} file', file = sys.stderr)
+            filename = str(frame.payload, encoding = 'utf-8')
+            logger.debug('  > %s:%s has requested the version of the %s file', peer_address[0], peer_address[1], filename)
 
-            message = read_file(pathlib.Path(self.data_dir, filename))
+            stat = os.stat(pathlib.Path(self.data_dir, filename))
 
         except FileNotFoundError as e:
-            message = Data.ERROR_FILE_NOT_FOUND
+            return framing.ERROR, Data.ERROR_FILE_NOT_FOUND.encode()
 
         except Exception as e:
-            message = Data.ERROR_INTERNAL_SERVER_ERROR
-            print(f'an exception occurred while reading file {filename}: Exception = {e}', file = sys.stderr)
+            logger.error('an exception occurred while reading file %s: Exception = %s', filename, e)
+            return framing.ERROR, Data.ERROR_INTERNAL_SERVER_ERROR.encode()
+
+        return framing.RESPONSE, file_version(stat)
+
+    def index_handler(self, peer_address, frame):
+        '''
+        Replies with the precomputed word occurrences of a file (see
+        Indexer), as long as its index is as recent as the file and fits in
+        a frame.
+        '''
 
-        finally:
-            peer_conn.send(f'{message}{os.linesep}'.encode())
-            peer_conn.close()
+        try:
+            filename = str(frame.payload, encoding = 'utf-8')
+            logger.info('  > %s:%s has requested the index of the %s file', peer_address[0], peer_address[1], filename)
+
+            stat = os.stat(pathlib.Path(self.data_dir, filename))
+            payload = self.indexer.lookup(filename, file_version(stat)) if self.indexer else None
+
+        except FileNotFoundError as e:
+            return framing.ERROR, Data.ERROR_FILE_NOT_FOUND.encode()
+
+        except Exception as e:
+            logger.error('an exception occurred while reading the index of file %s: Exception = %s', filename, e)
+            return framing.ERROR, Data.ERROR_INTERNAL_SERVER_ERROR.encode()
 
-    @staticmethod
-    def is_error(message):
-        return Data.ERROR_INTERNAL_SERVER_ERROR in message or Data.ERROR_FILE_NOT_FOUND in message
+        if payload is None or len(payload) > framing.MAX_PAYLOAD_SIZE: # the file is counted instead
+            return framing.ERROR, Data.ERROR_NOT_INDEXED.encode()
 
+        return framing.RESPONSE, payload
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description = 'starts the data server')
 
     parser.add_argument('--host', '-H', type = str, default = 'localhost', help = 'local address (default localhost)')
     parser.add_argument('--port', '-p', type = int, default = 8080, help = 'local port (default 8080)')
+    parser.add_argument('--threads', '-t', type = int, default = 16, help = 'number of worker threads, each one handling a request at a time (default 16)')
+    parser.add_argument('--max-pending', type = int, default = 64, help = 'max number of requests waiting for a free thread, the extra ones are answered with an error, 0 means no limit (default 64)')
     parser.add_argument('--data-dir', type = str, default = './files', help = 'path at filesystem which the files are stored (default ./files)')
+    parser.add_argument('--cache-size', type = int, default = 64 * 1024 * 1024, help = 'memory budget in bytes of the cached small files, 0 disables the cache (default 64 MiB)')
+    parser.add_argument('--cache-max-file-size', type = int, default = 1024 * 1024, help = 'max size in bytes of a cached file, the larger ones are streamed from the disk (default 1 MiB)')
+    parser.add_argument('--index-dir', type = str, default = None, help = 'path at filesystem where the word occurrences of every file are indexed in the background, none disables the index (default none)')
+    parser.add_argument('--index-interval', type = float, default = 5, help = 'seconds between two scans of the data dir for new and changed files to index (default 5)')
+    parser.add_argument('--index-cache-size', type = int, default = 16 * 1024 * 1024, help = 'memory budget in bytes of the index files kept in memory, 0 disables it (default 16 MiB)')
+    parser.add_argument('--log-level', type = str, default = 'info', choices = log.LEVELS, help = 'min level of the logged messages, debug traces every message (default info)')
+    parser.add_argument('--log-sample', type = float, default = 1.0, help = 'fraction of the debug and info messages which are logged (default 1)')
 
     args = parser.parse_args()
 
-    server = Data(data_dir = args.data_dir)
+    log.setup(level = args.log_level, sample_rate = args.log_sample)
+
+    cache = ResultCache(max_bytes = args.cache_size)
+    indexer = Indexer(args.data_dir, args.index_dir, interval = args.index_interval, cache_size = args.index_cache_size) if args.index_dir else None
+
+    server = Data(data_dir = args.data_dir, cache = cache, max_cached_file_size = args.cache_max_file_size, indexer = indexer, threads = args.threads, max_pending = args.max_pending)
 
     for ss in [signal.SIGINT, signal.SIGTERM]:
         signal.signal(ss, lambda received_signal, frame: server.stop())
 
-    server.start(host = args.host, port = args.port)
\ No newline at end of file
+    if indexer:
+        indexer.start()
+
+    server.start(host = args.host, port = args.port)
+
+    if indexer:
+        indexer.stop()
\ No newline at end of file
@@ -0,0 +1,317 @@
+import asyncio
+import collections
+import io
+import json
+import os
+import socket
+import struct
+
+
+# every frame starts with its type, the request ID and the payload length
+HEADER = struct.Struct('!BIQ')
+
+REQUEST  = 1 # payload: the requested file name, or a query (see encode_query)
+RESPONSE = 2 # payload: the reply content
+ERROR    = 3 # payload: the error message
+STAT     = 4 # payload: a file name, answered with the version of the file
+LIST     = 5 # payload: a glob pattern, answered with the matching file names, one per line
+INDEX    = 6 # payload: a file name, answered with its precomputed word occurrences (binary-zlib), or an error if it has not been indexed
+TRACE    = 7 # payload: as REQUEST, answered as REQUEST then with a TRACE frame carrying the span records of every tier as JSON
+TRACE_INDEX = 8 # payload: as INDEX, answered as INDEX then with a TRACE frame
+
+# the frame types served as another type, whose reply is followed by a TRACE frame
+TRACED_TYPES = {TRACE: REQUEST, TRACE_INDEX: INDEX}
+
+MAX_PAYLOAD_SIZE = 64 * 1024 * 1024
+
+CHUNK_SIZE = 64 * 1024
+
+Frame = collections.namedtuple('Frame', ['type', 'request_id', 'payload'])
+
+
+class ProtocolError(Exception):
+    '''
+    Raised when the peer sends something which is not a valid frame.
+    '''
+
+
+def payload_size(payload):
+    '''
+    Returns the size of a payload, which is either bytes or a binary file.
+    '''
+
+    if isinstance(payload, io.IOBase):
+        return os.fstat(payload.fileno()).st_size
+
+    return len(payload)
+
+def encode_query(filename, **options):
+    '''
+    Encodes the payload of a request carrying options besides the file name.
+
+    Args:
+        filename (str): The requested file name.
+        options (dict): Options of the request, such as "top", the number of words wanted, or "encoding".
+
+    Returns:
+        bytes: The query as JSON.
+    '''
+
+    return json.dumps({'filename': filename, **options}).encode()
+
+def decode_query(payload):
+    '''
+    Decodes the payload of a request. A bare file name is a query without options.
+
+    Args:
+        payload (bytes): The payload of a REQUEST frame.
+
+    Returns:
+        dict: The query, with the file name at "filename".
+    '''
+
+    try:
+        text = str(payload, encoding = 'utf-8')
+    except UnicodeDecodeError as e:
+        raise ProtocolError(f'invalid query: {e}')
+
+    if not text.startswith('{'):
+        return {'filename': text}
+
+    try:
+        query = json.loads(text)
+    except ValueError as e:
+        raise ProtocolError(f'invalid query: {e}')
+
+    if not isinstance(query, dict) or not isinstance(query.get('filename'), str):
+        raise ProtocolError('invalid query: the file name is missing')
+
+    top = query.get('top')
+    if top is not None and (not isinstance(top, int) or isinstance(top, bool) or top < 1):
+        raise ProtocolError(f'invalid query: "top" must be a positive integer, got {top!r}')
+
+    return query
+
+def encode_frame(frame_type, request_id, payload = b''):
+    '''
+    Encodes a frame.
+
+    Args:
+        frame_type (int): One of REQUEST, RESPONSE or ERROR.
+        request_id (int): Identifier of the request, replies carry the ID of the request they answer.
+        payload (bytes): The frame content.
+
+    Returns:
+        bytes: The header followed by the payload.
+    '''
+
+    return HEADER.pack(frame_type, request_id, len(payload)) + payload
+
+def decode_header(header, max_size = MAX_PAYLOAD_SIZE):
+    '''
+    Decodes a frame header.
+
+    Args:
+        header (bytes): The first HEADER.size bytes of a frame.
+        max_size (int): Max accepted payload length, None means no limit. Defaults to MAX_PAYLOAD_SIZE.
+
+    Returns:
+        tuple: The frame type, the request ID and the payload length.
+    '''
+
+    frame_type, request_id, length = HEADER.unpack(header)
+
+    if max_size is not None and length > max_size:
+        raise ProtocolError(f'frame of {length} bytes exceeds the limit of {max_size} bytes')
+
+    return frame_type, request_id, length
+
+def recv_exactly(conn, size):
+    '''
+    Reads exactly "size" bytes from a socket, however the peer has split them.
+
+    Args:
+        conn (obj): A connected socket object.
+        size (int): Number of bytes to read.
+
+    Returns:
+        bytes: The read bytes, or None if the peer has closed the connection before sending any.
+    '''
+
+    buffer = bytearray(size)
+    view = memoryview(buffer)
+
+    received = 0
+    while received < size:
+        count = conn.recv_into(view[received:])
+        if not count:
+            if received:
+                raise ProtocolError(f'connection closed after {received} of {size} bytes')
+
+            return None
+
+        received += count
+
+    return bytes(buffer)
+
+def recv_header(conn, max_size = MAX_PAYLOAD_SIZE):
+    '''
+    Reads the header of the next frame from a socket, leaving its payload
+    on the socket so it can be consumed with recv_chunks.
+
+    Args:
+        conn (obj): A connected socket object.
+        max_size (int): Max accepted payload length, None means no limit. Defaults to MAX_PAYLOAD_SIZE.
+
+    Returns:
+        tuple: The frame type, the request ID and the payload length, or None if the peer has closed the connection.
+    '''
+
+    header = recv_exactly(conn, HEADER.size)
+    if header is None:
+        return None
+
+    return decode_header(header, max_size)
+
+def recv_chunks(conn, length, chunk_size = CHUNK_SIZE):
+    '''
+    Yields the payload of a frame as it arrives, so it can be processed
+    while the rest is still on the network. Every chunk is a view of the
+    same buffer, it must be consumed before the next one is read.
+
+    Args:
+        conn (obj): A connected socket object.
+        length (int): The payload length, as read from the header.
+        chunk_size (int): Max size of a chunk. Defaults to CHUNK_SIZE.
+    '''
+
+    view = memoryview(bytearray(min(length, chunk_size)))
+
+    remaining = length
+    while remaining:
+        count = conn.recv_into(view, min(remaining, len(view)))
+        if not count:
+            raise ProtocolError(f'connection closed with {remaining} bytes of the payload still missing')
+
+        remaining -= count
+        yield view[:count]
+
+def recv_frame(conn, max_size = MAX_PAYLOAD_SIZE):
+    '''
+    Reads the next frame from a socket.
+
+    Args:
+        conn (obj): A connected socket object.
+        max_size (int): Max accepted payload length, None means no limit. Defaults to MAX_PAYLOAD_SIZE.
+
+    Returns:
+        Frame: The received frame, or None if the peer has closed the connection.
+    '''
+
+    header = recv_header(conn, max_size)
+    if header is None:
+        return None
+
+    frame_type, request_id, length = header
+
+    payload = recv_exactly(conn, length) if length else b''
+    if payload is None:
+        raise ProtocolError(f'connection closed before the payload of request #{request_id}')
+
+    return Frame(frame_type, request_id, payload)
+
+def send_frame(conn, frame_type, request_id, payload = b''):
+    '''
+    Sends a frame. A file payload is streamed with sendfile, so the kernel
+    copies it from the page cache straight to the socket and the memory
+    used does not depend on the file size.
+
+    Args:
+        conn (obj): A connected socket object.
+        frame_type (int): One of REQUEST, RESPONSE or ERROR.
+        request_id (int): Identifier of the request.
+        payload (bytes): The frame content, either bytes or a file opened in binary mode.
+    '''
+
+    if not isinstance(payload, io.IOBase):
+        conn.sendall(encode_frame(frame_type, request_id, payload))
+        return
+
+    size = payload_size(payload)
+    conn.sendall(HEADER.pack(frame_type, request_id, size), getattr(socket, 'MSG_MORE', 0)) # lets the header leave with the first chunk
+
+    if size and conn.sendfile(payload, 0, size) != size:
+        raise ProtocolError('file has been truncated while it was being sent')
+
+async def read_header(reader, max_size = MAX_PAYLOAD_SIZE):
+    '''
+    Reads the header of the next frame from an asyncio stream, as recv_header does.
+    '''
+
+    header = await reader.read(HEADER.size)
+    if not header:
+        return None
+
+    if len(header) < HEADER.size:
+        header += await reader.readexactly(HEADER.size - len(header))
+
+    return decode_header(header, max_size)
+
+async def read_frame(reader, max_size = MAX_PAYLOAD_SIZE):
+    '''
+    Reads the next frame from an asyncio stream.
+
+    Args:
+        reader (obj): Stream where the frames are read from.
+        max_size (int): Max accepted payload length, None means no limit. Defaults to MAX_PAYLOAD_SIZE.
+
+    Returns:
+        Frame: The received frame, or None if the peer has closed the connection.
+    '''
+
+    header = await read_header(reader, max_size)
+    if header is None:
+        return None
+
+    frame_type, request_id, length = header
+
+    payload = await reader.readexactly(length) if length else b''
+    return Frame(frame_type, request_id, payload)
+
+async def read_chunks(reader, length, chunk_size = CHUNK_SIZE):
+    '''
+    Yields the payload of a frame from an asyncio stream as it arrives, as recv_chunks does.
+    '''
+
+    remaining = length
+    while remaining:
+        chunk = await reader.read(min(remaining, chunk_size))
+        if not chunk:
+            raise ProtocolError(f'connection closed with {remaining} bytes of the payload still missing')
+
+        remaining -= len(chunk)
+        yield chunk
+
+async def write_frame(writer, frame_type, request_id, payload = b''):
+    '''
+    Writes a frame on an asyncio stream. As in send_frame, a file payload
+    is streamed with sendfile.
+
+    Args:
+        writer (obj): Stream where the frame is written to.
+        frame_type (int): One of REQUEST, RESPONSE or ERROR.
+        request_id (int): Identifier of the request.
+        payload (bytes): The frame content, either bytes or a file opened in binary mode.
+    '''
+
+    if not isinstance(payload, io.IOBase):
+        writer.write(encode_frame(frame_type, request_id, payload))
+        await writer.drain()
+        return
+
+    size = payload_size(payload)
+    writer.write(HEADER.pack(frame_type, request_id, size))
+    await writer.drain()
+
+    if size and await asyncio.get_running_loop().sendfile(writer.transport, payload, 0, size) != size:
+        raise ProtocolError('file has been truncated while it was being sent')
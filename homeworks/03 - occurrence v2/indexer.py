@@ -0,0 +1,273 @@
+#!/usr/bin/env python3
+
+import argparse
+import json
+import log
+import occurrences
+import os
+import pathlib
+import threading
+import time
+
+from cache import ResultCache
+from words import WordCounter
+
+
+logger = log.get_logger(__name__)
+
+INDEX_SUFFIX = '.idx'
+
+READ_SIZE = 1024 * 1024
+
+
+def file_version(stat):
+    '''
+    Builds the version of a file from its inode, size and modification
+    time. Any change of the content changes the version, so it can tag
+    what has been computed from the file.
+    '''
+
+    return json.dumps({'inode': stat.st_ino, 'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}).encode()
+
+def is_valid_filename(filename):
+    '''
+    Checks a file name sent by a peer: it must be relative and must not go
+    up with "..", so the path of its index file stays in the index dir.
+    '''
+
+    path = pathlib.PurePath(filename)
+    return bool(filename) and not path.is_absolute() and '..' not in path.parts
+
+def count_file(path):
+    '''
+    Counts the words of a file, reading it in pieces so its size does not
+    matter.
+
+    Args:
+        path (obj): Path of the file.
+
+    Returns:
+        dict: Contains the words as keys and their ocurrences as values.
+    '''
+
+    counter = WordCounter()
+
+    with open(path, 'rb') as fh:
+        while chunk := fh.read(READ_SIZE):
+            counter.feed(chunk)
+
+    return counter.finish()
+
+def read_index(path):
+    '''
+    Reads an index file: the version of the indexed file on the first line,
+    then its word occurrences in the binary-zlib encoding.
+
+    Args:
+        path (obj): Path of the index file.
+
+    Returns:
+        tuple: The version and the encoded word occurrences.
+    '''
+
+    with open(path, 'rb') as fh:
+        version = fh.readline().rstrip(b'\n')
+        return version, fh.read()
+
+def write_index(path, version, count):
+    '''
+    Writes an index file through a temporary file which is renamed over the
+    previous one, so a reader never sees it half written.
+
+    Args:
+        path (obj): Path of the index file.
+        version (bytes): The version of the indexed file.
+        count (dict): Contains the words as keys and their ocurrences as values.
+    '''
+
+    path.parent.mkdir(parents = True, exist_ok = True)
+    temporary = path.with_name(f'.{path.name}.{os.getpid()}.tmp')
+
+    with open(temporary, 'wb') as fh:
+        fh.write(version + b'\n')
+        fh.write(occurrences.encode_word_occurrences(count, occurrences.BINARY_ZLIB))
+
+    os.replace(temporary, path)
+
+
+class Indexer:
+    '''
+    Indexer keeps the word occurrences of every file of the data dir in a
+    sidecar index file, so they are read in O(vocabulary) instead of counted
+    in O(file size). A background thread polls the data dir every "interval"
+    seconds and only counts again the files whose version (see file_version)
+    has changed since they were indexed; the index files of removed files
+    are removed too.
+
+    The index files which have been looked up are kept in memory, tagged
+    with the version of their file, so a popular file is not read and parsed
+    from the disk on every request.
+
+    Args:
+        data_dir (str): Path at filesystem which the files are stored.
+        index_dir (str): Path at filesystem where the index files are written, it may be inside the data dir.
+        interval (float): Seconds between two scans of the data dir. Defaults to 5.
+        cache_size (int): Memory budget in bytes of the index files kept in memory, 0 disables it. Defaults to 16 MiB.
+    '''
+
+    def __init__(self, data_dir, index_dir, interval = 5.0, cache_size = 16 * 1024 * 1024):
+        self.data_dir = pathlib.Path(data_dir)
+        self.index_dir = pathlib.Path(index_dir)
+        self.interval = interval
+        self.cache = ResultCache(max_bytes = cache_size)
+
+        self.versions = {} # file name -> version of its index file, as known by the scans
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def start(self):
+        '''
+        Starts scanning the data dir on a background thread.
+        '''
+
+        logger.info('indexing %s into %s every %s seconds...', self.data_dir, self.index_dir, self.interval)
+
+        self.stopped.clear()
+        self.thread = threading.Thread(target = self.run, name = 'indexer', daemon = True)
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+
+        if self.thread:
+            self.thread.join()
+            self.thread = None
+
+    def run(self):
+        while not self.stopped.is_set():
+            try:
+                self.scan()
+            except Exception as e:
+                logger.error('an exception occurred while indexing %s: Exception = %s', self.data_dir, e)
+
+            self.stopped.wait(self.interval)
+
+    def index_path(self, filename):
+        return pathlib.Path(self.index_dir, filename + INDEX_SUFFIX)
+
+    def scan(self):
+        '''
+        Indexes the new and changed files of the data dir and removes the
+        index files of the removed ones.
+
+        Returns:
+            int: Number of files which have been indexed.
+        '''
+
+        index_dir = self.index_dir.resolve()
+        filenames = set()
+        indexed = 0
+
+        for path in sorted(self.data_dir.rglob('*')):
+            if self.stopped.is_set():
+                return indexed
+
+            if path.resolve().is_relative_to(index_dir) or not path.is_file():
+                continue
+
+            filename = str(path.relative_to(self.data_dir))
+            filenames.add(filename)
+
+            try:
+                indexed += self.index_file(path, filename)
+            except FileNotFoundError:
+                filenames.discard(filename) # removed meanwhile
+
+        if self.index_dir.is_dir():
+            for path in self.index_dir.rglob('*' + INDEX_SUFFIX):
+                filename = str(path.relative_to(self.index_dir))[:-len(INDEX_SUFFIX)]
+
+                if filename not in filenames:
+                    logger.info('removing the index of %s, the file has been removed', filename)
+                    path.unlink(missing_ok = True)
+                    self.versions.pop(filename, None)
+
+        return indexed
+
+    def index_file(self, path, filename):
+        '''
+        Counts a file and writes its index file, unless the index is up to date.
+
+        Returns:
+            bool: Whether the file has been indexed.
+        '''
+
+        version = file_version(os.stat(path))
+
+        if filename not in self.versions:
+            try:
+                self.versions[filename] = read_index(self.index_path(filename))[0]
+            except OSError:
+                self.versions[filename] = None
+
+        if self.versions[filename] == version:
+            return False
+
+        started_at = time.perf_counter()
+        count = count_file(path)
+
+        if file_version(os.stat(path)) != version: # changed while it was counted, the next scan picks it up
+            return False
+
+        write_index(self.index_path(filename), version, count)
+        self.versions[filename] = version
+
+        logger.info('indexed %s: %s words in %.1f ms', filename, len(count), (time.perf_counter() - started_at) * 1000)
+        return True
+
+    def lookup(self, filename, version):
+        '''
+        Reads the indexed word occurrences of a file from memory, or from its
+        index file, so any process serving the data dir can answer from the
+        index.
+
+        Args:
+            filename (str): The requested file name.
+            version (bytes): The current version of the file.
+
+        Returns:
+            bytes: The word occurrences in the binary-zlib encoding, or None if the file has not been indexed at this version.
+        '''
+
+        if not is_valid_filename(filename):
+            return None
+
+        payload = self.cache.get(filename, version)
+        if payload is not None:
+            return payload
+
+        try:
+            indexed_version, payload = read_index(self.index_path(filename))
+        except FileNotFoundError:
+            return None
+
+        if indexed_version != version:
+            return None
+
+        self.cache.put(filename, version, payload)
+        return payload
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = 'indexes the word occurrences of the files of a data dir once')
+
+    parser.add_argument('--data-dir', type = str, default = './files', help = 'path at filesystem which the files are stored (default ./files)')
+    parser.add_argument('--index-dir', type = str, required = True, help = 'path at filesystem where the index files are written')
+    parser.add_argument('--log-level', type = str, default = 'info', choices = log.LEVELS, help = 'min level of the logged messages (default info)')
+
+    args = parser.parse_args()
+
+    log.setup(level = args.log_level)
+
+    indexer = Indexer(args.data_dir, args.index_dir)
+    logger.info('%s files have been indexed', indexer.scan())
@@ -0,0 +1,158 @@
+import atexit
+import logging
+import logging.handlers
+import os
+import queue
+import random
+import sys
+import time
+
+
+LEVELS = ['debug', 'info', 'warning', 'error']
+
+FORMAT = '%(asctime)s %(levelname)s [%(process)d] %(threadName)s: %(message)s'
+
+# seconds given to the background writer to make room for its stop sentinel
+STOP_TIMEOUT = 5
+
+
+class SamplingFilter(logging.Filter):
+    '''
+    Keeps only a fraction of the records below WARNING, so the per-message
+    logs of a busy server cost close to nothing. Warnings and errors are
+    never dropped.
+
+    Args:
+        rate (float): Fraction of the records which are kept, between 0 and 1. Defaults to 1.
+    '''
+
+    def __init__(self, rate = 1.0):
+        super().__init__()
+        self.rate = rate
+
+    def filter(self, record):
+        return self.rate >= 1 or record.levelno >= logging.WARNING or random.random() < self.rate
+
+
+class BackgroundHandler(logging.handlers.QueueHandler):
+    '''
+    Hands the records over to a background thread through a bounded queue.
+    The message is formatted by the background thread and, if the queue is
+    full, the record is dropped instead of blocking the caller.
+
+    Args:
+        records (obj): Queue shared with the background writer.
+    '''
+
+    def __init__(self, records):
+        super().__init__(records)
+        self.dropped = 0
+
+    def prepare(self, record):
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+class BackgroundWriter(logging.handlers.QueueListener):
+    '''
+    Writes the records handed over by BackgroundHandler on a background
+    thread. Its stop sentinel waits for room in the bounded queue, which the
+    thread keeps draining, instead of failing when the queue is full. A
+    thread stuck on its stream is given up after STOP_TIMEOUT seconds: it is
+    a daemon, so it goes away with the process.
+    '''
+
+    def stop(self):
+        if not self._thread:
+            return
+
+        deadline = time.monotonic() + STOP_TIMEOUT
+
+        try:
+            self.queue.put(self._sentinel, timeout = STOP_TIMEOUT)
+        except queue.Full:
+            pass
+        else:
+            self._thread.join(max(deadline - time.monotonic(), 0))
+
+        self._thread = None
+
+
+class Logging:
+    '''
+    Logging owns the background writer shared by every server in the process.
+    '''
+
+    def __init__(self):
+        self.handler = None
+        self.listener = None
+        self.options = None
+
+    def setup(self, level = 'info', sample_rate = 1.0, stream = sys.stderr, max_queued = 10000):
+        '''
+        Configures the "server" logger to write on "stream" from a background thread.
+
+        Args:
+            level (str): Min level of the records, one of LEVELS. Defaults to info.
+            sample_rate (float): Fraction of the records below WARNING which are kept. Defaults to 1.
+            stream (obj): File where the records are written to. Defaults to STDERR.
+            max_queued (int): Max number of records waiting to be written. Defaults to 10000.
+        '''
+
+        self.shutdown()
+        self.options = (level, sample_rate, stream, max_queued)
+
+        records = queue.Queue(max_queued)
+
+        writer = logging.StreamHandler(stream)
+        writer.setFormatter(logging.Formatter(FORMAT))
+
+        self.handler = BackgroundHandler(records)
+        self.handler.addFilter(SamplingFilter(sample_rate))
+
+        logger = logging.getLogger('server')
+        logger.handlers = [self.handler]
+        logger.setLevel(level.upper())
+        logger.propagate = False
+
+        self.listener = BackgroundWriter(records, writer)
+        self.listener.start()
+
+    def shutdown(self):
+        '''
+        Flushes the pending records and stops the background writer.
+        '''
+
+        if self.listener:
+            self.listener.stop()
+            self.listener = None
+
+    def restart(self):
+        '''
+        Starts a new background writer, since threads do not survive a fork.
+        '''
+
+        if self.options:
+            self.listener = None
+            self.setup(*self.options)
+
+
+logs = Logging()
+
+atexit.register(logs.shutdown)
+os.register_at_fork(after_in_child = logs.restart)
+
+
+def setup(level = 'info', sample_rate = 1.0, stream = sys.stderr):
+    logs.setup(level = level, sample_rate = sample_rate, stream = stream)
+
+def get_logger(name):
+    return logging.getLogger(f'server.{name}')
+
+def shutdown():
+    logs.shutdown()
@@ -0,0 +1,237 @@
+import csv
+import io
+import zlib
+
+
+# encodings of the word occurrences, negotiated with the "encoding" option of a query
+CSV         = 'csv'
+BINARY      = 'binary'      # varints and length-prefixed words, in the order of the count
+BINARY_ZLIB = 'binary-zlib' # the smallest one: sorted, front-coded and compressed
+
+ENCODINGS = (CSV, BINARY, BINARY_ZLIB)
+
+# the binary payload starts with a byte of flags
+FLAG_SORTED = 0x01 # the words are sorted and front-coded, each one only carries what differs from the previous
+FLAG_ZLIB   = 0x02 # everything after the flags is compressed with zlib
+
+
+def encode_word_occurrences_to_csv(count):
+    '''
+    Encodes a received dict to a CSV.
+
+    Args:
+        count (dict): Contains the words as keys and their ocurrences as values.
+
+    Returns:
+        csv: The count is just reestructured as a CSV, without nothing additional.
+    '''
+
+    r = io.StringIO()
+
+    writer = csv.writer(r)
+    for word in count:
+        writer.writerow([word, count[word]])
+
+    return r.getvalue()
+
+def decode_word_occurrences_from_csv(content):
+    '''
+    Decodes a received CSV to a dict.
+
+    Args:
+        count (csv): A received CSV.
+
+    Returns:
+        dict: Contains the words as keys and their ocurrences as values.
+    '''
+
+    count = {}
+    for row in csv.reader(io.StringIO(content)):
+        word, occurrences = row[0], int(row[1])
+        count[word] = occurrences
+
+    return count
+
+def write_varint(buffer, value):
+    '''
+    Appends an unsigned integer to a buffer as a varint: 7 bits per byte,
+    the high bit set on every byte but the last one.
+    '''
+
+    while value >= 0x80:
+        buffer.append(value & 0x7f | 0x80)
+        value >>= 7
+
+    buffer.append(value)
+
+def read_varint(data, offset):
+    '''
+    Reads a varint written by write_varint.
+
+    Returns:
+        tuple: The integer and the offset of the byte after it.
+    '''
+
+    value = shift = 0
+
+    while True:
+        byte = data[offset]
+        offset += 1
+
+        value |= (byte & 0x7f) << shift
+        if byte < 0x80:
+            return value, offset
+
+        shift += 7
+
+def encode_word_occurrences_to_binary(count, sort = False, compress = False):
+    '''
+    Encodes a received dict to the binary format: the number of words as a
+    varint, then every word as its UTF-8 length and bytes followed by its
+    occurrences as a varint.
+
+    Args:
+        count (dict): Contains the words as keys and their ocurrences as values.
+        sort (bool): Sorts the words and front-codes them, so a word only carries the suffix it does not share with the previous one. The order of "count" is lost. Defaults to False.
+        compress (bool): Compresses the payload with zlib. Defaults to False.
+
+    Returns:
+        bytes: The encoded word occurrences.
+    '''
+
+    body = bytearray()
+    write_varint(body, len(count))
+
+    if sort:
+        previous = b''
+
+        # UTF-8 keeps the order of the code points, the words can be sorted before they are encoded
+        for word in sorted(count):
+            occurrences, word = count[word], word.encode()
+
+            shared = 0
+            limit = min(len(word), len(previous))
+            while shared < limit and word[shared] == previous[shared]:
+                shared += 1
+
+            write_varint(body, shared)
+            write_varint(body, len(word) - shared)
+            body += word[shared:]
+            write_varint(body, occurrences)
+
+            previous = word
+
+    else:
+        for word, occurrences in count.items():
+            word = word.encode()
+
+            write_varint(body, len(word))
+            body += word
+            write_varint(body, occurrences)
+
+    flags = (FLAG_SORTED if sort else 0) | (FLAG_ZLIB if compress else 0)
+
+    return bytes([flags]) + (zlib.compress(body) if compress else body)
+
+def decode_word_occurrences_from_binary(payload):
+    '''
+    Decodes a payload encoded by encode_word_occurrences_to_binary.
+
+    Args:
+        payload (bytes): The encoded word occurrences.
+
+    Returns:
+        dict: Contains the words as keys and their ocurrences as values.
+    '''
+
+    if not payload:
+        raise ValueError('empty word occurrences payload')
+
+    flags, data = payload[0], payload[1:]
+
+    if flags & ~(FLAG_SORTED | FLAG_ZLIB):
+        raise ValueError(f'unknown word occurrences flags {flags:#04x}')
+
+    if flags & FLAG_ZLIB:
+        data = zlib.decompress(data)
+
+    count = {}
+
+    # most lengths and occurrences fit in a byte, they are read inline instead of calling read_varint
+    try:
+        size, offset = read_varint(data, 0)
+        previous = b''
+
+        for _ in range(size):
+            if flags & FLAG_SORTED:
+                shared = data[offset]
+                if shared < 0x80:
+                    offset += 1
+                else:
+                    shared, offset = read_varint(data, offset)
+
+            length = data[offset]
+            if length < 0x80:
+                offset += 1
+            else:
+                length, offset = read_varint(data, offset)
+
+            end = offset + length
+            word = data[offset:end]
+
+            if flags & FLAG_SORTED:
+                word = previous[:shared] + word
+                previous = word
+
+            occurrences = data[end]
+            if occurrences < 0x80:
+                offset = end + 1
+            else:
+                occurrences, offset = read_varint(data, end)
+
+            count[word.decode()] = occurrences
+
+    except IndexError:
+        raise ValueError('truncated word occurrences payload')
+
+    return count
+
+def encode_word_occurrences(count, encoding = CSV):
+    '''
+    Encodes the word occurrences for the wire.
+
+    Args:
+        count (dict): Contains the words as keys and their ocurrences as values.
+        encoding (str): One of ENCODINGS. Defaults to CSV.
+
+    Returns:
+        bytes: The encoded word occurrences.
+    '''
+
+    if encoding == CSV:
+        return encode_word_occurrences_to_csv(count).encode()
+
+    if encoding in (BINARY, BINARY_ZLIB):
+        return encode_word_occurrences_to_binary(count, sort = encoding == BINARY_ZLIB, compress = encoding == BINARY_ZLIB)
+
+    raise ValueError(f'unknown encoding {encoding!r}')
+
+def decode_word_occurrences(payload, encoding = CSV):
+    '''
+    Decodes the word occurrences encoded by encode_word_occurrences.
+
+    Args:
+        payload (bytes): The encoded word occurrences.
+        encoding (str): One of ENCODINGS. Defaults to CSV.
+
+    Returns:
+        dict: Contains the words as keys and their ocurrences as values.
+    '''
+
+    if encoding == CSV:
+        return decode_word_occurrences_from_csv(str(payload, encoding = 'utf-8'))
+
+    if encoding in (BINARY, BINARY_ZLIB):
+        return decode_word_occurrences_from_binary(payload)
+
+    raise ValueError(f'unknown encoding {encoding!r}')
@@ -1,33 +1,30 @@
 #!/usr/bin/env python3
 
 import argparse
-import csv
-import io
+import framing
+import heapq
+import log
+import occurrences
 import os
-import pathlib
 import server
 import signal
-import socket
-import sys
 
-from data import Data
+from cache import ResultCache
+from pool import ConnectionPool
+from singleflight import SingleFlight
+from words import CountingPool
 
+logger = log.get_logger(__name__)
 
-def count_word_occurrences(content):
-    count = dict()
-    for word in content.split():
-        count[word] = count.get(word, 0) + 1
 
-    return count
-
-def encode_word_occurrences_to_csv(count):
-    r = io.StringIO()
-
-    writer = csv.writer(r)
-    for word in count:
-        writer.writerow([word, count[word]])
+def select_top_occurrences(count, k):
+    '''
+    Selects the k words that appeared the most with a heap of k elements,
+    which takes O(n log k) instead of sorting the whole vocabulary. Ties
+    are broken in lexicographical order.
+    '''
 
-    return r.getvalue()
+    return dict(heapq.nsmallest(k, count.items(), key = lambda item: (-item[1], item[0])))
 
 
 class Processing(server.Server):
@@ -35,55 +32,145 @@ class Processing(server.Server):
     Reimplements the Server Class.
     '''
 
-    def __init__(self, data_address = 'localhost', data_port = 8080, payload_size = 1024):
-        super().__init__(payload_size = payload_size)
+    def __init__(self, data_address = 'localhost', data_port = 8080, payload_size = 1024, counting_pool = None, cache = None, pool_size = 8, use_index = True, threads = 16, max_pending = 64, upstream_timeout = None):
+        super().__init__(payload_size = payload_size, threads = threads, max_pending = max_pending)
 
         self.data_address = data_address
         self.data_port = data_port
+        self.counting_pool = counting_pool or CountingPool(processes = 0)
+        self.cache = cache or ResultCache(max_bytes = 0)
+        self.data_pool = ConnectionPool(data_address, data_port, max_size = pool_size, timeout = upstream_timeout)
+        self.use_index = use_index
+
+        # concurrent requests for the same file share a single fetch and count
+        self.flights = SingleFlight()
+
+    def shutdown(self):
+        super().shutdown() # the workers are joined first, since they may still be counting or fetching a file
+        self.counting_pool.shutdown()
+
+        logger.info('data connection pool: %s', self.data_pool.stats())
+        logger.info('coalesced requests: %s', self.flights.shared)
+        self.data_pool.close()
+
+        if self.cache.max_bytes:
+            logger.info('result cache: %s', self.cache.stats())
+
+    def request_handler(self, peer_address, frame):
+        try:
+            query = framing.decode_query(frame.payload)
+        except framing.ProtocolError as e:
+            return framing.ERROR, f'error: {e}'.encode()
+
+        filename, top, encoding = query['filename'], query.get('top'), query.get('encoding', occurrences.CSV)
+        if encoding not in occurrences.ENCODINGS:
+            return framing.ERROR, f'error: unknown encoding {encoding}'.encode()
+
+        logger.info('  > %s:%s has requested the %s file', peer_address[0], peer_address[1], filename)
+
+        version = None
+
+        if self.cache.max_bytes:
+            reply = self.stat_file(filename)
+            if reply.type == framing.ERROR:
+                return framing.ERROR, reply.payload
+
+            version = reply.payload
+
+            response = self.cache.get((filename, top, encoding), version)
+            if response is not None:
+                logger.debug('  > serving the cached word occurrences of %s', filename)
+                return framing.RESPONSE, response
+
+        # keyed by the version too, so a request never shares a count started before the file changed, nor caches it
+        frame_type, result = self.flights.run((filename, version), lambda: self.count_file_words(filename))
+
+        if frame_type == framing.ERROR:
+            return framing.ERROR, result
+
+        if top is not None:
+            result = select_top_occurrences(result, top)
 
-    def request_handler(self, peer_conn, peer_address, data = ''):
-        filename = data.rstrip(os.linesep)
-        print(f'  > {peer_address[0]}:{peer_address[1]} has requested the {filename} file', file = sys.stderr)
+        response = occurrences.encode_word_occurrences(result, encoding)
 
-        content = self.get_file_content(filename)
+        if version is not None:
+            self.cache.put((filename, top, encoding), version, response)
 
-        response = ''
+        return framing.RESPONSE, response
 
-        if Data.is_error(content):
-            response = content
-        else:
-            response = encode_word_occurrences_to_csv(count_word_occurrences(content))
+    def stat_file(self, filename):
+        '''
+        Asks the Data Server for the version of a file, which is much cheaper
+        than fetching it.
+
+        Args:
+            filename (str): The requested file name.
+
+        Returns:
+            Frame: The reply of the Data Server, with the version of the file or an error.
+        '''
+
+        def stat(data_conn):
+            framing.send_frame(data_conn, framing.STAT, 1, filename.encode())
+            logger.debug('requesting the version of %s on data service', filename)
+
+            reply = framing.recv_frame(data_conn)
+            if reply is None:
+                raise ConnectionError('data service has closed the connection')
 
-        peer_conn.send(response.encode())
+            return reply
 
-    def get_file_content(self, filename):
+        return self.data_pool.run(stat)
+
+    def count_file_words(self, filename):
         '''
-        Connects with Data Server and sends the received file name.
+        Sends the received file name to the Data Server, on a pooled
+        connection, and counts the words of the content while it is being
+        received. The precomputed word occurrences are asked first, unless
+        "use_index" is off, and the file is only counted if it has not been
+        indexed.
 
         Args:
             filename (str): The requested file name.
 
         Returns:
-            str: The content of the file name requested to the Data Server.
+            tuple: RESPONSE and the word occurrences, or ERROR and the error message sent by the Data Server.
         '''
 
-        content = ''
+        def count(data_conn):
+            if self.use_index:
+                framing.send_frame(data_conn, framing.INDEX, 1, filename.encode())
+                logger.debug('requesting the index of %s on data service', filename)
+
+                reply = framing.recv_frame(data_conn)
+                if reply is None:
+                    raise ConnectionError('data service has closed the connection')
+
+                if reply.type == framing.RESPONSE:
+                    return reply.type, occurrences.decode_word_occurrences_from_binary(reply.payload)
+
+            framing.send_frame(data_conn, framing.REQUEST, 1, filename.encode())
+            logger.debug('requesting the content of %s on data service', filename)
+
+            header = framing.recv_header(data_conn, max_size = None)
+            if header is None:
+                raise ConnectionError('data service has closed the connection')
 
-        with socket.socket() as data_conn:
-            print(f'connecting to data service at {self.data_address}:{self.data_port}', file = sys.stderr)
-            data_conn.connect((self.data_address, self.data_port))
+            frame_type, _, length = header
 
-            data_conn.sendall(filename.encode())
-            print(f'requesting the content of {filename} on data service', file = sys.stderr)
+            if frame_type == framing.ERROR:
+                if length > framing.MAX_PAYLOAD_SIZE:
+                    raise framing.ProtocolError(f'error of {length} bytes exceeds the limit of {framing.MAX_PAYLOAD_SIZE} bytes')
 
-            while True:
-                raw = data_conn.recv(self.payload_size)
-                if not raw:
-                    break
+                return frame_type, framing.recv_exactly(data_conn, length)
 
-                content += str(raw, encoding = 'utf-8')
+            counter = self.counting_pool.counter(length)
+            for chunk in framing.recv_chunks(data_conn, length):
+                counter.feed(chunk)
 
-        return content
+            return frame_type, counter.finish()
+
+        return self.data_pool.run(count)
 
 
 if __name__ == '__main__':
@@ -91,12 +178,28 @@ if __name__ == '__main__':
 
     parser.add_argument('--host', '-H', type = str, default = 'localhost', help = 'local address (default localhost)')
     parser.add_argument('--port', '-p', type = int, default = 8080, help = 'local port (default 8080)')
+    parser.add_argument('--threads', '-t', type = int, default = 16, help = 'number of worker threads, each one handling a request at a time (default 16)')
+    parser.add_argument('--max-pending', type = int, default = 64, help = 'max number of requests waiting for a free thread, the extra ones are answered with an error, 0 means no limit (default 64)')
     parser.add_argument('--data-address', type = str, default = 'localhost', help = 'data server\'s address (default localhost)')
     parser.add_argument('--data-port', type = int, default = 8080, help = 'data server\'s port (default 8080)')
+    parser.add_argument('--count-processes', type = int, default = os.cpu_count(), help = 'number of processes counting the large files, 0 counts every file inline (default the number of CPUs)')
+    parser.add_argument('--count-threshold', type = int, default = 8 * 1024 * 1024, help = 'min size in bytes of a file counted on the processes (default 8 MiB)')
+    parser.add_argument('--pool-size', type = int, default = 8, help = 'max number of connections kept open with the data server (default 8)')
+    parser.add_argument('--upstream-timeout', type = float, default = 0, help = 'seconds after which a read from the data server waiting for its next bytes fails, not a limit on the whole transfer, 0 disables it (default 0)')
+    parser.add_argument('--cache-size', type = int, default = 64 * 1024 * 1024, help = 'memory budget in bytes of the cached results, 0 disables the cache (default 64 MiB)')
+    parser.add_argument('--no-index', action = 'store_true', help = 'always count the files instead of asking the data server for their precomputed word occurrences first')
+    parser.add_argument('--log-level', type = str, default = 'info', choices = log.LEVELS, help = 'min level of the logged messages, debug traces every message (default info)')
+    parser.add_argument('--log-sample', type = float, default = 1.0, help = 'fraction of the debug and info messages which are logged (default 1)')
 
     args = parser.parse_args()
 
-    server = Processing(data_address = args.data_address, data_port = args.data_port)
+    log.setup(level = args.log_level, sample_rate = args.log_sample)
+
+    counting_pool = CountingPool(processes = args.count_processes, threshold = args.count_threshold)
+
+    cache = ResultCache(max_bytes = args.cache_size)
+
+    server = Processing(data_address = args.data_address, data_port = args.data_port, counting_pool = counting_pool, cache = cache, pool_size = args.pool_size, use_index = not args.no_index, threads = args.threads, max_pending = args.max_pending, upstream_timeout = args.upstream_timeout or None)
 
     for ss in [signal.SIGINT, signal.SIGTERM]:
         signal.signal(ss, lambda received_signal, frame: server.stop())
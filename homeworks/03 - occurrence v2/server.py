@@ -1,13 +1,123 @@
 #!/usr/bin/env python3
 
-import argparse
-import errno
-import select
-import signal
+import collections
+import io
+import os
+import queue
+import selectors
 import socket
-import sys
 import threading
 
+import framing
+import log
+
+
+logger = log.get_logger(__name__)
+
+class Connection:
+    '''
+    Connection keeps the state of a peer on the event loop. It goes from
+    READING the next request frame, to HANDLING it on a worker thread, to
+    WRITING the reply, and back to READING. Reading and writing never
+    block: they go as far as the socket allows and resume on its next event.
+
+    Args:
+        sock (obj): The non-blocking socket of the peer.
+        address (tuple): A tuple with the address and port from the remote peer.
+    '''
+
+    READING  = 'reading'
+    HANDLING = 'handling'
+    WRITING  = 'writing'
+
+    def __init__(self, sock, address):
+        self.socket = sock
+        self.address = address
+        self.state = Connection.READING
+        self.events = 0 # events watched on the selector, 0 if it is not registered
+        self.closed = False
+
+        self.inbox = bytearray() # received bytes which do not make a whole frame yet
+        self.outbox = memoryview(b'') # the frame being written, or the header of a file reply
+        self.file = None # file streamed with sendfile after the header
+        self.file_offset = 0
+        self.file_size = 0
+
+    def next_frame(self):
+        '''
+        Takes the next request frame out of the received bytes.
+
+        Returns:
+            Frame: The request, or None if it has not been fully received yet.
+        '''
+
+        if len(self.inbox) < framing.HEADER.size:
+            return None
+
+        frame_type, request_id, length = framing.decode_header(bytes(self.inbox[:framing.HEADER.size]))
+
+        end = framing.HEADER.size + length
+        if len(self.inbox) < end:
+            return None
+
+        payload = bytes(self.inbox[framing.HEADER.size:end])
+        del self.inbox[:end]
+
+        return framing.Frame(frame_type, request_id, payload)
+
+    def reply(self, frame_type, request_id, payload = b''):
+        '''
+        Prepares the reply to be written, switching to WRITING.
+
+        Args:
+            frame_type (int): One of RESPONSE or ERROR.
+            request_id (int): Identifier of the answered request.
+            payload (bytes): The frame content, either bytes or a file opened in binary mode.
+        '''
+
+        if isinstance(payload, io.IOBase):
+            self.file, self.file_offset, self.file_size = payload, 0, framing.payload_size(payload)
+            self.outbox = memoryview(framing.HEADER.pack(frame_type, request_id, self.file_size))
+        else:
+            self.outbox = memoryview(framing.encode_frame(frame_type, request_id, payload))
+
+        self.state = Connection.WRITING
+
+    def write(self):
+        '''
+        Writes as much of the reply as the socket takes.
+
+        Returns:
+            bool: Whether the whole reply has been written.
+        '''
+
+        try:
+            while self.outbox:
+                self.outbox = self.outbox[self.socket.send(self.outbox):]
+
+            while self.file and self.file_offset < self.file_size:
+                sent = os.sendfile(self.socket.fileno(), self.file.fileno(), self.file_offset, self.file_size - self.file_offset)
+                if not sent:
+                    raise framing.ProtocolError('file has been truncated while it was being sent')
+
+                self.file_offset += sent
+
+        except BlockingIOError:
+            return False
+
+        self.close_file()
+        return True
+
+    def close_file(self):
+        if self.file:
+            self.file.close()
+            self.file = None
+
+    def close(self):
+        self.closed = True
+        self.close_file()
+        self.socket.close()
+
 
 class Server:
     '''
@@ -15,17 +125,41 @@ class Server:
     to one or more local interface and listens for incoming connection on some
     port.
 
+    A single event loop watches the listening socket and every peer with an
+    epoll selector, so an idle connection costs no thread and no CPU. Each
+    connection is a state machine (see Connection) which reads a request,
+    hands it to the worker threads and writes the reply without blocking.
+    The handlers run on a fixed number of worker threads, which take the
+    requests from a bounded queue; once it is full, the new requests are
+    answered with an error right away.
+
     Args:
         payload_size (int): Max size of an incoming message. Defaults to 1024.
+        threads (int): Number of worker threads, each one handling a request at a time. Defaults to 16.
+        max_pending (int): Max number of requests waiting for a free worker, 0 means no limit. Defaults to 64.
     '''
 
-    def __init__(self, payload_size = 1024):
+    ERROR_SERVER_BUSY           = 'error: server is busy'
+    ERROR_INTERNAL_SERVER_ERROR = 'error: internal server error'
+
+    REQUEST_TYPES = (framing.REQUEST,)
+
+    def __init__(self, payload_size = 1024, threads = 16, max_pending = 64):
         self.payload_size = payload_size
+        self.threads = threads
+        self.max_pending = max_pending
 
         self.lock = threading.Lock()
-        self.threads = []
+        self.workers = []
+        self.pending = None
+        self.completed = collections.deque() # (connection, request ID, frame type, payload) handled by the workers
         self.stopped = True
         self.socket = None
+        self.selector = None
+        self.wakeup = None # socket pair waking up the event loop when a request has been handled
+        self.connections = set()
+
+        self.rejected = 0
 
     def start(self, host, port):
         '''
@@ -37,40 +171,53 @@ class Server:
         '''
 
         address = (host, port)
-        print(f'starting the server at {address[0]}:{address[1]}...')
+        logger.info('starting the server at %s:%s...', address[0], address[1])
 
         with self.lock:
             if not self.stopped:
                 raise Exception('server is already running')
 
             self.socket = self.create_server(address)
+            self.selector = selectors.DefaultSelector()
+            self.selector.register(self.socket, selectors.EVENT_READ)
 
-        self.listen_connections()
+            self.wakeup = socket.socketpair()
+            for s in self.wakeup:
+                s.setblocking(False)
 
-        self.socket.close()
+            self.selector.register(self.wakeup[0], selectors.EVENT_READ)
+            self.stopped = False
 
-        with self.lock:
-            self.socket = None
+            self.pending = queue.Queue(self.max_pending)
+            self.workers = [threading.Thread(target = self.serve_requests, args = (self.pending,)) for _ in range(self.threads)]
+
+            for t in self.workers:
+                t.start()
+
+        try:
+            self.run_event_loop()
+        finally:
+            self.shutdown()
 
     def stop(self):
         '''
-        Stops the server.
+        Stops the server. The event loop closes the connections and waits for
+        the workers to finish once it wakes up. It takes no lock, since it is
+        usually called by a signal handler on the thread running the loop.
         '''
 
-        with self.lock:
-            print('server has received a signal to stop...')
-            self.stopped = True
-
-            if self.socket:
-                self.socket.close()
-
-            print(self.threads)
+        logger.info('server has received a signal to stop...')
+        self.stopped = True
+        self.wake_up()
 
-            for t in self.threads:
-                print(t)
-                t.join()
+    def wake_up(self):
+        if not self.wakeup:
+            return
 
-            self.threads = []
+        try:
+            self.wakeup[1].send(b'\0')
+        except OSError: # already woken up, the loop reads every byte at once
+            pass
 
     def create_server(self, address):
         '''
@@ -84,73 +231,232 @@ class Server:
         ss.setblocking(False) # set the socket as asynchronous
         return ss
 
-    def listen_connections(self):
+    def run_event_loop(self):
+        '''
+        Waits for the events of the listening socket, of the peers and of the
+        workers, until the server is stopped.
         '''
-        Accepts new connections from remote peers.
 
-        Args:
-            socket (obj): Inherited socket object.
+        while not self.stopped:
+            for key, events in self.selector.select():
+                if key.fileobj is self.socket:
+                    self.accept_connections()
+                elif key.fileobj is self.wakeup[0]:
+                    self.complete_requests()
+                else:
+                    self.serve_connection(key.data, events)
+
+    def shutdown(self):
+        '''
+        Closes the listening socket and the connections, and waits for the
+        workers to finish the requests they are handling.
         '''
 
-        while True:
-            reading_list = []
+        with self.lock:
+            workers, self.workers = self.workers, []
 
-            try:
-                reading_list, _, _ = select.select([self.socket], [], [])
-            except IOError as e:
-                if e.errno == errno.EBADF: # server has been stopped
-                    break
+        logger.debug('waiting for %s workers to finish...', len(workers))
 
-            except Exception as e:
-                print(f'an exception occurred while listening for connections: Exception = {e}', file = sys.stderr)
-                break
+        for t in workers:
+            self.pending.put(None)
+
+        for t in workers:
+            t.join()
+
+        for conn in self.connections:
+            conn.close()
+
+        self.connections.clear()
 
-            for r in reading_list:
+        while self.completed:
+            _, _, _, payload = self.completed.popleft()
+            if isinstance(payload, io.IOBase):
+                payload.close()
+
+        self.selector.close()
+        self.socket.close()
+
+        for s in self.wakeup:
+            s.close()
+
+        with self.lock:
+            self.socket = None
+
+        if self.rejected:
+            logger.info('%s requests have been rejected', self.rejected)
+
+    def accept_connections(self):
+        '''
+        Accepts the pending connections of remote peers and starts watching them.
+        '''
+
+        while True:
+            try:
                 peer_connection, peer_address = self.socket.accept()
 
-                thread = threading.Thread(target = self.handle_connection, args = (peer_connection, peer_address))
-                thread.start()
+            except BlockingIOError: # none left, or taken by another process sharing the port
+                return
+
+            except OSError as e:
+                logger.error('an exception occurred while accepting a connection: Exception = %s', e)
+                return
+
+            logger.debug('handling connection from peer %s:%s...', peer_address[0], peer_address[1])
+
+            peer_connection.setblocking(False)
 
-                self.threads.append(thread)
+            conn = Connection(peer_connection, peer_address)
+            self.connections.add(conn)
+            self.watch(conn, selectors.EVENT_READ)
 
-    def handle_connection(self, peer_conn, peer_address):
+    def watch(self, conn, events):
+        '''
+        Changes the events of a connection watched on the selector, 0 stops watching it.
         '''
-        Handles the connection from a remote peer, extracts the payload and
-        replies with the same content.
 
-        Args:
-            peer_conn (obj): Inherited socket object.
-            peer_address (tuple): A tuple with the address and port from the remote peer.
+        if events == conn.events:
+            return
+
+        if not events:
+            self.selector.unregister(conn.socket)
+        elif not conn.events:
+            self.selector.register(conn.socket, events, conn)
+        else:
+            self.selector.modify(conn.socket, events, conn)
+
+        conn.events = events
+
+    def serve_connection(self, conn, events):
+        '''
+        Handles an event of a peer: new bytes of a request, or room to write
+        the rest of a reply.
         '''
 
-        peer_id = f'{peer_address[0]}:{peer_address[1]}'
-        print(f'handling connection from peer {peer_id}...')
+        try:
+            if events & selectors.EVENT_READ:
+                data = conn.socket.recv(framing.CHUNK_SIZE)
+                if not data:
+                    logger.debug('  > no content received, closing the connection with %s:%s...', conn.address[0], conn.address[1])
+                    self.close_connection(conn)
+                    return
 
-        messages_count = 0
+                conn.inbox += data
+
+            self.advance(conn)
+
+        except BlockingIOError:
+            pass
+
+        except Exception as e:
+            logger.warning('an exception occurred while handling a connection from peer %s:%s: Exception = %s', conn.address[0], conn.address[1], e)
+            self.close_connection(conn)
+
+    def advance(self, conn):
+        '''
+        Moves a connection through its states as far as it goes without
+        blocking, then watches the events it waits for.
+        '''
 
         while True:
+            if conn.state == Connection.WRITING:
+                if not conn.write():
+                    self.watch(conn, selectors.EVENT_WRITE)
+                    return
+
+                conn.state = Connection.READING
+
+            if conn.state != Connection.READING:
+                return
+
+            frame = conn.next_frame()
+            if frame is None:
+                self.watch(conn, selectors.EVENT_READ)
+                return
+
+            if frame.type not in self.REQUEST_TYPES:
+                conn.reply(framing.ERROR, frame.request_id, f'error: unexpected frame type {frame.type}'.encode())
+                continue
+
             try:
-                messages_count += 1
+                self.pending.put_nowait((conn, frame))
 
-                data = peer_conn.recv(self.payload_size)
-                if not data:
-                    print(f'  > message #{messages_count}: no content received, closing the connection with {peer_id}...')
-                    break
+            except queue.Full:
+                logger.warning('server is busy, rejecting a request from %s:%s', conn.address[0], conn.address[1])
+                self.rejected += 1
+
+                conn.reply(framing.ERROR, frame.request_id, Server.ERROR_SERVER_BUSY.encode())
+                continue
+
+            # the peer is not read while its request is being handled
+            conn.state = Connection.HANDLING
+            self.watch(conn, 0)
+            return
+
+    def complete_requests(self):
+        '''
+        Writes the replies of the requests handled by the workers.
+        '''
+
+        try:
+            while self.wakeup[0].recv(1024):
+                pass
+        except BlockingIOError:
+            pass
+
+        while self.completed:
+            conn, request_id, frame_type, payload = self.completed.popleft()
 
-                self.request_handler(peer_conn, peer_address, str(data, encoding='utf-8'))
+            if conn.closed:
+                if isinstance(payload, io.IOBase):
+                    payload.close()
 
-            except IOError as e:
-                if e.errno == errno.EDEADLK: # ignoring the "Resource temporarily unavailable" error if no data is available (since the socket is asynchronous)
-                   continue
+                continue
 
-                if e.errno == errno.EBADF: # if the file descriptor is suddenly closed in the "connection_handler" method, we close abort the loop to end up the thread
-                    break
+            conn.reply(frame_type, request_id, payload)
+            self.serve_connection(conn, 0)
+
+    def close_connection(self, conn):
+        if conn.events:
+            self.watch(conn, 0)
+
+        self.connections.discard(conn)
+        conn.close()
+
+    def serve_requests(self, pending):
+        '''
+        Handles the queued requests one at a time, until it takes None.
+
+        Args:
+            pending (obj): Queue of the requests, with their connection.
+        '''
+
+        while True:
+            item = pending.get()
+            if item is None:
+                return
+
+            conn, frame = item
+
+            try:
+                frame_type, payload = self.request_handler(conn.address, frame)
 
             except Exception as e:
-                print(f'an exception occurred while handling a connection from peer {peer_id}: Exception = {e}', file = sys.stderr)
-                break
+                logger.error('an exception occurred while handling a request from peer %s:%s: Exception = %s', conn.address[0], conn.address[1], e)
+                frame_type, payload = framing.ERROR, Server.ERROR_INTERNAL_SERVER_ERROR.encode()
 
-        peer_conn.close()
+            self.completed.append((conn, frame.request_id, frame_type, payload))
+            self.wake_up()
+
+    def request_handler(self, peer_address, frame):
+        '''
+        Handles a request on a worker thread.
+
+        Args:
+            peer_address (tuple): A tuple with the address and port from the remote peer.
+            frame (Frame): The request.
+
+        Returns:
+            tuple: The frame type of the reply and its payload, bytes or a file opened in binary mode.
+        '''
 
-    def request_handler(self, peer_conn, peer_address, data = ''):
         raise NotImplementedError("please implement this method")
@@ -0,0 +1,121 @@
+import asyncio
+import concurrent.futures
+import threading
+
+
+class SingleFlight:
+    '''
+    SingleFlight coalesces concurrent calls for the same key: the first one
+    runs the call, and the ones arriving while it is in progress wait for it
+    and share its result, or its exception, instead of running it again. A
+    thundering herd on a popular file then costs a single fetch and count.
+    Nothing is kept once the call is over, the next one runs it again.
+
+    The result is shared by every caller, it must not be modified.
+    '''
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.calls = {} # key -> future of the call in progress
+
+        self.shared = 0
+
+    def run(self, key, function):
+        '''
+        Runs "function", unless a call for the same key is in progress.
+
+        Args:
+            key (obj): Identifies the call, such as the requested file name.
+            function (function): Computes the result, it receives no argument.
+
+        Returns:
+            obj: What "function" returns.
+        '''
+
+        with self.lock:
+            future = self.calls.get(key)
+            leader = future is None
+
+            if leader:
+                future = self.calls[key] = concurrent.futures.Future()
+            else:
+                self.shared += 1
+
+        if not leader:
+            return future.result()
+
+        try:
+            result = function()
+
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+
+        else:
+            future.set_result(result)
+            return result
+
+        finally:
+            with self.lock:
+                del self.calls[key]
+
+
+class AsyncSingleFlight:
+    '''
+    AsyncSingleFlight coalesces concurrent calls for the same key on the
+    event loop, as SingleFlight does for threads.
+    '''
+
+    def __init__(self):
+        self.calls = {} # key -> future of the call in progress
+
+        self.shared = 0
+
+    async def run(self, key, function):
+        '''
+        Awaits "function", unless a call for the same key is in progress.
+
+        Args:
+            key (obj): Identifies the call, such as the requested file name.
+            function (function): Coroutine function computing the result, it receives no argument.
+
+        Returns:
+            obj: What "function" returns.
+        '''
+
+        while (future := self.calls.get(key)) is not None:
+            self.shared += 1
+
+            try:
+                return await asyncio.shield(future) # a waiter being cancelled does not cancel the call
+
+            except asyncio.CancelledError:
+                if not future.cancelled():
+                    raise
+
+                self.shared -= 1 # the caller has been cancelled, the call is run again by a waiter
+
+        future = self.calls[key] = asyncio.get_running_loop().create_future()
+
+        try:
+            result = await function()
+
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+
+        except BaseException as e:
+            future.set_exception(e)
+            future.exception() # retrieved, so it is not reported when nobody else was waiting
+            raise
+
+        else:
+            future.set_result(result)
+            return result
+
+        finally:
+            del self.calls[key]
+
+
+def expose_single_flight_metrics(registry, flights):
+    registry.gauge('coalesced_requests', lambda: flights.shared)
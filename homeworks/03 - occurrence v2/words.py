@@ -0,0 +1,217 @@
+import codecs
+import collections
+import concurrent.futures
+import framing
+import log
+import multiprocessing
+import os
+import threading
+
+
+logger = log.get_logger(__name__)
+
+
+def count_word_occurrences(content):
+    '''
+    Count the occurrence of the words in "content".
+
+    Args:
+        content (str): The received content from a requested file.
+
+    Returns:
+        dict: Contains the words as keys and their ocurrences as values.
+    '''
+
+    count = dict()
+    for word in content.split():
+        count[word] = count.get(word, 0) + 1
+
+    return count
+
+class WordCounter:
+    '''
+    WordCounter counts the words of a text received in chunks, so the count
+    is updated while the rest of the text is still on the network and the
+    text is never held in memory as a whole. UTF-8 sequences and words
+    split between two chunks are carried over to the next one.
+
+    Args:
+        encoding (str): Encoding of the text. Defaults to UTF-8.
+    '''
+
+    def __init__(self, encoding = 'utf-8'):
+        self.decoder = codecs.getincrementaldecoder(encoding)(errors = 'replace')
+        self.count = collections.Counter()
+        self.partial_word = ''
+
+    def feed(self, chunk):
+        '''
+        Counts the words of a chunk, keeping back the last one if the chunk
+        may have cut it.
+
+        Args:
+            chunk (bytes): The next piece of the text.
+        '''
+
+        text = self.partial_word + self.decoder.decode(chunk)
+        words = text.split()
+
+        if words and not text[-1].isspace():
+            self.partial_word = words.pop()
+        else:
+            self.partial_word = ''
+
+        self.count.update(words)
+
+    def finish(self):
+        '''
+        Counts what is left once the whole text has been fed.
+
+        Returns:
+            dict: Contains the words as keys and their ocurrences as values.
+        '''
+
+        self.count.update((self.partial_word + self.decoder.decode(b'', final = True)).split())
+        self.partial_word = ''
+
+        return self.count
+
+
+# ASCII whitespace never shows up inside a UTF-8 multi-byte sequence, so
+# cutting right after one of them never splits a word nor a character
+WHITESPACE = [b' ', b'\n', b'\t', b'\r', b'\x0b', b'\x0c']
+
+
+def count_shard(shard):
+    '''
+    Counts the words of a shard cut on a whitespace, in a worker process.
+
+    Args:
+        shard (bytes): UTF-8 encoded text.
+
+    Returns:
+        Counter: Contains the words as keys and their ocurrences as values.
+    '''
+
+    return collections.Counter(str(shard, encoding = 'utf-8', errors = 'replace').split())
+
+def find_last_whitespace(data):
+    return max(data.rfind(whitespace) for whitespace in WHITESPACE)
+
+class ParallelWordCounter:
+    '''
+    ParallelWordCounter has the same interface as WordCounter but counts the
+    text on a pool of processes: the chunks are gathered into shards cut on
+    a whitespace, every shard is counted by a worker (map) and the partial
+    counts are merged as they come back (reduce). Only a few shards are in
+    flight at once, so the memory stays bounded however large the text is.
+
+    Args:
+        executor (obj): The pool of processes where the shards are counted.
+        shard_size (int): Min size of a shard. Defaults to 4 MiB.
+        max_in_flight (int): Max number of shards being counted at once. Defaults to 4.
+    '''
+
+    def __init__(self, executor, shard_size = 4 * 1024 * 1024, max_in_flight = 4):
+        self.executor = executor
+        self.shard_size = shard_size
+        self.max_in_flight = max_in_flight
+
+        self.buffer = bytearray()
+        self.futures = collections.deque()
+        self.count = collections.Counter()
+
+    def feed(self, chunk):
+        self.buffer += chunk
+
+        if len(self.buffer) < self.shard_size:
+            return
+
+        cut = find_last_whitespace(self.buffer)
+        if cut < 0: # a single word so far, keep gathering
+            return
+
+        self.submit(bytes(self.buffer[:cut + 1]))
+        del self.buffer[:cut + 1]
+
+    def submit(self, shard):
+        if len(self.futures) >= self.max_in_flight:
+            self.count.update(self.futures.popleft().result())
+
+        self.futures.append(self.executor.submit(count_shard, shard))
+
+    def finish(self):
+        if self.buffer:
+            self.submit(bytes(self.buffer))
+            self.buffer.clear()
+
+        while self.futures:
+            self.count.update(self.futures.popleft().result())
+
+        return self.count
+
+class CountingPool:
+    '''
+    CountingPool picks how a file is counted: inline when it is small, since
+    shipping it to another process would cost more than counting it, or on a
+    pool of processes when it is large. The processes are only started when
+    the first large file arrives.
+
+    Args:
+        processes (int): Number of counting processes, 0 always counts inline. Defaults to the number of CPUs.
+        threshold (int): Min size in bytes of a file counted on the processes. Defaults to 8 MiB.
+        shard_size (int): Min size in bytes of the piece of a file counted by a process at once. Defaults to 4 MiB.
+    '''
+
+    def __init__(self, processes = os.cpu_count(), threshold = 8 * 1024 * 1024, shard_size = 4 * 1024 * 1024):
+        self.processes = processes
+        self.threshold = threshold
+        self.shard_size = shard_size
+
+        self.lock = threading.Lock()
+        self.executor = None
+
+    def counter(self, length):
+        '''
+        Returns a counter for a text of "length" bytes.
+        '''
+
+        if not self.processes or length < self.threshold:
+            return WordCounter()
+
+        with self.lock:
+            if self.executor is None:
+                logger.info('starting %s counting processes...', self.processes)
+
+                # spawned, since forking a process which runs threads may copy a held lock
+                context = multiprocessing.get_context('spawn')
+                self.executor = concurrent.futures.ProcessPoolExecutor(self.processes, mp_context = context)
+
+        return ParallelWordCounter(self.executor, self.shard_size, max_in_flight = 2 * self.processes)
+
+    def shutdown(self):
+        with self.lock:
+            if self.executor:
+                self.executor.shutdown(wait = False, cancel_futures = True)
+                self.executor = None
+
+def count_word_occurrences_in_parallel(data, pool):
+    '''
+    Counts the occurrence of the words in "data", on the processes of the
+    pool when it is large enough.
+
+    Args:
+        data (bytes): UTF-8 encoded text.
+        pool (obj): A CountingPool.
+
+    Returns:
+        dict: Contains the words as keys and their ocurrences as values.
+    '''
+
+    counter = pool.counter(len(data))
+
+    view = memoryview(data)
+    for offset in range(0, len(data), framing.CHUNK_SIZE):
+        counter.feed(view[offset:offset + framing.CHUNK_SIZE])
+
+    return counter.finish()